@@ -4,14 +4,15 @@ import json
 import yaml
 import contextlib
 import copy
+from collections import OrderedDict
 
-import requests
 import redis_lock
 from addict import Dict
-from flask import abort, g
+from flask import abort, g, Response, stream_with_context, after_this_request
 from marshmallow import ValidationError
 from sqlalchemy.exc import IntegrityError
 from webargs.flaskparser import use_args
+from werkzeug.exceptions import HTTPException
 
 from kaelib.spec import app_specs_schema
 
@@ -19,26 +20,32 @@ from console.libs.validation import (
     RegisterSchema, CreateAppArgsSchema, RollbackSchema, SecretArgsSchema, ConfigMapArgsSchema,
     ScaleSchema, DeploySchema, ClusterArgSchema, OptionalClusterArgSchema, ABTestingSchema,
     ClusterCanarySchema, SpecsArgsSchema, AppYamlArgsSchema, PaginationSchema, PodLogArgsSchema,
-    PodEntryArgsSchema, AppCanaryWeightArgSchema, GetPodEventsSchema,
+    PodEntryArgsSchema, AppCanaryWeightArgSchema, GetPodEventsSchema, BatchDeploySchema, ListAppArgsSchema,
+    OPLogArgsSchema,
 )
 
 from console.libs.utils import (
-    logger, make_canary_appname, im_sendmsg, make_app_redis_key,
-    make_errmsg, get_safe_cluster_names, validate_release_version,
+    logger, make_canary_appname, make_app_redis_key,
+    make_errmsg, make_msg, get_safe_cluster_names, validate_release_version,
 )
 from console.libs.view import create_api_blueprint, DEFAULT_RETURN_VALUE, user_require
 from console.models import (
     App, Release, DeployVersion, User, OPLog, OPType, AppYaml, AppConfig,
     RBACAction, check_rbac, prepare_roles_for_new_app, delete_roles_relate_to_app,
 )
-from console.libs.k8s import KubeApi, KubeError, ANNO_DEPLOY_INFO, ANNO_CONFIG_ID
+from console.libs.spec_cache import load_specs
+from console.libs.events import enqueue_event, get_event_metrics
+from console.libs.notify import notify_im
+from console.tasks import deliver_events_task
+from console.libs.k8s import KubeApi, KubeError, ANNO_DEPLOY_INFO, ANNO_CONFIG_ID, check_cluster_results
+from console.libs.informer import CacheMode
 from console.libs.k8s import ApiException
 from console.config import (
     DEFAULT_REGISTRY, IM_WEBHOOK_CHANNEL,
     TASK_PUBSUB_CHANNEL, TASK_PUBSUB_EOF,
-    CLUSTER_CFG, EVENT_WEBHOOK_URL,
+    CLUSTER_CFG,
 )
-from console.ext import rds
+from console.ext import rds, db
 
 bp = create_api_blueprint('app', __name__, 'app')
 
@@ -80,23 +87,25 @@ def fix_app_spec(spec, appname, tag):
         container['image'] = container['image'].replace('${TAG}', tag)
 
 
-def handle_event(**kwargs):
-    url = EVENT_WEBHOOK_URL.strip()
-    if url != "":
-        data = copy.deepcopy(kwargs)
-        data["action"] = str(kwargs["action"].value)
-        try:
-            requests.post(url, json=data, timeout=20)
-        except:
-            msg = f"Can't send event to webhook: {data}"
-            im_sendmsg(IM_WEBHOOK_CHANNEL, msg)
-            logger.exception("Can't send event to webhook")
+def handle_event(commit=True, **kwargs):
+    # the event is sent to the webhook by celery, so a slow webhook never blocks the request
+    data = copy.deepcopy(kwargs)
+    data["action"] = str(kwargs["action"].value)
+    try:
+        if enqueue_event(data):
+            deliver_events_task.delay()
+    except Exception:
+        logger.exception("Can't enqueue event")
     # create operation log
     data = kwargs
     if "prev" in kwargs:
         data = copy.deepcopy(kwargs)
         data.pop("prev")
-    OPLog.create(**data)
+    if commit:
+        OPLog.enqueue(**data)
+    else:
+        # the log is committed with the other changes of the caller
+        OPLog.create(commit=False, **data)
 
 
 @contextlib.contextmanager
@@ -183,7 +192,10 @@ def _get_release(appname, git_tag):
 def _get_canary_info(appname, cluster):
     canary_appname = make_canary_appname(appname)
     with handle_k8s_error("Error when get app {} canary".format(appname)):
-        dp = KubeApi.instance().get_deployment(canary_appname, cluster_name=cluster, ignore_404=True)
+        # it guards deploy and rollback, so a miss of the local store (e.g. the canary was just created
+        # by another worker) must be confirmed by apiserver
+        dp = KubeApi.instance().get_deployment(canary_appname, cluster_name=cluster, ignore_404=True,
+                                               cache_mode=CacheMode.READ_THROUGH)
     info = {}
     if dp is None:
         info['status'] = False
@@ -226,17 +238,79 @@ def _check_deploy_info_error(dp):
         abort(403, f"deployment's annotation don't contain {ANNO_DEPLOY_INFO}")
 
 
+def _get_deploy_state(appname, cluster):
+    """
+    check if the app can be deployed to the cluster,
+    :return: the deployment in kubernetes(None if it doesn't exist) and its deploy info
+    """
+    # check canary
+    canary_info = _get_canary_info(appname, cluster)
+    if canary_info['status']:
+        abort(403, "please delete canary release before you deploy a new release")
+
+    deploy_info = {}
+    with handle_k8s_error("Error when get deployment"):
+        k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, ignore_404=True,
+                                                           cache_mode=CacheMode.READ_THROUGH)
+        if k8s_deployment is not None:
+            _check_deploy_info_error(k8s_deployment)
+
+            deploy_info = json.loads(k8s_deployment.metadata.annotations[ANNO_DEPLOY_INFO])
+            config_id = deploy_info.get("config_id")
+            # check the config id in deployment and configmap are same
+            # if these two value is not same, it means data inconsistent,
+            # such as create a configmap in new version, but don't create deployment in correspond version
+            k8s_configmap = KubeApi.instance().get_config_map(appname, cluster_name=cluster, raw=True, ignore_404=True,
+                                                              cache_mode=CacheMode.READ_THROUGH)
+            if k8s_configmap is not None:
+                config_id_in_configmap_str = k8s_configmap.metadata.annotations[ANNO_CONFIG_ID]
+                if config_id_in_configmap_str is None:
+                    abort(403, f"there exists an configmap({appname}) which is not created by KAE, please contact administrator")
+                config_id_in_configmap = int(config_id_in_configmap_str)
+                if config_id != config_id_in_configmap:
+                    logger.error(f"config id in deployment and configmap is not same({config_id}: {config_id_in_configmap}")
+                    abort(500, "config id in deployment and configmap are not same, this is a serious problem, please contact administrator.")
+    return k8s_deployment, deploy_info
+
+
+def _make_deploy_specs(specs, args, k8s_deployment):
+    # update specs from release
+    replicas = args.get('replicas')
+    cpus = args.get('cpus')
+    memories = args.get('memories')
+
+    # sometimes user may forget fo update replicas value after a scale operation,
+    # so we never scale down the deployments
+    if not replicas:
+        replicas = specs.service.replicas
+        if k8s_deployment is not None and k8s_deployment.spec.replicas > replicas:
+            replicas = k8s_deployment.spec.replicas
+    try:
+        return _update_specs(specs, cpus, memories, replicas)
+    except IndexError:
+        abort(403, "cpus or memories' index is larger than the number of containers")
+
+
 @bp.route('/')
-@use_args(PaginationSchema(), location="query")
+@use_args(ListAppArgsSchema(), location="query")
 @user_require(True)
 def list_app(args):
     """
     List all the apps associated with the current logged in user, for
     administrators, list all apps
     ---
+    parameters:
+      - name: prefix
+        in: query
+        type: string
+        required: false
+        description: only list the apps whose name starts with prefix
     responses:
       200:
-        description: A list of app owned by current user
+        description: A list of app owned by current user, the total number is in the X-Total-Count header
+        headers:
+          X-Total-Count:
+            type: integer
         schema:
           type: array
           items:
@@ -252,7 +326,15 @@ def list_app(args):
     """
     limit = args['size']
     start = (args['page'] - 1) * limit
-    return g.user.list_app(start, limit)
+    q = g.user.query_app(args.get('prefix'))
+    total = q.order_by(None).count()
+
+    @after_this_request
+    def add_total_header(response):
+        response.headers['X-Total-Count'] = str(total)
+        return response
+
+    return q.offset(start).limit(limit).all()
 
 
 @bp.route('/', methods=['POST'])
@@ -431,8 +513,10 @@ def rollback_app(args, appname):
         if canary_info['status']:
             abort(403, "Please delete canary release before rollback app")
 
+        # the resourceVersion is used for optimistic concurrency, so it must be fresh
         with handle_k8s_error("failed to get kubernetes deployment of app {}".format(appname)):
-            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster)
+            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster,
+                                                               cache_mode=CacheMode.DIRECT)
 
         version = k8s_deployment.metadata.resource_version
         deploy_info = json.loads(k8s_deployment.metadata.annotations[ANNO_DEPLOY_INFO])
@@ -534,7 +618,8 @@ def delete_app(appname):
 
     with lock_app(appname):
         with handle_k8s_error("Error when delete app {}".format(appname)):
-            KubeApi.instance().undeploy_app(appname, app.type, ignore_404=True, cluster_name=KubeApi.ALL_CLUSTER)
+            results = KubeApi.instance().undeploy_app(appname, app.type, ignore_404=True, cluster_name=KubeApi.ALL_CLUSTER)
+            check_cluster_results(results)
 
     delete_roles_relate_to_app(app)
     app.delete()
@@ -550,7 +635,7 @@ def delete_app(appname):
 
     msg = 'Warning: App **{}** has been deleted by **{}**.'.format(appname, g.user.nickname)
     logger.warning(msg)
-    im_sendmsg(IM_WEBHOOK_CHANNEL, msg)
+    notify_im(IM_WEBHOOK_CHANNEL, msg)
     return DEFAULT_RETURN_VALUE
 
 
@@ -643,6 +728,41 @@ def get_app_pods(args, appname):
         return KubeApi.instance().get_app_pods(name=name, cluster_name=cluster)
 
 
+@bp.route('/<appname>/pod/<podname>')
+@use_args(ClusterArgSchema(), location="query")
+@user_require(True)
+def get_app_pod(args, appname, podname):
+    """
+    Get the full pod object, the pod events sent by websocket only contain the fields shown by UI
+    ---
+    parameters:
+      - name: appname
+        in: path
+        type: string
+        required: true
+      - name: podname
+        in: path
+        type: string
+        required: true
+      - name: cluster
+        in: query
+        type: string
+        required: true
+    responses:
+      200:
+        description: Pod object
+    """
+    cluster = args['cluster']
+    get_app_raw(appname, [RBACAction.GET], cluster)
+
+    with handle_k8s_error("Error when get app {}'s pod {}".format(appname, podname)):
+        pod = KubeApi.instance().get_pod(podname, cluster_name=cluster)
+    labels = pod.metadata.labels or {}
+    if labels.get('kae-app-name') not in (appname, make_canary_appname(appname)):
+        abort(404, "pod {} not found".format(podname))
+    return pod
+
+
 @bp.route('/<appname>/pod/<podname>/events')
 @use_args(GetPodEventsSchema(), location="query")
 @user_require(True)
@@ -900,8 +1020,9 @@ def get_release_spec(appname, tag):
 
 
 @bp.route('/<appname>/oplogs')
+@use_args(OPLogArgsSchema(), location="query")
 @user_require(True)
-def get_app_oplogs(appname):
+def get_app_oplogs(args, appname):
     """
     Get oplog list of the specified app
     ---
@@ -910,9 +1031,18 @@ def get_app_oplogs(appname):
         in: path
         type: string
         required: true
+      - name: cursor
+        in: query
+        type: integer
+        required: false
+        description: the value of X-Next-Cursor header of the previous page
+      - name: size
+        in: query
+        type: integer
+        required: false
     responses:
       200:
-        description: single Release object
+        description: single Release object, if there may be more logs, the cursor of next page is in the X-Next-Cursor header
         schema:
           $ref: '#/definitions/OPLog'
         examples:
@@ -927,7 +1057,22 @@ def get_app_oplogs(appname):
             created: 2018-05-24 10:00:25
     """
     app = get_app_raw(appname, [RBACAction.GET, ])
-    return OPLog.get_by(app_id=app.id)
+    # read the logs written by this process
+    try:
+        OPLog.flush()
+    except Exception:
+        logger.exception("can't flush operation logs")
+    limit = args['size']
+    oplogs = OPLog.get_by(app_id=app.id, cursor=args.get('cursor'), limit=limit)
+    if len(oplogs) == limit:
+        next_cursor = oplogs[-1].id
+
+        @after_this_request
+        def add_cursor_header(response):
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+            return response
+
+    return oplogs
 
 
 @bp.route('/<appname>/secret', methods=['POST'])
@@ -1150,11 +1295,12 @@ def create_app_yaml(args, appname):
 
     # check the format of specs
     try:
-        yaml_dict = yaml.safe_load(specs_text)
+        specs = load_specs(specs_text)
     except yaml.YAMLError as e:
         return abort(400, 'specs text is invalid yaml {}'.format(str(e)))
+    except ValidationError as e:
+        return abort(400, 'specs text is invalid {}'.format(str(e)))
     try:
-        specs = app_specs_schema.load(yaml_dict).data
         # at this place, we just use fix_app_spec to check if the default values in spec are correct
         # we don't change the spec text, because AppYaml is independent with any release.
         fix_app_spec(specs, appname, 'v0.0.1')
@@ -1184,11 +1330,12 @@ def update_app_yaml(args, appname, name):
     comment = args.get('comment', '')
     # check the format of specs
     try:
-        yaml_dict = yaml.safe_load(specs_text)
+        specs = load_specs(specs_text)
     except yaml.YAMLError as e:
         return abort(400, 'specs text is invalid yaml {}'.format(str(e)))
+    except ValidationError as e:
+        return abort(400, 'specs text is invalid {}'.format(str(e)))
     try:
-        specs = app_specs_schema.load(yaml_dict).data
         # at this place, we just use fix_app_spec to check if the default values in spec are correct
         # we don't change the spec text, because AppYaml is independent with any release.
         fix_app_spec(specs, appname, 'v0.0.1')
@@ -1220,6 +1367,33 @@ def delete_app_yaml(appname, name):
     return DEFAULT_RETURN_VALUE
 
 
+@bp.route('/event_metrics')
+@user_require(True)
+def get_event_delivery_metrics():
+    """
+    metrics of the delivery of app events to the webhook, need kae admin role
+    ---
+    responses:
+      200:
+        description: delivery metrics
+        examples:
+          application/json: {
+            "enqueued": 1024,
+            "delivered": 1000,
+            "failed": 30,
+            "retried": 28,
+            "dead": 2,
+            "last_batch_duration": 0.35,
+            "last_delivery_lag": 1.2,
+            "queued": 4,
+            "retrying": 2
+          }
+    """
+    if not check_rbac([RBACAction.KAE_ADMIN], None):
+        abort(403, 'Forbidden by RBAC rules, please check if you have permission.')
+    return get_event_metrics()
+
+
 @bp.route('/register', methods=['POST'])
 @use_args(RegisterSchema())
 @user_require(True)
@@ -1280,11 +1454,12 @@ def register_release(args):
         abort(400, "tag is invalid, kae suggests using semantic version")
     # check the format of specs
     try:
-        yaml_dict = yaml.safe_load(specs_text)
+        specs = load_specs(specs_text)
     except yaml.YAMLError as e:
         return abort(400, 'specs text is invalid yaml {}'.format(str(e)))
+    except ValidationError as e:
+        return abort(400, 'specs text is invalid {}'.format(str(e)))
     try:
-        specs = app_specs_schema.load(yaml_dict).data
         fix_app_spec(specs, appname, tag)
     except ValidationError as e:
         return abort(400, 'specs text is invalid: {}'.format(str(e)))
@@ -1393,8 +1568,11 @@ def scale_app(args, appname):
 
     with lock_app(appname):
         with handle_k8s_error("Error when get deployment"):
-            k8s_hpa = KubeApi.instance().get_hpa(appname, cluster_name=cluster, ignore_404=True)
-            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster)
+            # a miss of the local store doesn't prove the HPA doesn't exist
+            k8s_hpa = KubeApi.instance().get_hpa(appname, cluster_name=cluster, ignore_404=True,
+                                                 cache_mode=CacheMode.READ_THROUGH)
+            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster,
+                                                               cache_mode=CacheMode.READ_THROUGH)
         # if HPA exists, then forbidden scale operation
         if k8s_hpa is not None:
             abort(403, "hpa exists, so you can't scale")
@@ -1492,52 +1670,15 @@ def deploy_app(args, appname):
         abort(403, "please build release first")
 
     with lock_app(appname):
-        # check canary
-        canary_info = _get_canary_info(appname, cluster)
-        if canary_info['status']:
-            abort(403, "please delete canary release before you deploy a new release")
-
-        deploy_info, exist_deploy_id = {}, -1
-        with handle_k8s_error("Error when get deployment"):
-            k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, ignore_404=True)
-            if k8s_deployment is not None:
-                _check_deploy_info_error(k8s_deployment)
-
-                deploy_info = json.loads(k8s_deployment.metadata.annotations[ANNO_DEPLOY_INFO])
-                exist_deploy_id = deploy_info["deploy_id"]
-                config_id = deploy_info.get("config_id")
-                prev_tag = deploy_info.get("release_tag")
-                # check the config id in deployment and configmap are same
-                # if these two value is not same, it means data inconsistent,
-                # such as create a configmap in new version, but don't create deployment in correspond version
-                k8s_configmap = KubeApi.instance().get_config_map(appname, cluster_name=cluster, raw=True, ignore_404=True)
-                if k8s_configmap is not None:
-                    config_id_in_configmap_str = k8s_configmap.metadata.annotations[ANNO_CONFIG_ID]
-                    if config_id_in_configmap_str is None:
-                        abort(403, f"there exists an configmap({appname}) which is not created by KAE, please contact administrator")
-                    config_id_in_configmap = int(config_id_in_configmap_str)
-                    if config_id != config_id_in_configmap:
-                        logger.error(f"config id in deployment and configmap is not same({config_id}: {config_id_in_configmap}")
-                        abort(500, "config id in deployment and configmap are not same, this is a serious problem, please contact administrator.")
+        k8s_deployment, deploy_info = _get_deploy_state(appname, cluster)
+        exist_deploy_id = -1
+        if k8s_deployment is not None:
+            exist_deploy_id = deploy_info["deploy_id"]
+            prev_tag = deploy_info.get("release_tag")
 
         specs = app_yaml.specs
         fix_app_spec(specs, appname, tag)
-
-        # update specs from release
-        replicas = args.get('replicas')
-        cpus = args.get('cpus')
-        memories = args.get('memories')
-
-        # sometimes user may forget fo update replicas value after a scale operation,
-        # so we never scale down the deployments
-        if not replicas:
-            replicas = specs.service.replicas
-            if k8s_deployment is not None and k8s_deployment.spec.replicas > replicas:
-                replicas = k8s_deployment.spec.replicas
-        try:
-            specs = _update_specs(specs, cpus, memories, replicas)
-        except IndexError:
-            abort(403, "cpus or memories' index is larger than the number of containers")
+        specs = _make_deploy_specs(specs, args, k8s_deployment)
 
         # create deploy version
         config_id = deploy_info.get('config_id')
@@ -1558,7 +1699,7 @@ def deploy_app(args, appname):
         _validate_configmap_keys(appname, specs, deploy_ver.app_config)
 
         try:
-            KubeApi.instance().deploy_app(specs, deploy_ver, cluster_name=cluster)
+            steps = KubeApi.instance().deploy_app(specs, deploy_ver, cluster_name=cluster)
         except KubeError as e:
             abort(403, "Deploy Error: {}".format(str(e)))
         except ApiException as e:
@@ -1578,7 +1719,197 @@ def deploy_app(args, appname):
                 "tag": prev_tag,
             },
         )
-        return DEFAULT_RETURN_VALUE
+        return {'error': None, 'steps': steps}
+
+
+def _format_deploy_error(e):
+    if isinstance(e, HTTPException):
+        return e.description
+    if isinstance(e, KubeError):
+        return "Deploy Error: {}".format(str(e))
+    if isinstance(e, ApiException):
+        return "Error when deploy app: {}".format(str(e))
+    return 'kubernetes error: {}'.format(str(e))
+
+
+@bp.route('/<appname>/batch_deploy', methods=['PUT'])
+@use_args(BatchDeploySchema())
+@user_require(True)
+def batch_deploy_app(args, appname):
+    """
+    deploy a release to multiple clusters, the release and spec are validated only once,
+    then all clusters are checked and deployed concurrently.
+    nothing is deployed if any cluster fails the check.
+    ---
+    definitions:
+      BatchDeployArgs:
+        type: object
+        properties:
+          clusters:
+            type: array
+            items:
+              type: string
+            required: true
+          tag:
+            type: string
+            required: true
+          app_yaml_name:
+            type: string
+          use_newest_config:
+            type: boolean
+          cpus:
+            type: object
+          memories:
+            type: object
+          replicas:
+            type: integer
+
+    parameters:
+      - name: appname
+        in: path
+        type: string
+        required: true
+      - name: deploy_args
+        in: body
+        required: true
+        schema:
+          $ref: '#/definitions/BatchDeployArgs'
+    responses:
+      200:
+        description: multiple stream messages(one json per line), the last one is the aggregated result
+        schema:
+          $ref: '#/definitions/StreamMessage'
+      400:
+        description: Error information
+        schema:
+          $ref: '#/definitions/Error'
+        examples:
+          error: "xxx"
+    """
+    # keep the order and remove the duplicate clusters
+    clusters = list(OrderedDict.fromkeys(args['clusters']))
+    tag = args["tag"]
+    app_yaml_name = args['app_yaml_name']
+    use_newest_config = args['use_newest_config']
+
+    app = get_app_raw(appname, [RBACAction.DEPLOY])
+    forbidden = [cluster for cluster in clusters if not check_rbac([RBACAction.DEPLOY], app, cluster)]
+    if forbidden:
+        abort(403, 'Forbidden by RBAC rules, please check if you have permission on clusters {}.'.format(", ".join(forbidden)))
+
+    app_yaml = AppYaml.get_by_app_and_name(app, app_yaml_name)
+    if not app_yaml:
+        abort(404, "AppYaml {} doesn't exist.".format(app_yaml_name))
+
+    release = app.get_release_by_tag(tag)
+    if not release:
+        abort(404, 'release {} not found.'.format(tag))
+    if release.build_status is False:
+        abort(403, "please build release first")
+
+    base_specs = app_yaml.specs
+    fix_app_spec(base_specs, appname, tag)
+    username = g.user.username
+
+    def _check_cluster(cluster):
+        k8s_deployment, deploy_info = _get_deploy_state(appname, cluster)
+        specs = _make_deploy_specs(copy.deepcopy(base_specs), args, k8s_deployment)
+        _validate_secret_keys(appname, specs, cluster)
+        return specs, deploy_info
+
+    def _generate():
+        results = {cluster: {"ok": False, "error": None, "steps": None} for cluster in clusters}
+
+        def _finish():
+            success = all(r["ok"] for r in results.values())
+            return make_msg("Finished", raw_data=results, success=success,
+                            error=None if success else "failed on some clusters", jsonize=True)
+
+        with lock_app(appname):
+            # step 1: check all clusters, the checks only read kubernetes
+            states = {}
+            for r in KubeApi.instance().iter_on_clusters(clusters, _check_cluster):
+                if r.ok:
+                    states[r.cluster] = r.result
+                    yield make_msg("Check", raw_data={"cluster": r.cluster}, msg=f"cluster {r.cluster} is ready", jsonize=True)
+                else:
+                    results[r.cluster]["error"] = _format_deploy_error(r.error)
+                    yield make_msg("Check", raw_data={"cluster": r.cluster}, success=False,
+                                   error=results[r.cluster]["error"], jsonize=True)
+            if len(states) != len(clusters):
+                yield _finish()
+                return
+
+            # step 2: create the deploy versions of all clusters in one transaction
+            deploy_vers, prev_tags = {}, {}
+            try:
+                for cluster in clusters:
+                    specs, deploy_info = states[cluster]
+                    config_id = deploy_info.get('config_id')
+                    if use_newest_config:
+                        newest_cfg = AppConfig.get_newest_config(app, cluster)
+                        if newest_cfg:
+                            config_id = newest_cfg.id
+                    deploy_vers[cluster] = DeployVersion.create(
+                        app, tag, app_yaml.name, specs, parent_id=deploy_info.get("deploy_id", -1),
+                        cluster=cluster, config_id=config_id, commit=False)
+                    prev_tags[cluster] = deploy_info.get("release_tag")
+                    _validate_configmap_keys(appname, specs, deploy_vers[cluster].app_config)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                if not isinstance(e, HTTPException):
+                    logger.exception("can't create deploy version")
+                for cluster in clusters:
+                    results[cluster]["error"] = e.description if isinstance(e, HTTPException) else "internal server error"
+                yield _finish()
+                return
+
+            # the deploy workers can't use the db session of this request,
+            # so load everything they need from database here(the objects are expired by the commit)
+            for ver in deploy_vers.values():
+                ver.to_k8s_annotation()
+                app_cfg = ver.app_config
+                if app_cfg is not None:
+                    app_cfg.id, app_cfg.data_dict, app_cfg.appname
+
+            # step 3: deploy to all clusters
+            def _deploy(cluster):
+                specs, _ = states[cluster]
+                return KubeApi.instance().deploy_app(specs, deploy_vers[cluster], cluster_name=cluster)
+
+            for r in KubeApi.instance().iter_on_clusters(clusters, _deploy):
+                result = results[r.cluster]
+                if r.ok:
+                    result.update(ok=True, steps=r.result)
+                    yield make_msg("Deploy", raw_data={"cluster": r.cluster, "steps": r.result},
+                                   msg=f"deployed to cluster {r.cluster}", jsonize=True)
+                else:
+                    if not isinstance(r.error, (KubeError, ApiException)):
+                        logger.error(f"kubernetes error when deploy {appname} to {r.cluster}: {r.error}")
+                    result["error"] = _format_deploy_error(r.error)
+                    yield make_msg("Deploy", raw_data={"cluster": r.cluster}, success=False,
+                                   error=result["error"], jsonize=True)
+
+            # step 4: write the operation logs of all deployed clusters in one transaction
+            for cluster in clusters:
+                if results[cluster]["ok"]:
+                    handle_event(
+                        commit=False,
+                        username=username,
+                        app_id=app.id,
+                        cluster=cluster,
+                        appname=appname,
+                        tag=tag,
+                        action=OPType.DEPLOY_APP,
+                        prev={
+                            "tag": prev_tags[cluster],
+                        },
+                    )
+            db.session.commit()
+            yield _finish()
+
+    return Response(stream_with_context(_generate()), mimetype='application/x-ndjson')
 
 
 @bp.route('/<appname>/undeploy', methods=['DELETE'])
@@ -1609,7 +1940,9 @@ def undeploy_app(args, appname):
 
     with lock_app(appname):
         with handle_k8s_error("Error when undploy app {}".format(appname)):
-            KubeApi.instance().undeploy_app(appname, app.type, ignore_404=True, cluster_name=cluster)
+            results = KubeApi.instance().undeploy_app(appname, app.type, ignore_404=True, cluster_name=cluster)
+            if cluster == KubeApi.ALL_CLUSTER:
+                check_cluster_results(results)
             handle_event(
                 username=g.user.username,
                 app_id=app.id,
@@ -1620,7 +1953,7 @@ def undeploy_app(args, appname):
             )
 
     msg = 'Warning: App **{}**\'s deployment in cluster **{}** has been deleted by **{}**.'.format(appname, cluster, g.user.nickname)
-    im_sendmsg(IM_WEBHOOK_CHANNEL, msg)
+    notify_im(IM_WEBHOOK_CHANNEL, msg)
     return DEFAULT_RETURN_VALUE
 
 
@@ -1716,7 +2049,8 @@ def deploy_app_canary(args, appname):
         else:
             app_cfg = None
             with handle_k8s_error("Error when get deployment"):
-                k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, ignore_404=True)
+                k8s_deployment = KubeApi.instance().get_deployment(appname, cluster_name=cluster, ignore_404=True,
+                                                                   cache_mode=CacheMode.READ_THROUGH)
                 if k8s_deployment is not None:
                     _check_deploy_info_error(k8s_deployment)
 
@@ -1920,7 +2254,8 @@ def get_app_abtesting_rules(args, appname):
     app = get_app_raw(appname, [RBACAction.GET, ], cluster)
 
     with handle_k8s_error("Error when get abtesting rules"):
-        rules = KubeApi.instance().get_abtesting_rules(appname, cluster_name=cluster)
+        rules = KubeApi.instance().get_abtesting_rules(appname, cluster_name=cluster,
+                                                       cache_mode=CacheMode.READ_THROUGH)
 
     if rules is None:
         abort(404, "not found")
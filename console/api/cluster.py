@@ -1,7 +1,8 @@
-from flask import g
+from flask import g, abort
 
+from console.libs.k8s import KubeApi
 from console.libs.view import create_api_blueprint, user_require
-from console.models.rbac import get_clusters_by_user
+from console.models.rbac import get_clusters_by_user, check_rbac, RBACAction
 
 bp = create_api_blueprint('cluster', __name__, 'cluster')
 
@@ -26,3 +27,29 @@ def list_cluster():
             ]
     """
     return get_clusters_by_user(g.user)
+
+
+@bp.route('/pool_stats')
+@user_require(True)
+def get_pool_stats():
+    """
+    connection pool utilization of every k8s context loaded by current process, need kae admin role
+    ---
+    responses:
+      200:
+        description: k8s context name -> pool stats
+        examples:
+          application/json: {
+            "k8s1": {
+              "maxsize": 32,
+              "in_flight": 3,
+              "peak_in_flight": 20,
+              "total_requests": 1024,
+              "connections_created": 20,
+              "idle_connections": 17
+            }
+          }
+    """
+    if not check_rbac([RBACAction.KAE_ADMIN], None):
+        abort(403, 'Forbidden by RBAC rules, please check if you have permission.')
+    return KubeApi.instance().pool_stats()
@@ -2,6 +2,7 @@
 
 from flask import jsonify, abort, g
 
+from console.libs.sso import SSO
 from console.libs.view import user_require, create_api_blueprint
 from console.models import (
     User, Group, check_rbac, RBACAction,
@@ -53,6 +54,32 @@ def list_groups():
     return jsonify(Group.get_all())
 
 
+@bp.route('/sso_stats')
+@user_require(True)
+def get_sso_stats():
+    """
+    sync metrics of the keycloak users and groups in current process, need kae admin role
+    ---
+    responses:
+      200:
+        description: sync stats
+        examples:
+          application/json: {
+            "leader": true,
+            "last_refresh_mode": "incremental",
+            "last_refresh_duration": 0.12,
+            "full_refreshes": 3,
+            "incremental_refreshes": 30,
+            "snapshot_version": 33,
+            "staleness": 12.5,
+            "full_sync_staleness": 150.2
+          }
+    """
+    if not check_rbac([RBACAction.KAE_ADMIN], None):
+        abort(403, 'Forbidden by RBAC rules, please check if you have permission.')
+    return jsonify(SSO.instance().get_stats())
+
+
 @bp.route('/me')
 @user_require(False)
 def me():
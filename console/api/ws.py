@@ -12,14 +12,18 @@ from urllib3.exceptions import ProtocolError
 import redis_lock
 
 from console.libs.utils import (
-    logger, make_app_watcher_channel_name, make_msg, make_errmsg, send_email, im_sendmsg,
+    logger, make_app_watcher_channel_name, make_msg, make_errmsg,
     make_app_redis_key,
 )
 from console.libs.jsonutils import VersatileEncoder
+from console.libs.notify import notify_im, notify_email
 from console.libs.k8s import KubeApi, ApiException
 from console.libs.validation import (
-    build_args_schema, cluster_canary_schema, pod_entry_schema
+    build_args_schema, app_pods_events_args_schema, pod_entry_schema
 )
+from console.libs.pod_event import FORMAT_DELTA, FORMAT_FULL, compact_pod, PodDeltaEncoder
+from console.libs.pubsub import get_pubsub_multiplexer
+from console.libs.pod_snapshot import load_snapshot as load_pods_snapshot, is_newer
 from console.libs.view import create_api_blueprint
 from console.models import App, User, RBACAction, get_current_user, check_rbac
 from console.tasks import celery_task_stream_response, build_image
@@ -70,6 +74,10 @@ def ignore_socket_dead(f):
     return _inner
 
 
+def _pod_event_key(content):
+    return json.loads(content)['object']['metadata']['uid']
+
+
 @ws.route('/app/<appname>/pods/events')
 @ignore_socket_dead
 @ws_user_require(True)
@@ -82,7 +90,7 @@ def get_app_pods_events(socket, appname):
         if message is None:
             return
         try:
-            payload = cluster_canary_schema.loads(message)
+            payload = app_pods_events_args_schema.loads(message)
             break
         except ValidationError as e:
             socket.send(json.dumps(e.messages))
@@ -92,8 +100,10 @@ def get_app_pods_events(socket, appname):
     args = payload.data
     cluster = args['cluster']
     canary = args['canary']
+    fmt = args['format']
     name = "{}-canary".format(appname) if canary else appname
-    channel = make_app_watcher_channel_name(cluster, name)
+    channel = make_app_watcher_channel_name(cluster, name, full=(fmt == FORMAT_FULL))
+    delta_encoder = PodDeltaEncoder() if fmt == FORMAT_DELTA else None
 
     app = App.get_by_name(appname)
     if not app:
@@ -107,69 +117,81 @@ def get_app_pods_events(socket, appname):
     # since this request may pend long time, so we remove the db session
     # otherwise we may get error like `sqlalchemy.exc.TimeoutError: QueuePool limit of size 50 overflow 10 reached, connection timed out`
     with session_removed():
-        pod_list = KubeApi.instance().get_app_pods(name, cluster_name=cluster)
-        pods = pod_list.to_dict()
-        for item in pods['items']:
+        # subscribe before reading the snapshot, so no event is missed
+        # a slow client only gets the newest event of every pod
+        sub = get_pubsub_multiplexer().subscription([channel], coalesce_key=_pod_event_key)
+        try:
+            snapshot = None
+            if fmt != FORMAT_FULL:
+                snapshot = load_pods_snapshot(cluster, name)
+            if snapshot is not None:
+                snapshot_rv, items = snapshot
+            else:
+                pod_list = KubeApi.instance().get_app_pods(name, cluster_name=cluster)
+                snapshot_rv = pod_list.metadata.resource_version
+                items = pod_list.to_dict()['items']
+                if fmt != FORMAT_FULL:
+                    items = [compact_pod(item) for item in items]
+            if delta_encoder is not None:
+                for item in items:
+                    delta_encoder.encode("ADDED", item)
             data = {
-                'object': item,
-                'action': "ADDED",
+                'action': "SNAPSHOT",
+                'objects': items,
+                'resource_version': snapshot_rv,
             }
             socket.send(json.dumps(data, cls=VersatileEncoder))
+            # the events before the snapshot are skipped, after the first newer event, all events are newer
+            caught_up = False
 
-        pubsub = rds.pubsub()
-        pubsub.subscribe(channel)
-        need_exit = False
-
-        def check_client_socket():
-            nonlocal need_exit
-            while need_exit is False:
-                if socket.receive() is None:
-                    need_exit = True
-                    break
-
-        def heartbeat_sender():
-            nonlocal need_exit, socket_active_ts
-            interval = WS_HEARTBEAT_TIMEOUT - 3
-            if interval <= 0:
-                interval = WS_HEARTBEAT_TIMEOUT
+            need_exit = False
 
-            while need_exit is False:
-                now = time.time()
-                if now - socket_active_ts <= (interval-1):
-                    time.sleep(interval - (now - socket_active_ts))
-                else:
-                    try:
-                        send_ping(socket)
-                        socket_active_ts = time.time()
-                    except WebSocketError as e:
+            def check_client_socket():
+                nonlocal need_exit
+                while need_exit is False:
+                    if socket.receive() is None:
                         need_exit = True
-                        return
-
-        gevent.spawn(check_client_socket)
-        gevent.spawn(heartbeat_sender)
+                        break
 
-        try:
+            def heartbeat_sender():
+                nonlocal need_exit, socket_active_ts
+                interval = WS_HEARTBEAT_TIMEOUT - 3
+                if interval <= 0:
+                    interval = WS_HEARTBEAT_TIMEOUT
+
+                while need_exit is False:
+                    now = time.time()
+                    if now - socket_active_ts <= (interval-1):
+                        time.sleep(interval - (now - socket_active_ts))
+                    else:
+                        try:
+                            send_ping(socket)
+                            socket_active_ts = time.time()
+                        except WebSocketError as e:
+                            need_exit = True
+                            return
+
+            gevent.spawn(check_client_socket)
+            gevent.spawn(heartbeat_sender)
 
             while need_exit is False:
-                resp = pubsub.get_message(timeout=30)
+                resp = sub.get(timeout=30)
                 if resp is None:
                     continue
 
-                if resp['type'] == 'message':
-                    raw_content = resp['data']
-                    # omit the initial message where resp['data'] is 1L
-                    if not isinstance(raw_content, (bytes, str)):
-                        continue
-                    content = raw_content
-                    if isinstance(content, bytes):
-                        content = content.decode('utf-8')
-                    socket.send(content)
-                    socket_active_ts = time.time()
+                _, content = resp
+                if caught_up is False or delta_encoder is not None:
+                    data = json.loads(content)
+                    if caught_up is False:
+                        if not is_newer(data.get('resource_version'), snapshot_rv):
+                            continue
+                        caught_up = True
+                    if delta_encoder is not None:
+                        content = json.dumps(delta_encoder.encode(data['action'], data['object']))
+                socket.send(content)
+                socket_active_ts = time.time()
         finally:
-            # need close the connection created by PUB/SUB,
-            # otherwise it will cause too many redis connections
-            pubsub.unsubscribe()
-            pubsub.close()
+            sub.close()
             need_exit = True
     logger.info("ws connection closed")
 
@@ -214,9 +236,11 @@ def build_app(socket, appname):
     client_closed = False
 
     phase = ""
+    # the builds of the images run concurrently, so the phase header is written when the image changes too
+    phase_image = None
 
     def handle_msg(ss, collect_msg=True):
-        nonlocal phase
+        nonlocal phase, phase_image
         try:
             m = json.loads(ss)
         except:
@@ -225,10 +249,14 @@ def build_app(socket, appname):
             if collect_msg:
                 total_msg.append(m['error'])
             return False
-        if phase != m['phase']:
-            phase = m['phase']
+        image = m.get('image')
+        if phase != m['phase'] or phase_image != image:
+            phase, phase_image = m['phase'], image
             if collect_msg:
-                total_msg.append("***** PHASE {}\n".format(m['phase']))
+                if image:
+                    total_msg.append("***** PHASE {} [{}]\n".format(m['phase'], image))
+                else:
+                    total_msg.append("***** PHASE {}\n".format(m['phase']))
 
         raw_data = m.get('raw_data', None)
         if raw_data is None:
@@ -332,7 +360,7 @@ def build_app(socket, appname):
                 if phase.lower() != "finished":
                     # send im message when build failed
                     im_msg = "KAE: Failed to build **{}:{}**".format(appname, tag)
-                    im_sendmsg(IM_WEBHOOK_CHANNEL, im_msg)
+                    notify_im(IM_WEBHOOK_CHANNEL, im_msg)
 
                     subject = "KAE: Failed to build {}:{}".format(appname, tag)
                     text_title = '<h2 style="color: #ff6161;"> Build Failed </h2>'
@@ -352,7 +380,7 @@ def build_app(socket, appname):
                 # TODO better way to get users to send email
                 email_list = [u.email for u in app.subscriber_list if 'email' in u]
                 if len(email_list) > 0:
-                    send_email(email_list, subject, email_text)
+                    notify_email(email_list, subject, email_text)
         else:
             socket.send(make_msg("Unknown", msg="there seems exist another build task, try to fetch output\n", jsonize=True))
             build_task_id = rds.hget(app_redis_key, "build-task-id")
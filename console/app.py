@@ -24,7 +24,7 @@ from console.config import (
 from console.ext import sess, db, mako, cache, rds, sockets, oidc
 from console.libs.datastructure import DateConverter
 from console.libs.jsonutils import VersatileEncoder
-from console.libs.utils import im_sendmsg
+from console.libs.notify import notify_im
 
 
 if DEBUG:
@@ -236,7 +236,7 @@ def make_celery(app):
             rds.publish(channel_name, json.dumps(failure_msg, cls=VersatileEncoder))
             rds.publish(channel_name, TASK_PUBSUB_EOF.format(task_id=task_id))
             msg = 'Console task {}:\nargs\n```\n{}\n```\nkwargs:\n```\n{}\n```\nerror message:\n```\n{}\n```'.format(self.name, args, kwargs, str(exc))
-            im_sendmsg(IM_WEBHOOK_CHANNEL, msg)
+            notify_im(IM_WEBHOOK_CHANNEL, msg)
 
         def __call__(self, *args, **kwargs):
             with app.app_context():
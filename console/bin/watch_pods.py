@@ -1,75 +1,452 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
 import json
+import math
+import time
+import random
+import signal
+import socket
 import argparse
-from urllib3.exceptions import ProtocolError
+import multiprocessing
+from collections import defaultdict
+
+import redis_lock
+from redis.exceptions import WatchError
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 # must import celery before import tasks
 from console.app import celery
 from console.libs.utils import logger
 from console.libs.k8s import KubeApi
-from console.libs.utils import spawn, make_app_watcher_channel_name, get_cluster_names
+from console.libs.utils import spawn, make_app_watcher_channel_name, get_cluster_names, id_generator
 from console.libs.jsonutils import VersatileEncoder
+from console.libs.pod_event import compact_pod
+from console.libs.pod_snapshot import (
+    RESOURCE_VERSION_FIELD, make_snapshot_key, mark_synced, iter_snapshot_keys,
+)
 from console.ext import rds
+from console.config import POD_WATCHER_PROCESSES, POD_WATCHER_LEASE_TTL, POD_WATCHER_WATCH_TIMEOUT
 
+LABEL_SELECTOR = "kae-type == app"
+# sorted set of live worker id -> last heartbeat
+WORKERS_KEY = "kae-pods-watcher:workers"
+# hash of cluster -> last seen resource version, the pod snapshots of the cluster are up to date with it
+RESOURCE_VERSION_KEY = "kae-pods-watcher:snapshot-resource-version"
+# the apiserver ends a watch after its timeout, a connection silent for longer than
+# the timeout plus the slack is half-open, the watch is restarted then
+WATCH_CONNECT_TIMEOUT = 10
+WATCH_READ_TIMEOUT_SLACK = 10
+
+
+def make_lease_name(cluster):
+    return "kae-pods-watcher:lease:{}".format(cluster)
+
+
+def make_lease_key(cluster):
+    # the key of the lease in redis, see redis_lock.Lock
+    return "lock:" + make_lease_name(cluster)
 
-class LongRunningWatcher(object):
-    def __init__(self, sync=False):
-        self.sync = sync
-        self.thread_map = {}
+
+# save the resource version only if the watcher still owns the lease of the cluster(KEYS[1] is the key of
+# the lease), a stopped watcher mustn't overwrite the version saved by the new owner.
+_save_resource_version_script = rds.register_script("""
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('hset', KEYS[2], ARGV[2], ARGV[3])
+return 1
+""")
+
+
+class ClusterPodWatcher(object):
+    """
+    watch the app pods of one cluster and publish the events to the channels of the apps.
+    the last seen resource version is saved in redis, so a restarted watcher resumes from it,
+    when the version is too old(410 Gone), the pods are listed again and the missed changes are published.
+    """
+    def __init__(self, cluster, lease, watch_timeout=POD_WATCHER_WATCH_TIMEOUT):
+        self.cluster = cluster
+        self.lease = lease
+        self.watch_timeout = watch_timeout
+        self.stopped = False
+        self.resource_version = None
+        # uid -> (resource version, namespace, name, appname) of the pods we have seen
+        self.pods = {}
+        self._rv_saved_at = 0
+        # when the last event or bookmark was received, a hung watch receives nothing
+        self.last_event_at = 0
+        self._thread = None
+
+    def __repr__(self):
+        return "ClusterPodWatcher <{}>".format(self.cluster)
 
     def start(self):
-        for name in get_cluster_names():
-            logger.info("create watcher thread for cluster {}".format(name))
-            self.thread_map[name] = spawn(self.watch_app_pods, name)
+        self._thread = spawn(self.run)
 
-    def wait(self):
-        while True:
-            for name, t in self.thread_map.items():
-                t.join(30)
-                if not t.isAlive():
-                    logger.info("cluster {}'s watcher thread crashed, restart it".format(name))
-                    self.thread_map[name] = spawn(self.watch_app_pods, name)
-
-    def watch_app_pods(self, cluster):
-        last_seen_version = None
-        label_selector = "kae-type == app"
-        while True:
+    def stop(self):
+        # the watch request is not interrupted, the thread exits on next event or bookmark
+        self.stopped = True
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _lose_lease(self, what):
+        logger.warn("{} lost the lease, don't {}".format(self, what))
+        self.stopped = True
+
+    def load_resource_version(self):
+        rv = rds.hget(RESOURCE_VERSION_KEY, self.cluster)
+        return rv.decode('utf8') if rv else None
+
+    def save_resource_version(self, force=False):
+        now = time.time()
+        if self.stopped or self.resource_version is None or (not force and now - self._rv_saved_at < 1):
+            return
+        saved = _save_resource_version_script(
+            keys=[make_lease_key(self.cluster), RESOURCE_VERSION_KEY],
+            args=[self.lease.id, self.cluster, self.resource_version])
+        if not saved:
+            self._lose_lease("save the resource version")
+            return
+        mark_synced(self.cluster)
+        self._rv_saved_at = now
+
+    def load_pods(self):
+        """
+        load the pods we have seen from the snapshots, so a resumed watcher can still diff when it relists
+        """
+        pods = {}
+        for key in iter_snapshot_keys(self.cluster):
+            appname = key[len(make_snapshot_key(self.cluster, "")):]
+            for field, val in rds.hgetall(key).items():
+                if field.decode('utf-8') == RESOURCE_VERSION_FIELD:
+                    continue
+                meta = json.loads(val)['metadata']
+                pods[meta['uid']] = (meta.get('resource_version'), meta.get('namespace'), meta.get('name'), appname)
+        self.pods = pods
+
+    def _queue_events(self, pipe, key, channel, events, resource_version, reset_pods):
+        if reset_pods is not None:
+            pipe.delete(key)
+            if reset_pods:
+                pipe.hset(key, mapping={
+                    obj.metadata.uid: json.dumps(compact_pod(obj), cls=VersatileEncoder) for obj in reset_pods
+                })
+        for action, obj, rv in events:
+            pod = compact_pod(obj)
+            if reset_pods is None:
+                if action == 'DELETED':
+                    pipe.hdel(key, pod['metadata']['uid'])
+                else:
+                    pipe.hset(key, pod['metadata']['uid'], json.dumps(pod, cls=VersatileEncoder))
+            data = {
+                'object': pod,
+                'action': action,
+                'resource_version': rv,
+            }
+            pipe.publish(message=json.dumps(data, cls=VersatileEncoder), channel=channel)
+        pipe.hset(key, RESOURCE_VERSION_FIELD, resource_version)
+
+    def apply_events(self, appname, events, resource_version, reset_pods=None):
+        """
+        change the snapshot of the app and publish the events in one transaction.
+        the transaction fails if the lease of the cluster changes after it's checked,
+        so a watcher which lost the lease never publishes or changes the snapshot.
+        :param events: list of (action, pod object, resource version of the event)
+        :param resource_version: the snapshot is up to date with this version after the events
+        :param reset_pods: if not None, the snapshot is replaced by these pods
+        """
+        key = make_snapshot_key(self.cluster, appname)
+        channel = make_app_watcher_channel_name(self.cluster, appname)
+        full_channel = make_app_watcher_channel_name(self.cluster, appname, full=True)
+        lease_key = make_lease_key(self.cluster)
+
+        with rds.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(lease_key)
+                    owner = pipe.get(lease_key)
+                    if owner is None or owner.decode('utf8') != self.lease.id:
+                        self._lose_lease("apply the events of {}".format(appname))
+                        return
+                    pipe.multi()
+                    self._queue_events(pipe, key, channel, events, resource_version, reset_pods)
+                    pipe.pubsub_numsub(full_channel)
+                    numsub = pipe.execute()[-1]
+                    break
+                except WatchError:
+                    # the lease is extended by the worker or taken by others, check it again
+                    continue
+
+        # the full object is large, only publish it when somebody wants it
+        if events and numsub and numsub[0][1] > 0:
+            pipe = rds.pipeline(transaction=False)
+            for action, obj, rv in events:
+                data = {
+                    'object': obj if isinstance(obj, dict) else obj.to_dict(),
+                    'action': action,
+                    'resource_version': rv,
+                }
+                pipe.publish(message=json.dumps(data, cls=VersatileEncoder), channel=full_channel)
+            pipe.execute()
+
+    def handle_event(self, action, obj):
+        labels = obj.metadata.labels or {}
+        appname = labels.get('kae-app-name')
+        if action == 'DELETED':
+            self.pods.pop(obj.metadata.uid, None)
+        else:
+            self.pods[obj.metadata.uid] = (obj.metadata.resource_version, obj.metadata.namespace,
+                                           obj.metadata.name, appname)
+        if appname:
+            rv = obj.metadata.resource_version
+            self.apply_events(appname, [(action, obj, rv)], rv)
+
+    def relist(self, publish=True):
+        """
+        list all pods, rebuild the snapshots and publish the changes since the last event we have seen
+        """
+        pod_list = KubeApi.instance().list_pods(cluster_name=self.cluster, label_selector=LABEL_SELECTOR)
+        list_rv = pod_list.metadata.resource_version
+        pods = {}
+        app_pods = defaultdict(list)
+        app_events = defaultdict(list)
+        for obj in pod_list.items:
+            labels = obj.metadata.labels or {}
+            appname = labels.get('kae-app-name')
+            pods[obj.metadata.uid] = (obj.metadata.resource_version, obj.metadata.namespace,
+                                      obj.metadata.name, appname)
+            if not appname:
+                continue
+            app_pods[appname].append(obj)
+            if not publish:
+                continue
+            old = self.pods.get(obj.metadata.uid)
+            if old is None:
+                app_events[appname].append(('ADDED', obj, list_rv))
+            elif old[0] != obj.metadata.resource_version:
+                app_events[appname].append(('MODIFIED', obj, list_rv))
+        if publish:
+            for uid, (_, namespace, name, appname) in self.pods.items():
+                if uid in pods or not appname:
+                    continue
+                # the pod is gone, we only know its identity
+                app_events[appname].append(('DELETED', {
+                    'metadata': {
+                        'uid': uid,
+                        'namespace': namespace,
+                        'name': name,
+                        'labels': {'kae-app-name': appname},
+                    },
+                }, list_rv))
+
+        # the apps without pods now still need their snapshots cleared
+        prefix = make_snapshot_key(self.cluster, "")
+        appnames = set(app_pods) | set(app_events) | set(key[len(prefix):] for key in iter_snapshot_keys(self.cluster))
+        for appname in appnames:
+            if self.stopped:
+                return
+            self.apply_events(appname, app_events.get(appname, []), list_rv, reset_pods=app_pods.get(appname, []))
+
+        self.pods = pods
+        self.resource_version = list_rv
+        self.save_resource_version(force=True)
+        logger.info("{} listed {} pods".format(self, len(pods)))
+
+    def watch(self):
+        mark_synced(self.cluster)
+        stream = KubeApi.instance().watch_pods(
+            cluster_name=self.cluster, label_selector=LABEL_SELECTOR, resource_version=self.resource_version,
+            timeout_seconds=self.watch_timeout, allow_watch_bookmarks=True,
+            _request_timeout=(WATCH_CONNECT_TIMEOUT, self.watch_timeout + WATCH_READ_TIMEOUT_SLACK))
+        for event in stream:
+            self.last_event_at = time.time()
+            if event['type'] == 'ERROR':
+                raw = event.get('raw_object') or {}
+                raise ApiException(status=raw.get('code'), reason=raw.get('message'))
+
+            obj = event['object']
+            self.resource_version = obj.metadata.resource_version
+            if event['type'] == 'BOOKMARK':
+                self.save_resource_version(force=True)
+            else:
+                self.handle_event(event['type'], obj)
+                self.save_resource_version()
+            if self.stopped:
+                break
+
+    def run(self):
+        logger.info("starting {}".format(self))
+        need_publish = True
+        self.resource_version = self.load_resource_version()
+        if self.resource_version is None:
+            # nothing to resume, the clients get the current pods when they connect
+            need_publish = False
+        else:
+            self.load_pods()
+
+        while self.stopped is False:
             try:
-                if last_seen_version is not None:
-                    watcher = KubeApi.instance().watch_pods(cluster_name=cluster, label_selector=label_selector, resource_version=last_seen_version)
+                if self.resource_version is None:
+                    self.relist(publish=need_publish)
+                    need_publish = True
+                self.watch()
+            except ApiException as e:
+                if e.status == 410:
+                    logger.info("{} got 410 Gone, relist".format(self))
                 else:
-                    watcher = KubeApi.instance().watch_pods(cluster_name=cluster, label_selector=label_selector)
-
-                for event in watcher:
-                    obj = event['object']
-                    labels = obj.metadata.labels or {}
-                    last_seen_version = obj.metadata.resource_version
-
-                    if 'kae-app-name' in labels:
-                        appname = labels['kae-app-name']
-                        channel = make_app_watcher_channel_name(cluster, appname)
-                        data = {
-                            'object': obj.to_dict(),
-                            'action': event['type'],
-                        }
-                        rds.publish(message=json.dumps(data, cls=VersatileEncoder), channel=channel)
+                    logger.exception("{} watch error".format(self))
+                    time.sleep(1)
+                self.resource_version = None
             except ProtocolError:
-                logger.warn('skip this error... because kubernetes disconnect client after default 10m...')
-            except Exception as e:
-                # logger.error("---------watch error ------------------")
+                logger.debug("{} disconnected by apiserver".format(self))
+            except ReadTimeoutError:
+                logger.info("{} received nothing for {}s, watch again".format(
+                    self, self.watch_timeout + WATCH_READ_TIMEOUT_SLACK))
+            except Exception:
                 logger.exception("watch pods workers error")
-                # logger.error("watch pods error {}".format(str(e)))
+                time.sleep(1)
+        # don't save the resource version here, the new owner of the cluster may have saved a newer one
+        logger.info("{} stopped".format(self))
+
+
+class WatcherWorker(object):
+    """
+    a watcher process, the clusters are shared evenly among the live workers of all watcher instances,
+    every worker only watches the clusters whose lease it owns.
+    """
+    def __init__(self, lease_ttl=POD_WATCHER_LEASE_TTL):
+        self.id = "{}:{}:{}".format(socket.gethostname(), os.getpid(), id_generator(6))
+        self.lease_ttl = lease_ttl
+        self.interval = lease_ttl / 3
+        # cluster -> (lease, watcher)
+        self.watchers = {}
+
+    def heartbeat(self):
+        now = time.time()
+        pipe = rds.pipeline()
+        pipe.zadd(WORKERS_KEY, {self.id: now})
+        pipe.zremrangebyscore(WORKERS_KEY, 0, now - self.lease_ttl)
+        pipe.zcard(WORKERS_KEY)
+        return pipe.execute()[-1]
+
+    def renew(self):
+        for cluster, (lease, watcher) in list(self.watchers.items()):
+            try:
+                lease.extend(expire=self.lease_ttl)
+            except redis_lock.NotAcquired:
+                logger.warn("lost the lease of cluster {}".format(cluster))
+                watcher.stop()
+                self.watchers.pop(cluster)
+                continue
+            if not watcher.is_alive():
+                logger.info("cluster {}'s watcher thread crashed, restart it".format(cluster))
+                watcher = ClusterPodWatcher(cluster, lease)
+                watcher.start()
+                self.watchers[cluster] = (lease, watcher)
+            elif watcher.resource_version is not None and time.time() - watcher.last_event_at < self.interval:
+                # the watcher is up to date(not relisting) and its watch isn't hung,
+                # a quiet cluster still gets a bookmark about every minute.
+                mark_synced(cluster)
+
+    def release(self, cluster):
+        lease, watcher = self.watchers.pop(cluster)
+        watcher.stop()
+        try:
+            lease.release()
+        except redis_lock.NotAcquired:
+            pass
+        logger.info("released the lease of cluster {}".format(cluster))
+
+    def balance(self, n_workers):
+        clusters = get_cluster_names()
+        share = math.ceil(len(clusters) / max(n_workers, 1))
+        for cluster in list(self.watchers.keys()):
+            if cluster not in clusters:
+                self.release(cluster)
+        # give away one cluster at a time, so the new workers can take them
+        if len(self.watchers) > share:
+            self.release(random.choice(list(self.watchers.keys())))
+            return
+
+        random.shuffle(clusters)
+        for cluster in clusters:
+            if len(self.watchers) >= share:
+                break
+            if cluster in self.watchers:
+                continue
+            lease = redis_lock.Lock(rds, make_lease_name(cluster), expire=self.lease_ttl, id=self.id)
+            if lease.acquire(blocking=False):
+                logger.info("worker {} acquired the lease of cluster {}".format(self.id, cluster))
+                watcher = ClusterPodWatcher(cluster, lease)
+                watcher.start()
+                self.watchers[cluster] = (lease, watcher)
+
+    def run(self):
+        # release the leases on exit, so other workers can take the clusters immediately
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        logger.info("starting watcher worker {}".format(self.id))
+        try:
+            while True:
+                try:
+                    n_workers = self.heartbeat()
+                    self.renew()
+                    self.balance(n_workers)
+                except Exception:
+                    logger.exception("watcher worker {} error".format(self.id))
+                time.sleep(self.interval)
+        finally:
+            for cluster in list(self.watchers.keys()):
+                self.release(cluster)
+            rds.zrem(WORKERS_KEY, self.id)
+
+
+def run_worker():
+    WatcherWorker().run()
+
+
+class LongRunningWatcher(object):
+    def __init__(self, sync=False, processes=POD_WATCHER_PROCESSES):
+        self.sync = sync
+        if processes is None:
+            processes = min(os.cpu_count() or 1, max(len(get_cluster_names()), 1))
+        self.processes = processes
+        self.process_list = []
+
+    def _new_process(self):
+        p = multiprocessing.Process(target=run_worker, daemon=True)
+        p.start()
+        return p
+
+    def start(self):
+        for _ in range(self.processes):
+            self.process_list.append(self._new_process())
+        logger.info("started {} watcher processes".format(self.processes))
+
+    def wait(self):
+        while True:
+            for idx, p in enumerate(self.process_list):
+                p.join(30 / len(self.process_list))
+                if not p.is_alive():
+                    logger.info("watcher process {} exited({}), restart it".format(p.pid, p.exitcode))
+                    self.process_list[idx] = self._new_process()
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Watch pods')
     parser.add_argument('--sync', action='store_true')
+    parser.add_argument('--processes', type=int, default=POD_WATCHER_PROCESSES,
+                        help='number of watcher processes, default is one per cpu')
     args = parser.parse_args()
     return args
 
 
 if __name__ == '__main__':
     args = parse_args()
-    wch = LongRunningWatcher(args.sync)
+    # exit normally on SIGTERM, so the worker processes are terminated and release their leases
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    wch = LongRunningWatcher(args.sync, args.processes)
     wch.start()
     wch.wait()
@@ -32,6 +32,14 @@ CONSOLE_CONFIG_PATHS = [
 
 INGRESS_ANNOTATIONS_PREFIX = "nginx.ingress.kubernetes.io"
 APP_BUILD_TIMEOUT = 1800     # timeout for build image(30 minutes)
+# the builds of a release run concurrently against the docker daemon
+BUILD_CONCURRENCY = 2
+# the images of the previous built release of the app are pulled and used as the build cache(cache_from),
+# if BUILD_CACHE_TAG is set, the images are also pushed with this tag as a dedicated cache ref.
+BUILD_CACHE_ENABLED = True
+BUILD_CACHE_TAG = ""
+# settings of the apps, like {"appname": {"enabled": False, "tag": "buildcache"}}
+BUILD_CACHE_APPS = {}
 
 # in order to avoid nginx to close the idle websocket connection,
 # we need to send heartbeat message to refresh the read timeout
@@ -39,6 +47,14 @@ WS_HEARTBEAT_TIMEOUT = 60
 
 EMAIL_SENDER = ""
 EMAIL_SENDER_PASSWOORD = ""
+EMAIL_SMTP_SERVER = "smtp.exmail.qq.com"
+EMAIL_SMTP_PORT = 465
+# the notifications(email and IM) are sent by a background thread of every process,
+# the emails to the same receiver in EMAIL_DIGEST_WINDOW seconds are merged into one digest,
+# the SMTP connection is closed after idle EMAIL_SMTP_IDLE_TIMEOUT seconds.
+EMAIL_DIGEST_WINDOW = 30
+EMAIL_SMTP_IDLE_TIMEOUT = 60
+NOTIFY_QUEUE_MAXSIZE = 10000
 # SERVER_NAME = getenv('SERVER_NAME', default='127.0.0.1')
 SENTRY_DSN = getenv('SENTRY_DSN', default='')
 SECRET_KEY = getenv('SECRET_KEY', default='testsecretkey')
@@ -59,7 +75,12 @@ CLUSTER_CFG = {
     #     "base_domain": "xxx",
     #     "tls_secrets": {
     #         "domain name": "tls secret name"
-    #     }
+    #     },
+    #     # optional, override KUBE_CONNECTION_POOL_MAXSIZE, KUBE_REQUEST_TIMEOUT and KUBE_KEEP_ALIVE,
+    #     # clusters using the same k8s share one connection pool.
+    #     "connection_pool_maxsize": 64,
+    #     "request_timeout": 30,
+    #     "keep_alive": True,
     # },
     # "cluster2": {
     #     "k8s": "k8s name",
@@ -69,6 +90,33 @@ CLUSTER_CFG = {
 
 PROTECTED_CLUSTER = []
 
+# operations applied to KubeApi.ALL_CLUSTER run concurrently on a bounded worker pool,
+# every cluster gets at most KUBE_FANOUT_TIMEOUT seconds to finish its part.
+KUBE_FANOUT_MAX_WORKERS = 8
+KUBE_FANOUT_TIMEOUT = 60
+# the objects of a deployment which don't depend on each other are applied concurrently by this many workers.
+KUBE_DEPLOY_MAX_WORKERS = 16
+# keep local list+watch caches of Deployment, Ingress, HPA and ConfigMap for every cluster,
+# a cache which doesn't get any update in KUBE_INFORMER_MAX_STALENESS seconds is considered stale.
+KUBE_INFORMER_ENABLED = False
+KUBE_INFORMER_MAX_STALENESS = 60
+# all API groups of a k8s context share one connection pool,
+# KUBE_CONNECTION_POOL_MAXSIZE should be close to the concurrency of the gevent worker.
+# KUBE_REQUEST_TIMEOUT(seconds) is applied to every non-streaming request, None means no timeout.
+KUBE_CONNECTION_POOL_MAXSIZE = 32
+KUBE_REQUEST_TIMEOUT = None
+KUBE_KEEP_ALIVE = True
+# the pod watcher(console/bin/watch_pods.py) shares the clusters among POD_WATCHER_PROCESSES processes
+# of every watcher instance, a cluster is owned by one process through a redis lease of POD_WATCHER_LEASE_TTL seconds.
+# None means one process per cpu.
+POD_WATCHER_PROCESSES = None
+POD_WATCHER_LEASE_TTL = 30
+POD_WATCHER_WATCH_TIMEOUT = 120
+# the cache decorator(console/libs/cache.py) keeps at most CACHE_LOCAL_MAXSIZE values in every process
+# for at most CACHE_LOCAL_TTL seconds in front of redis, 0 disables the local tier.
+CACHE_LOCAL_MAXSIZE = 1024
+CACHE_LOCAL_TTL = 30
+
 SQLALCHEMY_DATABASE_URI = getenv('SQLALCHEMY_DATABASE_URI', default="mysql+pymysql://root@127.0.0.1:3306/kaetest?charset=utf8mb4")
 SQLALCHEMY_TRACK_MODIFICATIONS = getenv('SQLALCHEMY_TRACK_MODIFICATIONS', default=True, type=bool)
 SQLALCHEMY_POOL_SIZE = getenv('SQLALCHEMY_POOL_SIZE', default=30)
@@ -85,11 +133,42 @@ SSO_REALM = ""
 SSO_HOST = ""
 KEYCLOAK_ADMIN_USER = ""
 KEYCLOAK_ADMIN_PASSWD = ""
+# the users and groups of keycloak are synced by the process holding a redis lease, and shared by all processes
+# through a snapshot in redis, the other processes check the snapshot version every SSO_SYNC_INTERVAL seconds.
+# with SSO_INCREMENTAL_SYNC, only the users changed since the last sync are fetched,
+# it needs "Save Admin Events" enabled in the realm, a full sync still runs every SSO_FULL_SYNC_INTERVAL seconds.
+SSO_INCREMENTAL_SYNC = False
+SSO_SYNC_INTERVAL = 30
+SSO_FULL_SYNC_INTERVAL = 300
+# the results of bearer token validation are cached for at most OIDC_TOKEN_CACHE_MAX_TTL seconds(and never after
+# the token expires), invalid tokens for OIDC_TOKEN_NEGATIVE_CACHE_TTL seconds.
+# with OIDC_OFFLINE_VALIDATION, the signature of the token is verified with the realm's JWKS(cached for
+# OIDC_JWKS_CACHE_TTL seconds) instead of calling the introspection endpoint, revoked tokens stay valid until they expire.
+OIDC_TOKEN_CACHE_MAX_TTL = 300
+OIDC_TOKEN_NEGATIVE_CACHE_TTL = 10
+OIDC_OFFLINE_VALIDATION = False
+OIDC_JWKS_CACHE_TTL = 3600
 
 EMAIL_DOMAIN = getenv('EMAIL_DOMAIN')
 BOT_WEBHOOK_URL = getenv('BOT_WEBHOOK_URL')
 IM_WEBHOOK_CHANNEL = 'platform'
 EVENT_WEBHOOK_URL = ''
+# the events are queued in redis and delivered to EVENT_WEBHOOK_URL by celery in batches of EVENT_BATCH_SIZE,
+# with EVENT_WEBHOOK_BATCH the webhook gets a json list of events in one request, otherwise one request per event.
+# a failed event is retried with exponential backoff(from EVENT_RETRY_BASE_DELAY seconds) at most EVENT_MAX_ATTEMPTS times,
+# then it's moved to the dead letter list(the newest EVENT_DEAD_LETTER_MAXLEN events are kept).
+EVENT_WEBHOOK_TIMEOUT = 20
+EVENT_WEBHOOK_BATCH = False
+EVENT_BATCH_SIZE = 100
+EVENT_MAX_ATTEMPTS = 8
+EVENT_RETRY_BASE_DELAY = 5
+EVENT_DEAD_LETTER_MAXLEN = 10000
+# the operation logs are buffered in every process and inserted in one statement
+# when there are OPLOG_FLUSH_SIZE logs or every OPLOG_FLUSH_INTERVAL seconds.
+OPLOG_FLUSH_SIZE = 100
+OPLOG_FLUSH_INTERVAL = 1
+# the oldest buffered logs are dropped when the database is unavailable for long
+OPLOG_BUFFER_MAXSIZE = 10000
 
 DEFAULT_REGISTRY = "registry.cn-hangzhou.aliyuncs.com/kae"
 REGISTRY_AUTHS = {
@@ -129,6 +208,9 @@ if len(set(PROTECTED_CLUSTER) - set(CLUSTER_CFG.keys())) != 0:
 # the config below must not use getenv
 ##################################################
 TASK_PUBSUB_CHANNEL = 'citadel:task:{task_id}:pubsub'
+# every websocket subscriber of a web worker buffers at most PUBSUB_QUEUE_MAXSIZE messages,
+# the older messages are merged or dropped when the client can't keep up.
+PUBSUB_QUEUE_MAXSIZE = 1000
 # send this to mark EOF of stream message
 # TODO: ugly
 TASK_PUBSUB_EOF = 'CELERY_TASK_DONE:{task_id}'
@@ -166,6 +248,8 @@ CACHE_REDIS_URL = REDIS_URL
 
 HOST_VOLUMES_DIR = os.path.join(HOST_DATA_DIR, "volumes")
 REPO_DATA_DIR = "/tmp/repo-data"
+# the git mirrors under REPO_DATA_DIR are evicted when they use more disk than this
+GIT_MIRROR_MAX_BYTES = 20 * 1024 * 1024 * 1024
 
 # create dir if not exists
 pathlib.Path(REPO_DATA_DIR).mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,388 @@
+# coding: utf-8
+"""
+build the images of a release.
+
+the `builds` of the specs are built concurrently against the docker daemon, at most BUILD_CONCURRENCY at a time.
+a build depends on another one if its Dockerfile uses the image of the other one(`FROM` or `COPY --from`),
+then it starts after the image of the other one is built.
+an image is pushed in the background once it's built, so the push overlaps the next builds,
+the release is finished after all the pushes succeed.
+
+the images of the previous built release(and the dedicated cache tag) are the build cache,
+the docker daemon of a build host may be new, so they are pulled before the build.
+the messages of the builds are interleaved line by line, every message has the name of its build in `image`.
+"""
+import os
+import re
+import json
+import queue
+import shutil
+
+import docker
+
+from console.config import (
+    DOCKER_HOST, BUILD_CONCURRENCY, BUILD_CACHE_ENABLED, BUILD_CACHE_TAG, BUILD_CACHE_APPS,
+)
+from console.libs import git_mirror
+from console.libs.utils import logger, spawn, make_msg, BuildError, construct_full_image_name
+
+_image_ref_regex = re.compile(r'^\s*(?:FROM\s+(?:--platform=\S+\s+)?(\S+)|COPY\s+.*--from=(\S+))', re.I)
+_arg_regex = re.compile(r'^\s*ARG\s+(\w+)(?:=(\S*))?', re.I)
+_var_regex = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+# FROM never hits the cache, so it isn't counted
+_step_regex = re.compile(r'^Step \d+/\d+ : (?!FROM\s)', re.I)
+_cache_hit_regex = re.compile(r'^ ---> Using cache$')
+
+
+def strip_image_tag(image):
+    image = image.split('@', 1)[0]
+    name, sep, tag = image.rpartition(':')
+    # the colon may be the port of the registry
+    if sep and '/' not in tag:
+        return name
+    return image
+
+
+def parse_image_refs(dockerfile_text, build_args=None):
+    """
+    the images used by `FROM` and `COPY --from` of the Dockerfile, the build args are substituted
+    """
+    variables = {}
+    refs = []
+    for line in dockerfile_text.splitlines():
+        m = _arg_regex.match(line)
+        if m is not None:
+            variables.setdefault(m.group(1), m.group(2) or "")
+            continue
+        m = _image_ref_regex.match(line)
+        if m is None:
+            continue
+        args = dict(variables)
+        args.update(build_args or {})
+        ref = _var_regex.sub(lambda v: str(args.get(v.group(1) or v.group(2), "")), m.group(1) or m.group(2))
+        refs.append(ref)
+    return refs
+
+
+def count_cache_hits(output):
+    """
+    :return: (number of steps, number of steps using cache) in the output of the docker build
+    """
+    steps, cache_hits = 0, 0
+    for line in output.split('\n'):
+        if _step_regex.match(line):
+            steps += 1
+        elif _cache_hit_regex.match(line):
+            cache_hits += 1
+    return steps, cache_hits
+
+
+class ImageBuild(object):
+    def __init__(self, appname, release, build, repo_dir):
+        self.appname = appname
+        self.spec = build
+        self.name = build.name or appname
+        self.repo_dir = repo_dir
+        self.image_name_no_tag = construct_full_image_name(build.name, appname)
+        self.image_tag = build.tag if build.tag else release.tag
+        self.full_image_name = "{}:{}".format(self.image_name_no_tag, self.image_tag)
+        self.dockerfile = build.dockerfile
+        if self.dockerfile is None:
+            self.dockerfile = os.path.join(repo_dir, "Dockerfile")
+        # indexes of the builds this one depends on
+        self.deps = set()
+        # images used as the build cache, and the tag to push the image as cache
+        self.cache_from = []
+        self.cache_tag = None
+
+    def image_refs(self):
+        path = os.path.join(self.repo_dir, self.dockerfile)
+        try:
+            with open(path) as fp:
+                text = fp.read()
+        except (OSError, UnicodeDecodeError):
+            return []
+        return parse_image_refs(text, self.spec.args)
+
+    def uses(self, other):
+        for ref in self.image_refs():
+            name = strip_image_tag(ref)
+            if construct_full_image_name(name, self.appname) != other.image_name_no_tag:
+                continue
+            # a reference without tag uses the image built in this release
+            tag = ref[len(name) + 1:].split('@', 1)[0]
+            if not tag or tag == other.image_tag:
+                return True
+        return False
+
+    def make_msg(self, phase, **kwargs):
+        return make_msg(phase, image=self.name, **kwargs)
+
+    def build(self, emit):
+        client = docker.APIClient(base_url=DOCKER_HOST)
+        for msg in self._build(client):
+            emit(msg)
+
+    def push(self, emit):
+        client = docker.APIClient(base_url=DOCKER_HOST)
+        for msg in self._push(client):
+            emit(msg)
+
+    def _pull_cache(self, client):
+        pulled = []
+        for image in self.cache_from:
+            repo, _, tag = image.rpartition(':')
+            try:
+                client.pull(repo, tag=tag)
+            except docker.errors.APIError as e:
+                yield self.make_msg("Building", msg="cache image {} is unavailable: {}\n".format(image, e))
+                continue
+            yield self.make_msg("Building", msg="use cache image {}\n".format(image))
+            pulled.append(image)
+        self.cache_from = pulled
+
+    def _build(self, client):
+        yield from self._pull_cache(client)
+        steps, cache_hits = 0, 0
+        try:
+            build_args_dict = {
+                "path": self.repo_dir,
+                "dockerfile": self.dockerfile,
+                "tag": self.full_image_name,
+            }
+            if self.cache_from:
+                build_args_dict['cache_from'] = self.cache_from
+            if self.spec.target:
+                build_args_dict['target'] = self.spec.target
+            if self.spec.args:
+                build_args_dict['buildargs'] = self.spec.args
+
+            buf = ""
+            for line in client.build(**build_args_dict):
+                output_dict = json.loads(line.decode('utf8'))
+                if 'error' in output_dict:
+                    raise BuildError(self.make_msg("Building", raw_data=output_dict, success=False,
+                                                   error="Building error: {}".format(output_dict['error'])))
+                if 'stream' in output_dict:
+                    # output_dict['stream'] may be just part of a line,
+                    # only whole lines are sent, so they aren't mixed with the lines of other builds.
+                    buf += output_dict['stream']
+                    if '\n' in buf:
+                        lines, buf = buf.rsplit('\n', 1)
+                        n_steps, n_hits = count_cache_hits(lines)
+                        steps += n_steps
+                        cache_hits += n_hits
+                        yield self.make_msg("Building", raw_data=output_dict, msg=lines + '\n')
+            if buf:
+                yield self.make_msg("Building", msg=buf)
+        except docker.errors.APIError as e:
+            raise BuildError(self.make_msg("Building", success=False, error="Building error: {}".format(str(e))))
+
+        if steps:
+            ratio = {"cache_hits": cache_hits, "steps": steps}
+            yield self.make_msg("Building", raw_data=ratio, msg="build cache hit ratio: {}/{} ({:.0%})\n".format(
+                cache_hits, steps, cache_hits / steps))
+
+    def _push_extra_tag(self, client, tag):
+        """
+        push the image with another tag, it's optional, so the errors don't fail the build
+        """
+        image_name = "{}:{}".format(self.image_name_no_tag, tag)
+        tagged = client.tag(self.full_image_name, self.image_name_no_tag, tag, True)
+        if not tagged:
+            logger.warning(f"Can't create {tag} tag for image {self.full_image_name}")
+            return
+        try:
+            for line in client.push(image_name, stream=True):
+                output_dict = json.loads(line.decode('utf8'))
+                if 'error' in output_dict:
+                    logger.warning(f"Can't push {image_name}: {output_dict['error']}")
+                    yield self.make_msg("Pushing", msg=f"Can't push {image_name}: {output_dict['error']}\n")
+                    break
+        except docker.errors.APIError:
+            logger.exception(f"Can't push {image_name} to registry.")
+
+    def _push(self, client):
+        try:
+            for line in client.push(self.full_image_name, stream=True):
+                output_dict = json.loads(line.decode('utf8'))
+                if 'error' in output_dict:
+                    raise BuildError(self.make_msg("Pushing", raw_data=output_dict, success=False,
+                                                   error="pushing error: {}".format(output_dict['error'])))
+
+                if len(output_dict) == 1 and 'status' in output_dict:
+                    msg = output_dict['status']+"\n"
+                elif 'id' in output_dict and 'status' in output_dict:
+                    # TODO: make the output like docker push
+                    # format output like:
+                    #   'b'{"status":"Preparing","progressDetail":{},"id":"89928fe4fc01"}\r\n''
+                    msg = f"{output_dict['id']}:{output_dict['status']}\n"
+                elif 'digest' in output_dict:
+                    # format output like:
+                    #    'b'{"status":"v0.1.5: digest: sha256:30fbf6b9db64c79751b7bf1f98b2ddfc630dead7f0016f764f752cecabcc72fa size: 1996"}\r\n''
+                    msg = "{}: digest: {} size: {}\n".format(output_dict.get('status'), output_dict['digest'], output_dict.get('size'))
+                else:
+                    msg = f"{line.decode('utf8')}\n"
+
+                yield self.make_msg("Pushing", raw_data=output_dict, msg=msg)
+        except docker.errors.APIError as e:
+            raise BuildError(self.make_msg("Pushing", success=False, error="pushing error: {}".format(str(e))))
+        logger.debug(f"========={self.full_image_name}")
+
+        # create latest tag for image and push this tag to registry
+        yield from self._push_extra_tag(client, "latest")
+        # export the build cache
+        if self.cache_tag:
+            yield from self._push_extra_tag(client, self.cache_tag)
+
+
+def get_build_cache_config(appname):
+    """
+    :return: (enabled, cache tag)
+    """
+    cfg = BUILD_CACHE_APPS.get(appname, {})
+    return cfg.get("enabled", BUILD_CACHE_ENABLED), cfg.get("tag", BUILD_CACHE_TAG) or None
+
+
+def setup_build_cache(appname, release, jobs):
+    enabled, cache_tag = get_build_cache_config(appname)
+    if not enabled:
+        return
+    previous_images = {}
+    prev = release.previous_built_release
+    if prev is not None:
+        try:
+            for build in prev.specs.builds:
+                image_name_no_tag = construct_full_image_name(build.name, appname)
+                previous_images[image_name_no_tag] = "{}:{}".format(image_name_no_tag, build.tag or prev.tag)
+        except Exception:
+            logger.exception("can't get the images of release {}".format(prev))
+
+    for job in jobs:
+        job.cache_tag = cache_tag
+        if cache_tag:
+            job.cache_from.append("{}:{}".format(job.image_name_no_tag, cache_tag))
+        prev_image = previous_images.get(job.image_name_no_tag)
+        if prev_image is not None and prev_image != job.full_image_name:
+            job.cache_from.append(prev_image)
+
+
+def resolve_dependencies(jobs):
+    for idx, job in enumerate(jobs):
+        job.deps = {other_idx for other_idx, other in enumerate(jobs) if other_idx != idx and job.uses(other)}
+
+    # check the circular dependencies
+    done = set()
+    while len(done) < len(jobs):
+        ready = {idx for idx, job in enumerate(jobs) if idx not in done and job.deps <= done}
+        if not ready:
+            names = [job.name for idx, job in enumerate(jobs) if idx not in done]
+            raise BuildError(make_msg("Building", success=False,
+                                      error="circular dependencies between builds: {}".format(names)))
+        done |= ready
+
+
+def run_builds(jobs, concurrency=BUILD_CONCURRENCY):
+    """
+    run the builds concurrently and yield their messages, every image is pushed right after it's built.
+    at most `concurrency` images are building at a time, the pushes don't count.
+    raise the first BuildError after the running builds and pushes exit.
+    the running builds and pushes are waited for even if the generator is closed early.
+    """
+    resolve_dependencies(jobs)
+    events = queue.Queue()
+
+    def run_step(step, idx):
+        job = jobs[idx]
+        try:
+            getattr(job, step)(events.put)
+            events.put((step, idx, None))
+        except BuildError as e:
+            events.put((step, idx, e))
+        except Exception as e:
+            logger.exception("error when {} {}".format(step, job.full_image_name))
+            phase = "Building" if step == "build" else "Pushing"
+            events.put((step, idx, BuildError(job.make_msg(phase, success=False, error=str(e)))))
+
+    pending = set(range(len(jobs)))
+    building, pushing, built = set(), set(), set()
+    error = None
+    try:
+        while True:
+            # a failed build or push stops starting the others
+            if error is None:
+                for idx in sorted(pending):
+                    if len(building) >= concurrency:
+                        break
+                    if jobs[idx].deps <= built:
+                        pending.remove(idx)
+                        building.add(idx)
+                        spawn(run_step, "build", idx)
+            if not building and not pushing:
+                break
+
+            item = events.get()
+            if isinstance(item, dict):
+                yield item
+                continue
+            step, idx, err = item
+            if step == "build":
+                building.remove(idx)
+                if err is None:
+                    # the dependent builds use the local image, they don't wait for the push
+                    built.add(idx)
+                    if error is None:
+                        pushing.add(idx)
+                        spawn(run_step, "push", idx)
+            else:
+                pushing.remove(idx)
+            if err is not None and error is None:
+                error = err
+    finally:
+        # the workers use the build context, wait for them before the caller removes it,
+        # e.g. the caller stops early or the generator is closed.
+        while building or pushing:
+            item = events.get()
+            if isinstance(item, dict):
+                continue
+            step, idx, _ = item
+            if step == "build":
+                building.discard(idx)
+            else:
+                pushing.discard(idx)
+    if error is not None:
+        raise error
+
+
+def build_image_helper(appname, release):
+    git_tag = release.tag
+    specs = release.specs
+
+    if not specs.builds:
+        yield make_msg("Finished", msg="ignore empty builds")
+        return
+    if release.build_status:
+        yield make_msg("Finished", msg="already built")
+        return
+
+    # clone code from the mirror of the repository
+    repo_dir = git_mirror.make_worktree_dir(appname)
+    try:
+        for line in git_mirror.checkout(release.git, git_tag, repo_dir):
+            yield make_msg("Cloning", msg=line)
+    except git_mirror.GitError as e:
+        shutil.rmtree(repo_dir, ignore_errors=True)
+        raise BuildError(make_msg(e.phase, success=False, error=str(e)))
+
+    try:
+        git_mirror.evict_mirrors()
+    except Exception:
+        logger.exception("can't evict git mirrors")
+
+    try:
+        jobs = [ImageBuild(appname, release, build, repo_dir) for build in specs.builds]
+        setup_build_cache(appname, release, jobs)
+        yield from run_builds(jobs)
+    finally:
+        shutil.rmtree(repo_dir, ignore_errors=True)
+    yield make_msg("Finished", msg="build app {}'s release {} successfully".format(appname, git_tag))
@@ -1,40 +1,203 @@
 # coding: utf-8
 
+import os
+import time
 import pickle
 import functools
 import inspect
+import threading
 from collections import OrderedDict
 
+import redis_lock
+
 from console.ext import rds
+from console.config import CACHE_LOCAL_MAXSIZE, CACHE_LOCAL_TTL
+from console.libs.utils import logger
 
 
 ONE_DAY = 86400
 ONE_HOUR = 3600
 
+# clean_cache publishes the key to this channel, so every process evicts its local copy
+CACHE_INVALIDATE_CHANNEL = 'console:cache:invalidate'
+# the lock of a missing key expires in case the process computing the value dies
+FILL_LOCK_EXPIRE = 30
+FILL_LOCK_TIMEOUT = 10
+
+
+class LocalCache(object):
+    """
+    bounded in-process LRU cache, every value expires after ttl seconds.
+    the values are shared by the callers, so they must not be modified.
+    """
+    def __init__(self, maxsize=CACHE_LOCAL_MAXSIZE, ttl=CACHE_LOCAL_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expire_at, value = item
+            if expire_at <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """
+    concurrent calls with the same key in one process share the result of the first one.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+        return call['result']
+
+
+local_cache = LocalCache()
+_single_flight = SingleFlight()
+
+_invalidation_thread = None
+_invalidation_pid = None
+
+
+def _handle_invalidation(msg):
+    key = msg['data']
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    local_cache.delete(key)
+
+
+def _ensure_invalidation_listener():
+    """
+    subscribe the invalidation channel once per process, the thread can't be shared by forked processes.
+    """
+    global _invalidation_thread, _invalidation_pid
+    if local_cache.maxsize <= 0:
+        return
+    if _invalidation_thread is not None and _invalidation_pid == os.getpid() and _invalidation_thread.is_alive():
+        return
+    try:
+        pubsub = rds.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{CACHE_INVALIDATE_CHANNEL: _handle_invalidation})
+        _invalidation_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        _invalidation_pid = os.getpid()
+    except Exception:
+        logger.exception("can't subscribe cache invalidation channel")
+        return
+    # the values cached before subscribing may have been invalidated
+    local_cache.clear()
+
+
+def _make_key_func(f, fmt):
+    # inspect the signature once, not on every call
+    arg_names = inspect.getfullargspec(f).args
+
+    def make_key(args, kwargs):
+        kw = dict(zip(arg_names, args))
+        kw.update(kwargs)
+        if not fmt:
+            _fmt = 'console:{}:{}'.format(f.__name__, '{}' * len(kw))
+            return _fmt.format(*kw.values())
+        return fmt.format(**kw)
+    return make_key
+
 
 def cache(fmt=None, ttl=None):
+    """
+    cache the result of f in a local LRU and in redis, None is never cached.
+    on a miss, only one caller computes the value: the callers in the same process wait for it,
+    the other processes wait for the redis lock and then read redis.
+    """
     def _cache(f):
-        @functools.wraps(f)
-        def _(*args, **kwargs):
-            ags = inspect.getargspec(f)
-            kw = dict(zip(ags.args, args))
-            kw.update(kwargs)
-
-            if not fmt:
-                _fmt = 'console:{}:{}'.format(f.__name__, '{}' * len(kw))
-                ordered = OrderedDict(kw)
-                key = _fmt.format(*ordered.values())
-            else:
-                key = fmt.format(**kw)
+        make_key = _make_key_func(f, fmt)
 
+        def _fill(key, args, kwargs):
             value = rds.get(key)
             if value is not None:
                 return pickle.loads(value)
 
-            r = f(*args, **kwargs)
+            lck = redis_lock.Lock(rds, 'console:cache-fill:{}'.format(key), expire=FILL_LOCK_EXPIRE)
+            locked = lck.acquire(timeout=FILL_LOCK_TIMEOUT)
+            try:
+                if locked:
+                    # another process may have filled it while we were waiting
+                    value = rds.get(key)
+                    if value is not None:
+                        return pickle.loads(value)
+                r = f(*args, **kwargs)
+                if r is not None:
+                    rds.set(key, pickle.dumps(r), ex=ttl)
+                return r
+            finally:
+                if locked:
+                    try:
+                        lck.release()
+                    except redis_lock.NotAcquired:
+                        pass
+
+        @functools.wraps(f)
+        def _(*args, **kwargs):
+            _ensure_invalidation_listener()
+            key = make_key(args, kwargs)
+
+            r = local_cache.get(key)
             if r is not None:
-                rds.set(key, pickle.dumps(r), ex=ttl)
+                return r
 
+            r = _single_flight.do(key, lambda: _fill(key, args, kwargs))
+            if r is not None:
+                local_cache.set(key, r, ttl)
             return r
         return _
     return _cache
@@ -42,3 +205,5 @@ def cache(fmt=None, ttl=None):
 
 def clean_cache(key):
     rds.delete(key)
+    local_cache.delete(key)
+    rds.publish(CACHE_INVALIDATE_CHANNEL, key)
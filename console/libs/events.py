@@ -0,0 +1,191 @@
+# coding: utf-8
+"""
+durable outbound queue of the app events sent to EVENT_WEBHOOK_URL.
+
+the API only pushes the event to a redis list, the celery task `deliver_events` sends them in batches.
+only one worker delivers at a time(the events keep their order), the events being sent are kept in
+a processing list, so they are sent again if the worker dies.
+"""
+import json
+import time
+
+import redis_lock
+import requests
+
+from console.ext import rds
+from console.libs.jsonutils import VersatileEncoder
+from console.libs.utils import logger
+from console.libs.notify import notify_im
+from console.config import (
+    EVENT_WEBHOOK_URL, EVENT_WEBHOOK_TIMEOUT, EVENT_WEBHOOK_BATCH, EVENT_BATCH_SIZE,
+    EVENT_MAX_ATTEMPTS, EVENT_RETRY_BASE_DELAY, EVENT_DEAD_LETTER_MAXLEN, IM_WEBHOOK_CHANNEL,
+)
+
+EVENT_QUEUE_KEY = "console:events:queue"
+EVENT_PROCESSING_KEY = "console:events:processing"
+# zset of the events waiting for retry, the score is the time of next attempt
+EVENT_RETRY_KEY = "console:events:retry"
+EVENT_DEAD_LETTER_KEY = "console:events:dead"
+EVENT_METRICS_KEY = "console:events:metrics"
+DELIVERY_LOCK_NAME = "console:events:delivery"
+
+
+def get_webhook_url():
+    return EVENT_WEBHOOK_URL.strip()
+
+
+def enqueue_event(data):
+    """
+    :return: False if the webhook isn't configured
+    """
+    if get_webhook_url() == "":
+        return False
+    item = {
+        "event": data,
+        "attempts": 0,
+        "enqueued_at": time.time(),
+    }
+    # the events are popped from the right
+    rds.lpush(EVENT_QUEUE_KEY, json.dumps(item, cls=VersatileEncoder))
+    rds.hincrby(EVENT_METRICS_KEY, "enqueued")
+    return True
+
+
+def get_event_metrics():
+    metrics = {k.decode('utf-8'): float(v) for k, v in rds.hgetall(EVENT_METRICS_KEY).items()}
+    metrics["queued"] = rds.llen(EVENT_QUEUE_KEY)
+    metrics["retrying"] = rds.zcard(EVENT_RETRY_KEY)
+    metrics["dead"] = rds.llen(EVENT_DEAD_LETTER_KEY)
+    return metrics
+
+
+class EventDeliverer(object):
+    def __init__(self, url=None):
+        self.url = url or get_webhook_url()
+        # keep-alive connections for the whole batch
+        self.session = requests.Session()
+
+    def _post(self, payload):
+        resp = self.session.post(self.url, json=payload, timeout=EVENT_WEBHOOK_TIMEOUT)
+        resp.raise_for_status()
+
+    def send(self, items):
+        """
+        :return: list of the items failed to send
+        """
+        if EVENT_WEBHOOK_BATCH:
+            try:
+                self._post([item["event"] for item in items])
+            except requests.RequestException as e:
+                logger.warn("can't send {} events to webhook: {}".format(len(items), e))
+                return items
+            return []
+
+        failed = []
+        for item in items:
+            try:
+                self._post(item["event"])
+            except requests.RequestException as e:
+                logger.warn("can't send event to webhook: {}".format(e))
+                failed.append(item)
+        return failed
+
+    def _fail(self, pipe, item):
+        item["attempts"] += 1
+        if item["attempts"] >= EVENT_MAX_ATTEMPTS:
+            pipe.lpush(EVENT_DEAD_LETTER_KEY, json.dumps(item))
+            pipe.ltrim(EVENT_DEAD_LETTER_KEY, 0, EVENT_DEAD_LETTER_MAXLEN - 1)
+            pipe.hincrby(EVENT_METRICS_KEY, "dead")
+            notify_im(IM_WEBHOOK_CHANNEL, f"Can't send event to webhook: {item['event']}")
+            return
+        delay = EVENT_RETRY_BASE_DELAY * (2 ** (item["attempts"] - 1))
+        pipe.zadd(EVENT_RETRY_KEY, {json.dumps(item): time.time() + delay})
+        pipe.hincrby(EVENT_METRICS_KEY, "retried")
+
+    def requeue_due_retries(self):
+        now = time.time()
+        due = rds.zrangebyscore(EVENT_RETRY_KEY, 0, now)
+        if not due:
+            return
+        pipe = rds.pipeline()
+        pipe.zremrangebyscore(EVENT_RETRY_KEY, 0, now)
+        # the retries are sent before the new events
+        pipe.rpush(EVENT_QUEUE_KEY, *reversed(due))
+        pipe.execute()
+
+    def recover_processing(self):
+        """
+        the events left by a dead worker are sent again, before the new events and in the same order
+        """
+        raw_items = rds.lrange(EVENT_PROCESSING_KEY, 0, -1)
+        if not raw_items:
+            return
+        pipe = rds.pipeline()
+        pipe.rpush(EVENT_QUEUE_KEY, *raw_items)
+        pipe.delete(EVENT_PROCESSING_KEY)
+        pipe.execute()
+
+    def deliver_batch(self):
+        """
+        :return: number of events taken from the queue
+        """
+        raw_items = []
+        for _ in range(EVENT_BATCH_SIZE):
+            raw = rds.rpoplpush(EVENT_QUEUE_KEY, EVENT_PROCESSING_KEY)
+            if raw is None:
+                break
+            raw_items.append(raw)
+        if not raw_items:
+            return 0
+        items = [json.loads(raw) for raw in raw_items]
+
+        started_at = time.time()
+        failed = self.send(items)
+        duration = time.time() - started_at
+
+        pipe = rds.pipeline()
+        for item in failed:
+            self._fail(pipe, item)
+        delivered = len(items) - len(failed)
+        pipe.hincrby(EVENT_METRICS_KEY, "delivered", delivered)
+        pipe.hincrby(EVENT_METRICS_KEY, "failed", len(failed))
+        pipe.hset(EVENT_METRICS_KEY, "last_batch_duration", duration)
+        if delivered:
+            lag = started_at - min(item["enqueued_at"] for item in items)
+            pipe.hset(EVENT_METRICS_KEY, "last_delivery_lag", lag)
+        pipe.delete(EVENT_PROCESSING_KEY)
+        pipe.execute()
+        return len(items)
+
+    def run(self):
+        """
+        deliver until the queue is empty
+        """
+        self.recover_processing()
+        self.requeue_due_retries()
+        while self.deliver_batch() > 0:
+            pass
+
+
+def deliver_events():
+    """
+    :return: seconds after which deliver_events should run again, None if not needed
+    """
+    if get_webhook_url() == "":
+        return None
+    lck = redis_lock.Lock(rds, DELIVERY_LOCK_NAME, expire=60, auto_renewal=True)
+    if not lck.acquire(blocking=False):
+        # the worker holding the lock delivers the new events too
+        return None
+    try:
+        EventDeliverer().run()
+    finally:
+        lck.release()
+
+    # the events enqueued after the last batch and before releasing the lock
+    if rds.llen(EVENT_QUEUE_KEY) > 0:
+        return 0
+    next_retry = rds.zrange(EVENT_RETRY_KEY, 0, 0, withscores=True)
+    if next_retry:
+        return max(next_retry[0][1] - time.time(), 1)
+    return None
@@ -0,0 +1,232 @@
+# coding: utf-8
+"""
+bare mirrors of the git repositories under REPO_DATA_DIR, shared by the builds.
+
+a build only fetches the new refs into the mirror of its repository, then makes a local clone
+sharing the objects of the mirror(`git clone --shared`), so nothing is downloaded twice.
+the submodules are mirrored too, their urls are rewritten to the mirrors by `url.<base>.insteadOf`.
+
+the mirrors are locked by flock: a fetch holds the exclusive lock of one mirror, a checkout updates the mirrors
+of the repository and its submodules first, then holds their shared locks until it's done,
+the shared locks are taken in the order of the paths, so a checkout never waits for a lock while holding others.
+the least recently used mirrors are removed when they use more than GIT_MIRROR_MAX_BYTES of disk.
+"""
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager, ExitStack
+from subprocess import Popen, PIPE, STDOUT, run, CalledProcessError
+
+from console.config import LOGGER_NAME, REPO_DATA_DIR, GIT_MIRROR_MAX_BYTES
+
+logger = logging.getLogger(LOGGER_NAME)
+
+MIRRORS_DIR = os.path.join(REPO_DATA_DIR, "mirrors")
+WORKTREES_DIR = os.path.join(REPO_DATA_DIR, "builds")
+
+
+class GitError(Exception):
+    def __init__(self, msg, phase="Cloning"):
+        super(GitError, self).__init__(msg)
+        self.phase = phase
+
+
+def mirror_path(git_url):
+    digest = hashlib.sha1(git_url.encode('utf8')).hexdigest()
+    return os.path.join(MIRRORS_DIR, "{}.git".format(digest))
+
+
+@contextmanager
+def _flock(path, mode, blocking=True):
+    """
+    :return: False if not blocking and the lock is held by others
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as fp:
+        try:
+            fcntl.flock(fp, mode if blocking else mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _run_git(args, cwd=None):
+    """
+    run git and yield its output line by line
+    """
+    p = Popen(['git'] + args, cwd=cwd, stdout=PIPE, stderr=STDOUT, env=os.environ.copy())
+    for line in iter(p.stdout.readline, ""):
+        if not line:
+            break
+        # please note: line contains \n
+        if isinstance(line, bytes):
+            line = line.decode('utf8')
+        yield line
+    p.wait()
+    if p.returncode:
+        raise GitError("git {} error: {}".format(args[0], p.returncode))
+
+
+def _touch(path):
+    # the mtime of the lock file is the last used time of the mirror
+    with open(path + ".lock", "a"):
+        pass
+    os.utime(path + ".lock")
+
+
+def update_mirror(git_url):
+    """
+    create the mirror of git_url or fetch the new refs into it, yields the output of git.
+    """
+    path = mirror_path(git_url)
+    with _flock(path + ".lock", fcntl.LOCK_EX):
+        if os.path.isdir(path):
+            try:
+                yield from _run_git(['fetch', '--prune', '--progress', 'origin'], cwd=path)
+                _touch(path)
+                return path
+            except GitError:
+                logger.exception("can't fetch mirror of {}, clone it again".format(git_url))
+                shutil.rmtree(path, ignore_errors=True)
+
+        tmp_path = "{}.tmp".format(path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        yield from _run_git(['clone', '--mirror', '--progress', git_url, tmp_path])
+        os.rename(tmp_path, path)
+        _touch(path)
+    return path
+
+
+def _submodule_urls(repo_dir, blob=None):
+    """
+    :param blob: read the .gitmodules of this blob(e.g. `<tag>:.gitmodules`) instead of the work tree
+    """
+    source = ['--blob', blob] if blob else ['-f', '.gitmodules']
+    try:
+        ret = run(
+            ['git', 'config'] + source + ['--get-regexp', r'^submodule\..*\.url$'],
+            check=True, cwd=repo_dir, stdout=PIPE, stderr=STDOUT, universal_newlines=True,
+        )
+    except CalledProcessError:
+        # no submodules
+        return []
+    urls = []
+    for line in ret.stdout.splitlines():
+        parts = line.split(None, 1)
+        # relative urls are resolved by git against the url of the super project
+        if len(parts) == 2 and not parts[1].startswith(('./', '../')):
+            urls.append(parts[1])
+    return urls
+
+
+def _update_mirrors(git_url, git_tag):
+    """
+    update the mirrors of git_url and the submodules of its git_tag, yields the output of git.
+    :return: {url: path of the mirror}
+    """
+    path = yield from update_mirror(git_url)
+    with _flock(path + ".lock", fcntl.LOCK_SH):
+        sub_urls = _submodule_urls(path, blob="{}:.gitmodules".format(git_tag)) if os.path.isdir(path) else []
+    mirrors = {git_url: path}
+    for url in sub_urls:
+        if url not in mirrors:
+            mirrors[url] = yield from update_mirror(url)
+    return mirrors
+
+
+def _lock_mirrors(paths, stack):
+    """
+    hold the shared locks of the mirrors in stack until the stack exits,
+    the clones share the objects of the mirrors, so they mustn't be evicted or gc'ed while they are made.
+    :return: False if a mirror was evicted after it was updated
+    """
+    for path in sorted(set(paths)):
+        stack.enter_context(_flock(path + ".lock", fcntl.LOCK_SH))
+        if not os.path.isdir(path):
+            return False
+    return True
+
+
+def checkout(git_url, git_tag, dest_dir):
+    """
+    check out git_tag of git_url(including the submodules) to dest_dir, yields the output of git.
+    only the submodules of the top level are mirrored, the nested ones are cloned from their remotes.
+    """
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    with ExitStack() as stack:
+        while True:
+            mirrors = yield from _update_mirrors(git_url, git_tag)
+            if _lock_mirrors(mirrors.values(), stack):
+                break
+            # evicted between the update and the lock
+            stack.close()
+
+        yield from _run_git(['clone', '--shared', '--no-checkout', mirrors[git_url], dest_dir])
+        # the remote of the clone is the real repository
+        yield from _run_git(['remote', 'set-url', 'origin', git_url], cwd=dest_dir)
+        try:
+            yield from _run_git(['checkout', git_tag], cwd=dest_dir)
+        except GitError:
+            raise GitError("checkout tag error: {}".format(git_tag), phase="Checkout")
+
+        sub_urls = _submodule_urls(dest_dir)
+        if not sub_urls:
+            return
+        # the mirrors are local paths, git doesn't clone submodules from them by default since 2.38.1
+        configs = ['-c', 'protocol.file.allow=always']
+        for url in sub_urls:
+            if url in mirrors:
+                configs += ['-c', 'url.{}.insteadOf={}'.format(mirrors[url], url)]
+        yield from _run_git(configs + ['submodule', 'update', '--init', '--recursive', '--progress'], cwd=dest_dir)
+
+
+def _disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def evict_mirrors(max_bytes=GIT_MIRROR_MAX_BYTES):
+    """
+    remove the least recently used mirrors until they use less than max_bytes, the mirrors in use are kept.
+    """
+    if not os.path.isdir(MIRRORS_DIR):
+        return
+    mirrors = []
+    for name in os.listdir(MIRRORS_DIR):
+        path = os.path.join(MIRRORS_DIR, name)
+        if not name.endswith(".git") or not os.path.isdir(path):
+            continue
+        try:
+            last_used = os.stat(path + ".lock").st_mtime
+        except OSError:
+            last_used = 0
+        mirrors.append((last_used, path, _disk_usage(path)))
+
+    total = sum(size for _, _, size in mirrors)
+    for _, path, size in sorted(mirrors):
+        if total <= max_bytes:
+            break
+        with _flock(path + ".lock", fcntl.LOCK_EX, blocking=False) as locked:
+            if not locked:
+                continue
+            logger.info("evict git mirror {}".format(path))
+            # keep the lock file, the others may be waiting on it
+            shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def make_worktree_dir(appname):
+    return os.path.join(WORKTREES_DIR, "{}-{}-{}".format(appname, os.getpid(), int(time.time() * 1000)))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+list+watch backed local stores of kubernetes objects.
+
+every Informer keeps the objects of one kind in one namespace fresh from watch events,
+so the read paths which only need a recent view of an object don't need to call apiserver.
+"""
+import time
+import copy
+import threading
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import ProtocolError
+
+from console.libs.utils import logger, spawn
+
+
+class CacheMode(object):
+    # always read from apiserver
+    DIRECT = None
+    # read from the local store when it is fresh, a miss means the object doesn't exist
+    LOCAL = "local"
+    # read hits from the local store, go to apiserver on miss or when the store is stale
+    READ_THROUGH = "read_through"
+
+
+def _parse_resource_version(obj):
+    try:
+        return int(obj.metadata.resource_version)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class ObjectStore(object):
+    """
+    thread safe store of kubernetes objects keyed by namespace/name
+    """
+    def __init__(self):
+        self.lck = threading.Lock()
+        self.items = {}
+        # keys written by this process, they are ignored until the next read-through,
+        # because the watch event of the write may not arrive yet.
+        self.dirty = set()
+        # key -> number of invalidations, a read-through only clears the dirty key
+        # if the key isn't invalidated during the read.
+        self.generations = {}
+
+    @staticmethod
+    def make_key(namespace, name):
+        return f"{namespace}/{name}"
+
+    def get(self, key):
+        with self.lck:
+            obj = self.items.get(key)
+        # the caller may modify the object and send it back to apiserver
+        return copy.deepcopy(obj)
+
+    def is_dirty(self, key):
+        with self.lck:
+            return key in self.dirty
+
+    def generation(self, key):
+        with self.lck:
+            return self.generations.get(key, 0)
+
+    def put(self, key, obj, from_watch=False, generation=None):
+        """
+        :param generation: the generation of the key when the object was read, see `generation`
+        """
+        new_ver = _parse_resource_version(obj)
+        with self.lck:
+            if not from_watch and (generation is None or generation == self.generations.get(key, 0)):
+                self.dirty.discard(key)
+            old = self.items.get(key)
+            old_ver = _parse_resource_version(old) if old is not None else None
+            # never replace a newer object with an older one
+            if old_ver is not None and new_ver is not None and new_ver < old_ver:
+                return
+            self.items[key] = obj
+
+    def delete(self, key):
+        with self.lck:
+            self.items.pop(key, None)
+
+    def invalidate(self, key):
+        with self.lck:
+            self.dirty.add(key)
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def replace(self, items):
+        with self.lck:
+            self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Informer(object):
+    def __init__(self, kind, list_func, namespace, max_staleness=60):
+        self.kind = kind
+        self.list_func = list_func
+        self.namespace = namespace
+        self.max_staleness = max_staleness
+        # watch requests end before the store becomes stale, then we know the store is still in sync
+        self.watch_timeout = max(max_staleness // 2, 1)
+
+        self.store = ObjectStore()
+        self.resource_version = None
+        self.synced_at = None
+        self._thread = None
+
+    def __repr__(self):
+        return "Informer <{}:{}>".format(self.namespace, self.kind)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = spawn(self._run)
+
+    @property
+    def fresh(self):
+        return self.synced_at is not None and (time.time() - self.synced_at) < self.max_staleness
+
+    def key(self, name):
+        return self.store.make_key(self.namespace, name)
+
+    def get(self, name):
+        return self.store.get(self.key(name))
+
+    def is_dirty(self, name):
+        return self.store.is_dirty(self.key(name))
+
+    def generation(self, name):
+        return self.store.generation(self.key(name))
+
+    def put(self, name, obj, generation=None):
+        self.store.put(self.key(name), obj, generation=generation)
+
+    def invalidate(self, name):
+        self.store.invalidate(self.key(name))
+
+    def _list(self):
+        result = self.list_func(namespace=self.namespace)
+        items = {self.key(obj.metadata.name): obj for obj in result.items}
+        self.store.replace(items)
+        self.resource_version = result.metadata.resource_version
+        self.synced_at = time.time()
+        logger.debug("{} listed {} objects".format(self, len(items)))
+
+    def _watch(self):
+        w = watch.Watch()
+        stream = w.stream(self.list_func, namespace=self.namespace,
+                          resource_version=self.resource_version, timeout_seconds=self.watch_timeout)
+        for event in stream:
+            if event['type'] == 'ERROR':
+                raw = event.get('raw_object') or {}
+                raise ApiException(status=raw.get('code'), reason=raw.get('message'))
+
+            obj = event['object']
+            key = self.key(obj.metadata.name)
+            if event['type'] == 'DELETED':
+                self.store.delete(key)
+            else:
+                self.store.put(key, obj, from_watch=True)
+            self.resource_version = obj.metadata.resource_version
+            self.synced_at = time.time()
+        self.synced_at = time.time()
+
+    def _run(self):
+        logger.info("starting {}".format(self))
+        while True:
+            try:
+                if self.resource_version is None:
+                    self._list()
+                self._watch()
+            except ApiException as e:
+                if e.status == 410:
+                    # resource version is too old, we need relist
+                    logger.info("{} got 410 Gone, relist".format(self))
+                else:
+                    logger.exception("{} watch error".format(self))
+                    time.sleep(1)
+                self.resource_version = None
+            except ProtocolError:
+                logger.debug("{} disconnected by apiserver".format(self))
+            except Exception:
+                logger.exception("{} watch error".format(self))
+                self.resource_version = None
+                time.sleep(1)
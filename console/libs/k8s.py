@@ -4,24 +4,42 @@ import yaml
 import base64
 import copy
 import json
+import socket
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 from addict import Dict
 from kubernetes import client, config, watch
 from kubernetes.watch.watch import iter_resp_lines
 from kubernetes.stream import stream
 
 from kubernetes.client.rest import ApiException
+from urllib3.connection import HTTPConnection
 
 from console.config import (
     HOST_VOLUMES_DIR, POD_LOG_DIR,
     REGISTRY_AUTHS, INGRESS_ANNOTATIONS_PREFIX, CLUSTER_CFG,
+    KUBE_FANOUT_MAX_WORKERS, KUBE_FANOUT_TIMEOUT,
+    KUBE_INFORMER_ENABLED, KUBE_INFORMER_MAX_STALENESS,
+    KUBE_CONNECTION_POOL_MAXSIZE, KUBE_REQUEST_TIMEOUT, KUBE_KEEP_ALIVE,
+    KUBE_DEPLOY_MAX_WORKERS,
 )
 
+from .informer import Informer, CacheMode
+from .k8s_diff import is_subset, make_json_patch
+from .pipeline import Step, run_steps
+
 from .utils import (
     parse_image_name, id_generator, make_canary_appname, search_tls_secret, get_dfs_host_dir,
 )
 
 ANNO_CONFIG_ID = "kae-app-config-id"
 ANNO_DEPLOY_INFO = "kae-app-deploy-info"
+# the object applied last time, used to compute the patch of next apply
+ANNO_LAST_APPLIED = "kae-last-applied-config"
+
+# runs the independent steps of deployments, shared by all clusters
+_deploy_executor = ThreadPoolExecutor(max_workers=KUBE_DEPLOY_MAX_WORKERS)
 
 # TODO: when the upstream upgrade, remove these dirty code
 # fix the stupid Condition is None problem,
@@ -64,6 +82,99 @@ class K8sNotExistError(Exception):
         return self.msg
 
 
+class PooledApiClient(client.ApiClient):
+    """
+    ApiClient shared by all the API groups of one k8s context,
+    it applies a default timeout to non-streaming requests and counts the pool utilization.
+    """
+    def __init__(self, configuration, request_timeout=None, keep_alive=True):
+        super(PooledApiClient, self).__init__(configuration=configuration)
+        self.request_timeout = request_timeout
+        self.lck = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_requests = 0
+        if keep_alive:
+            # new connections of the pool manager will use these socket options
+            self.rest_client.pool_manager.connection_pool_kw['socket_options'] = \
+                HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    def request(self, method, url, query_params=None, headers=None, post_params=None, body=None,
+                _preload_content=True, _request_timeout=None):
+        # streaming requests(watch, follow log) are long-running, so don't set timeout for them
+        if _request_timeout is None and _preload_content:
+            _request_timeout = self.request_timeout
+        with self.lck:
+            self.in_flight += 1
+            self.total_requests += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return super(PooledApiClient, self).request(
+                method, url, query_params=query_params, headers=headers, post_params=post_params, body=body,
+                _preload_content=_preload_content, _request_timeout=_request_timeout)
+        finally:
+            with self.lck:
+                self.in_flight -= 1
+
+    def pool_stats(self):
+        pools = self.rest_client.pool_manager.pools
+        created, idle = 0, 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            created += pool.num_connections
+            if pool.pool is not None:
+                idle += pool.pool.qsize()
+        return {
+            "maxsize": self.configuration.connection_pool_maxsize,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "total_requests": self.total_requests,
+            "connections_created": created,
+            "idle_connections": idle,
+        }
+
+
+class ClusterResult(object):
+    """
+    outcome of an operation on a single cluster when it is applied to KubeApi.ALL_CLUSTER
+    """
+    def __init__(self, cluster, result=None, error=None):
+        self.cluster = cluster
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def to_dict(self):
+        return {
+            "cluster": self.cluster,
+            "ok": self.ok,
+            "error": None if self.error is None else str(self.error),
+        }
+
+    def __repr__(self):
+        return "ClusterResult <{}: {}>".format(self.cluster, "ok" if self.ok else self.error)
+
+
+def check_cluster_results(results):
+    """
+    raise the error of the failed clusters in the results returned by a KubeApi.ALL_CLUSTER call.
+    if only one cluster failed, its original exception is re-raised,
+    so the callers can still handle ApiException as usual.
+    """
+    failed = [r for r in results.values() if not r.ok]
+    if not failed:
+        return
+    if len(failed) == 1:
+        raise failed[0].error
+    raise KubeError("failed on clusters: {}".format(
+        ", ".join("{}({})".format(r.cluster, r.error) for r in failed)))
+
+
 class KubeApi(object):
     _INSTANCE = None
     ALL_CLUSTER = "__all_cluster__"
@@ -71,6 +182,8 @@ class KubeApi(object):
     def __init__(self):
         self.k8s_api_map = {}
         self.kae_cluster_map = {}
+        self.lck = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=KUBE_FANOUT_MAX_WORKERS)
 
     @classmethod
     def instance(cls):
@@ -85,6 +198,26 @@ class KubeApi(object):
     def cluster_exist(self, cluster_name):
         return cluster_name in CLUSTER_CFG
 
+    @staticmethod
+    def _get_pool_options(k8s_name):
+        """
+        connection pool options of a k8s context, clusters using the same k8s share one pool,
+        so we use the largest pool size and timeout among them.
+        """
+        maxsize, timeout, keep_alive = KUBE_CONNECTION_POOL_MAXSIZE, KUBE_REQUEST_TIMEOUT, KUBE_KEEP_ALIVE
+        clusters = [info for info in CLUSTER_CFG.values() if info["k8s"] == k8s_name]
+        if clusters:
+            maxsize = max(info.get("connection_pool_maxsize", maxsize) for info in clusters)
+            timeouts = [info.get("request_timeout", timeout) for info in clusters]
+            timeout = None if None in timeouts else max(timeouts)
+            keep_alive = any(info.get("keep_alive", keep_alive) for info in clusters)
+        return maxsize, timeout, keep_alive
+
+    def _new_api_client(self, name, configuration):
+        maxsize, timeout, keep_alive = self._get_pool_options(name)
+        configuration.connection_pool_maxsize = maxsize
+        return PooledApiClient(configuration, request_timeout=timeout, keep_alive=keep_alive)
+
     def _load_k8s_client(self, name):
         if name not in self.k8s_api_map:
             # get k8s clusters
@@ -97,43 +230,77 @@ class KubeApi(object):
                 if name not in ctx_names:
                     raise K8sNotExistError(f"k8s context {name} not exist")
 
-                api_map = {}
-                api_map['core_v1_api'] = client.CoreV1Api(
-                    api_client=config.new_client_from_config(context=name))
-                api_map['apps_v1_api'] = client.AppsV1Api(
-                    api_client=config.new_client_from_config(context=name))
-                api_map['extensions_v1beta1_api'] = client.ExtensionsV1beta1Api(
-                    api_client=config.new_client_from_config(context=name))
-                api_map['scale_v2beta2_api'] = client.AutoscalingV2beta2Api(
-                    api_client=config.new_client_from_config(context=name))
-                api_map['custom_obj_api'] = client.CustomObjectsApi(
-                    api_client=config.new_client_from_config(context=name))
-                self.k8s_api_map[name] = api_map
+                def _new_configuration():
+                    cfg = client.Configuration()
+                    config.load_kube_config(context=name, client_configuration=cfg)
+                    return cfg
             else:
                 if name != "incluster":
                     raise K8sNotExistError(f"k8s context {name} not exist")
                 config.load_incluster_config()
-                api_map = {
-                    'core_v1_api': client.CoreV1Api(),
-                    'apps_v1_api': client.AppsV1Api(),
-                    'extensions_v1beta1_api': client.ExtensionsV1beta1Api(),
-                    'scale_v2beta2_api': client.AutoscalingV2beta2Api(),
-                    'custom_obj_api': client.CustomObjectsApi(),
-                }
-                self.k8s_api_map['incluster'] = api_map
+                _new_configuration = client.Configuration
+
+            api_client = self._new_api_client(name, _new_configuration())
+            # `stream` replaces the request method of the api client during a websocket call,
+            # so exec must use a separate client, otherwise it will intercept other requests.
+            stream_api_client = self._new_api_client(name, _new_configuration())
+            api_map = {
+                'api_client': api_client,
+                'core_v1_api': client.CoreV1Api(api_client=api_client),
+                'apps_v1_api': client.AppsV1Api(api_client=api_client),
+                'extensions_v1beta1_api': client.ExtensionsV1beta1Api(api_client=api_client),
+                'scale_v2beta2_api': client.AutoscalingV2beta2Api(api_client=api_client),
+                'custom_obj_api': client.CustomObjectsApi(api_client=api_client),
+                'stream_core_v1_api': client.CoreV1Api(api_client=stream_api_client),
+            }
+            self.k8s_api_map[name] = api_map
         return self.k8s_api_map[name]
 
+    def pool_stats(self):
+        """
+        connection pool utilization of every loaded k8s context
+        """
+        return {name: api_map['api_client'].pool_stats() for name, api_map in self.k8s_api_map.items()}
+
     def _load_kae_cluster(self, name):
-        if name not in self.kae_cluster_map:
-            cluster_info = CLUSTER_CFG[name]
-            k8s_name = cluster_info["k8s"]
-            k8s_namespace = cluster_info["namespace"]
-            try:
-                k8s_cluster = self._load_k8s_client(k8s_name)
-                self.kae_cluster_map[name] = KaeCluster(name, k8s_namespace, **k8s_cluster)
-            except K8sNotExistError:
-                raise KubeError(f"kae cluster {name}'s k8s {k8s_name} doesn't exist")
-        return self.kae_cluster_map[name]
+        # clusters may be loaded concurrently by the fan-out workers
+        with self.lck:
+            if name not in self.kae_cluster_map:
+                cluster_info = CLUSTER_CFG[name]
+                k8s_name = cluster_info["k8s"]
+                k8s_namespace = cluster_info["namespace"]
+                try:
+                    k8s_cluster = self._load_k8s_client(k8s_name)
+                    self.kae_cluster_map[name] = KaeCluster(name, k8s_namespace, **k8s_cluster)
+                except K8sNotExistError:
+                    raise KubeError(f"kae cluster {name}'s k8s {k8s_name} doesn't exist")
+            return self.kae_cluster_map[name]
+
+    def iter_on_clusters(self, cluster_names, func, timeout=KUBE_FANOUT_TIMEOUT):
+        """
+        run func(cluster_name) on the clusters concurrently, yield a ClusterResult as soon as a cluster finished.
+        an error or a timeout in one cluster doesn't affect the others.
+        """
+        futures = {self.executor.submit(func, name): name for name in cluster_names}
+        # every cluster is started at the same time, so waiting `timeout` in total is enough
+        try:
+            for fut in as_completed(futures, timeout=timeout):
+                name = futures.pop(fut)
+                if fut.exception() is not None:
+                    yield ClusterResult(name, error=fut.exception())
+                else:
+                    yield ClusterResult(name, result=fut.result())
+        except FutureTimeoutError:
+            for fut, name in futures.items():
+                fut.cancel()
+                yield ClusterResult(name, error=KubeError(f"timeout after {timeout}s on cluster {name}"))
+
+    def _exec_on_all_clusters(self, func, timeout=KUBE_FANOUT_TIMEOUT):
+        """
+        run func(cluster_name) on every cluster concurrently.
+        :return: dict of cluster name -> ClusterResult
+        """
+        return {r.cluster: r for r in self.iter_on_clusters(list(CLUSTER_CFG), func, timeout=timeout)}
 
     def __getattr__(self, item):
         def wrapper(*args, **kwargs):
@@ -148,10 +315,7 @@ class KubeApi(object):
                 raise ValueError("cluster_name is needed")
 
             if cluster_name == self.ALL_CLUSTER:
-                results = {}
-                for name, cluster_info in CLUSTER_CFG.items():
-                    results[name] = _exec_on_single_cluster(name)
-                return results
+                return self._exec_on_all_clusters(_exec_on_single_cluster)
 
             cluster_info = CLUSTER_CFG.get(cluster_name, None)
             if cluster_info is None:
@@ -166,6 +330,9 @@ class KaeCluster(object):
         self.cluster = name
         self.namespace = namespace
         self.api_map = api_map
+        self.informers = {}
+        if KUBE_INFORMER_ENABLED:
+            self.start_informers()
 
     @property
     def core_api(self):
@@ -187,6 +354,70 @@ class KaeCluster(object):
     def custom_api(self):
         return self.api_map['custom_obj_api']
 
+    @property
+    def stream_core_api(self):
+        return self.api_map['stream_core_v1_api']
+
+    def start_informers(self):
+        list_funcs = {
+            "Deployment": self.apps_api.list_namespaced_deployment,
+            "Ingress": self.extensions_api.list_namespaced_ingress,
+            "HorizontalPodAutoscaler": self.scale_api.list_namespaced_horizontal_pod_autoscaler,
+            "ConfigMap": self.core_api.list_namespaced_config_map,
+        }
+        for kind, list_func in list_funcs.items():
+            if kind not in self.informers:
+                informer = Informer(kind, list_func, self.namespace, max_staleness=KUBE_INFORMER_MAX_STALENESS)
+                informer.start()
+                self.informers[kind] = informer
+
+    def _cached_read(self, kind, name, read_func, cache_mode=CacheMode.DIRECT, ignore_404=False):
+        """
+        read an object from the informer's local store or from apiserver according to cache_mode
+        """
+        informer = self.informers.get(kind)
+        use_store = cache_mode and informer is not None and informer.fresh and not informer.is_dirty(name)
+        if use_store:
+            obj = informer.get(name)
+            if obj is not None:
+                return obj
+            if cache_mode == CacheMode.LOCAL:
+                if ignore_404 is True:
+                    return None
+                raise ApiException(status=404, reason=f"{kind} {name} not found")
+        # the object read during a write of this process may be older than the write
+        generation = informer.generation(name) if informer is not None else None
+        try:
+            obj = read_func(name=name, namespace=self.namespace)
+        except ApiException as e:
+            if e.status == 404 and ignore_404 is True:
+                return None
+            else:
+                raise e
+        if informer is not None:
+            informer.put(name, copy.deepcopy(obj), generation=generation)
+        return obj
+
+    def _invalidate_cache(self, kind, name):
+        informer = self.informers.get(kind)
+        if informer is not None:
+            informer.invalidate(name)
+
+    @contextlib.contextmanager
+    def _changing(self, kind, name):
+        """
+        wrap the writes of this process to an object, so the next cached read of the object will go to apiserver.
+        it's invalidated again after the write, a read-through during the write may have stored the old object.
+        """
+        self._invalidate_cache(kind, name)
+        try:
+            yield
+        finally:
+            self._invalidate_cache(kind, name)
+
+    def get_pod(self, podname):
+        return self.core_api.read_namespaced_pod(name=podname, namespace=self.namespace)
+
     def get_pods(self, label_selector):
         return self.core_api.list_namespaced_pod(namespace=self.namespace, label_selector=label_selector)
 
@@ -209,6 +440,11 @@ class KaeCluster(object):
         label_selector = "kae-app-name={}".format(name)
         return self.core_api.list_namespaced_pod(namespace=self.namespace, label_selector=label_selector)
 
+    def list_pods(self, label_selector=None, **kwargs):
+        if label_selector is None:
+            label_selector = "kae=true"
+        return self.core_api.list_pod_for_all_namespaces(label_selector=label_selector, **kwargs)
+
     def watch_pods(self, label_selector=None, **kwargs):
         if label_selector is None:
             label_selector = "kae=true"
@@ -227,7 +463,7 @@ class KaeCluster(object):
         }
         if container:
             kwargs['container'] = container
-        resp = stream(self.core_api.connect_get_namespaced_pod_exec, podname, self.namespace, **kwargs)
+        resp = stream(self.stream_core_api.connect_get_namespaced_pod_exec, podname, self.namespace, **kwargs)
         return resp
 
     def stop_container(self, podname, container=None):
@@ -242,17 +478,13 @@ class KaeCluster(object):
         }
         if container:
             kwargs['container'] = container
-        resp = stream(self.core_api.connect_get_namespaced_pod_exec, podname, self.namespace, **kwargs)
+        resp = stream(self.stream_core_api.connect_get_namespaced_pod_exec, podname, self.namespace, **kwargs)
         return resp
 
-    def get_hpa(self, appname, ignore_404=False):
-        try:
-            return self.scale_api.read_namespaced_horizontal_pod_autoscaler(appname, namespace=self.namespace)
-        except ApiException as e:
-            if e.status == 404 and ignore_404 is True:
-                return None
-            else:
-                raise e
+    def get_hpa(self, appname, ignore_404=False, cache_mode=CacheMode.DIRECT):
+        return self._cached_read("HorizontalPodAutoscaler", appname,
+                                 self.scale_api.read_namespaced_horizontal_pod_autoscaler,
+                                 cache_mode=cache_mode, ignore_404=ignore_404)
 
     def create_hpa(self, appname, hpa_data):
         """
@@ -305,20 +537,22 @@ class KaeCluster(object):
             metrics.append(metric)
         obj["spec"]["metrics"] = metrics
 
-        try:
-            self.scale_api.replace_namespaced_horizontal_pod_autoscaler(name=appname, namespace=self.namespace, body=obj)
-        except ApiException as e:
-            if e.status == 404:
-                self.scale_api.create_namespaced_horizontal_pod_autoscaler(namespace=self.namespace, body=obj)
-            else:
-                raise e
+        with self._changing("HorizontalPodAutoscaler", appname):
+            try:
+                self.scale_api.replace_namespaced_horizontal_pod_autoscaler(name=appname, namespace=self.namespace, body=obj)
+            except ApiException as e:
+                if e.status == 404:
+                    self.scale_api.create_namespaced_horizontal_pod_autoscaler(namespace=self.namespace, body=obj)
+                else:
+                    raise e
 
     def delete_hpa(self, appname, ignore_404=False):
-        try:
-            self.scale_api.delete_namespaced_horizontal_pod_autoscaler(name=appname, namespace=self.namespace)
-        except ApiException as e:
-            if not (e.status == 404 and ignore_404 is True):
-                raise e
+        with self._changing("HorizontalPodAutoscaler", appname):
+            try:
+                self.scale_api.delete_namespaced_horizontal_pod_autoscaler(name=appname, namespace=self.namespace)
+            except ApiException as e:
+                if not (e.status == 404 and ignore_404 is True):
+                    raise e
 
     def apply_config_map(self, appname, config_id, cm_data):
         """
@@ -335,24 +569,20 @@ class KaeCluster(object):
             else:
                 raise e
 
-    def get_config_map(self, appname, raw=False, ignore_404=False):
+    def get_config_map(self, appname, raw=False, ignore_404=False, cache_mode=CacheMode.DIRECT):
         """
         get configmap of specfied app
         :param appname: app name
         :param raw: if set True return the raw configmap object, otherwise return the data in configmap
+        :param cache_mode: see CacheMode
         :return:
         """
-        try:
-            result = self.core_api.read_namespaced_config_map(name=appname, namespace=self.namespace)
-            if raw:
-                return result 
-            else:
-                return result.data
-        except ApiException as e:
-            if e.status == 404 and ignore_404 is True:
-                return None
-            else:
-                raise e
+        result = self._cached_read("ConfigMap", appname, self.core_api.read_namespaced_config_map,
+                                   cache_mode=cache_mode, ignore_404=ignore_404)
+        if result is None or raw:
+            return result
+        else:
+            return result.data
 
     def _create_or_update_config_map(self, appname, config_id, cm_data, is_update=False):
         obj = {
@@ -366,10 +596,11 @@ class KaeCluster(object):
             },
             "data": cm_data,
         }
-        if is_update:
-            self.core_api.replace_namespaced_config_map(name=appname, namespace=self.namespace, body=obj)
-        else:
-            self.core_api.create_namespaced_config_map(namespace=self.namespace, body=obj)
+        with self._changing("ConfigMap", appname):
+            if is_update:
+                self.core_api.replace_namespaced_config_map(name=appname, namespace=self.namespace, body=obj)
+            else:
+                self.core_api.create_namespaced_config_map(namespace=self.namespace, body=obj)
 
     def create_config_map(self, appname, config_id, cm_data):
         return self._create_or_update_config_map(appname, config_id, cm_data, False)
@@ -378,12 +609,13 @@ class KaeCluster(object):
         return self._create_or_update_config_map(appname, config_id, cm_data, True)
 
     def delete_config_map(self, appname, ignore_404=False):
-        try:
-            self.core_api.delete_namespaced_config_map(name=appname, namespace=self.namespace,
-                                                       body=client.V1DeleteOptions())
-        except ApiException as e:
-            if not (e.status == 404 and ignore_404 is True):
-                raise e
+        with self._changing("ConfigMap", appname):
+            try:
+                self.core_api.delete_namespaced_config_map(name=appname, namespace=self.namespace,
+                                                           body=client.V1DeleteOptions())
+            except ApiException as e:
+                if not (e.status == 404 and ignore_404 is True):
+                    raise e
 
     def create_or_update_secret(self, appname, secrets, replace=True):
         """
@@ -439,33 +671,87 @@ class KaeCluster(object):
             if not (e.status == 404 and ignore_404 is True):
                 raise e
 
+    def _read_live_object(self, kind, name):
+        read_funcs = {
+            "Deployment": self.apps_api.read_namespaced_deployment,
+            "Service": self.core_api.read_namespaced_service,
+            "Ingress": self.extensions_api.read_namespaced_ingress,
+        }
+        return self._cached_read(kind, name, read_funcs[kind], cache_mode=CacheMode.READ_THROUGH, ignore_404=True)
+
     def apply(self, d):
         """
-        create or update deplopyment, service, ingress
+        create or update deplopyment, service, ingress.
+
+        the applied dict is saved in the annotations of the object, the next apply compares with it and the live object:
+        if nothing changed, no request is sent, otherwise only the changed fields are sent as a JSON patch.
         :param d:
-        :param namespace:
-        :return:
+        :return: one of "created", "patched", "replaced", "unchanged"
         """
         kind = d["kind"]
         name = d["metadata"]["name"]
-        if kind == "Deployment":
-            try:
-                self.apps_api.replace_namespaced_deployment(name=name, body=d, namespace=self.namespace)
-            except ApiException as e:
-                if e.status == 404:
-                    self.apps_api.create_namespaced_deployment(body=d, namespace=self.namespace)
-                else:
-                    raise e
-        elif kind == "Service":
-            self.create_or_update_service(d)
-        elif kind == "Ingress":
-            try:
-                self.extensions_api.replace_namespaced_ingress(name=name, body=d, namespace=self.namespace)
-            except ApiException as e:
-                if e.status == 404:
-                    self.extensions_api.create_namespaced_ingress(body=d, namespace=self.namespace)
-                else:
-                    raise e
+
+        # the resourceVersion in d is used for optimistic concurrency control, it isn't a part of the config
+        desired = json.loads(json.dumps(d))
+        version = desired["metadata"].pop("resourceVersion", None)
+        desired_txt = json.dumps(desired, sort_keys=True)
+        if not desired["metadata"].get("annotations"):
+            desired["metadata"]["annotations"] = {}
+        desired["metadata"]["annotations"][ANNO_LAST_APPLIED] = desired_txt
+
+        live = self._read_live_object(kind, name)
+        last_applied_txt = None
+        if live is not None and live.metadata.annotations:
+            last_applied_txt = live.metadata.annotations.get(ANNO_LAST_APPLIED)
+
+        if live is None or last_applied_txt is None:
+            # object doesn't exist or is created by old version of KAE, fallback to create or replace
+            if version is not None:
+                desired["metadata"]["resourceVersion"] = version
+            self._create_or_replace(desired)
+            return "created" if live is None else "replaced"
+
+        live_dict = self.api_map['api_client'].sanitize_for_serialization(live)
+        if last_applied_txt == desired_txt and is_subset(desired, live_dict):
+            return "unchanged"
+
+        ops = make_json_patch(json.loads(last_applied_txt), desired, live_dict)
+        if not ops:
+            return "unchanged"
+        if version is not None:
+            ops.insert(0, {"op": "test", "path": "/metadata/resourceVersion", "value": str(version)})
+
+        with self._changing(kind, name):
+            if kind == "Deployment":
+                self.apps_api.patch_namespaced_deployment(name, self.namespace, body=ops)
+            elif kind == "Service":
+                self.core_api.patch_namespaced_service(name, self.namespace, body=ops)
+            elif kind == "Ingress":
+                self.extensions_api.patch_namespaced_ingress(name, self.namespace, body=ops)
+        return "patched"
+
+    def _create_or_replace(self, d):
+        kind = d["kind"]
+        name = d["metadata"]["name"]
+        with self._changing(kind, name):
+            if kind == "Deployment":
+                try:
+                    self.apps_api.replace_namespaced_deployment(name=name, body=d, namespace=self.namespace)
+                except ApiException as e:
+                    if e.status == 404:
+                        self.apps_api.create_namespaced_deployment(body=d, namespace=self.namespace)
+                    else:
+                        raise e
+            elif kind == "Service":
+                self.create_or_update_service(d)
+            elif kind == "Ingress":
+                try:
+                    self.extensions_api.replace_namespaced_ingress(name=name, body=d, namespace=self.namespace)
+                except ApiException as e:
+                    if e.status == 404:
+                        self.extensions_api.create_namespaced_ingress(body=d, namespace=self.namespace)
+                    else:
+                        raise e
 
     def create_or_update_service(self, d):
         name = d['metadata']['name']
@@ -486,7 +772,8 @@ class KaeCluster(object):
                 "replicas": replicas,
             }
         }
-        return self.apps_api.patch_namespaced_deployment(appname, body=obj, namespace=self.namespace)
+        with self._changing("Deployment", appname):
+            return self.apps_api.patch_namespaced_deployment(appname, body=obj, namespace=self.namespace)
 
     def renew_app(self, appname):
         """
@@ -500,39 +787,58 @@ class KaeCluster(object):
         if deployment.spec.template.metadata.annotations is None:
             deployment.spec.template.metadata.annotations = {}
         deployment.spec.template.metadata.annotations['renew_id'] = id_generator(10)
-        self.apps_api.replace_namespaced_deployment(name=appname, namespace=self.namespace, body=deployment)
+        with self._changing("Deployment", appname):
+            self.apps_api.replace_namespaced_deployment(name=appname, namespace=self.namespace, body=deployment)
 
     def deploy_app(self, spec, deploy_ver, version=None, ignore_config=False):
+        """
+        deploy all the objects of an app, the Deployment is applied after the ConfigMap it mounts,
+        Service, Ingress, HPA and ServiceMonitor don't depend on anything, so they are applied concurrently.
+        :return: list of the timing of every step
+        """
         ing = None
         dp_annotations = {
             ANNO_DEPLOY_INFO: json.dumps(deploy_ver.to_k8s_annotation()),
         }
-        # step 1: create configmap if neccessary
-        app_cfg = deploy_ver.app_config
-        if app_cfg is not None and ignore_config is False:
-            self.apply_config_map(app_cfg.appname, app_cfg.id, app_cfg.data_dict)
-        else:
-            self.delete_config_map(spec.appname, ignore_404=True)
-
+        # generate all objects before changing anything, so an invalid spec doesn't leave a partial deploy
         dp = self._create_deployment_dict(spec, version=version, annotations=dp_annotations)
         svc = self._create_service_dict(spec)
-
         if spec.type == "web":
             ing = self._create_ingress_dict(spec)
-        self.apply(dp)
-        self.apply(svc)
-        if ing is not None:
-            self.apply(ing)
-        # create HPA if neccessary
-        hpa_data = spec.service.hpa
-        if hpa_data:
-            self.create_hpa(spec.appname, hpa_data)
-        else:
+
+        app_cfg = deploy_ver.app_config
+
+        def _configmap():
+            if app_cfg is not None and ignore_config is False:
+                self.apply_config_map(app_cfg.appname, app_cfg.id, app_cfg.data_dict)
+                return "applied"
+            self.delete_config_map(spec.appname, ignore_404=True)
+            return "deleted"
+
+        def _hpa():
+            hpa_data = spec.service.hpa
+            if hpa_data:
+                self.create_hpa(spec.appname, hpa_data)
+                return "applied"
             # delete any exist HPA
             self.delete_hpa(spec.appname, ignore_404=True)
-        monitor = spec.service.monitor
-        if monitor:
-            self.apply_service_monitor(spec.appname, monitor)
+            return "deleted"
+
+        def _service_monitor():
+            self.apply_service_monitor(spec.appname, spec.service.monitor)
+            return "applied"
+
+        steps = [
+            Step("configmap", _configmap),
+            Step("deployment", lambda: self.apply(dp), deps=["configmap"]),
+            Step("service", lambda: self.apply(svc)),
+            Step("hpa", _hpa),
+        ]
+        if ing is not None:
+            steps.append(Step("ingress", lambda: self.apply(ing)))
+        if spec.service.monitor:
+            steps.append(Step("service_monitor", _service_monitor))
+        return run_steps(_deploy_executor, steps)
 
     def deploy_app_canary(self, spec, release_tag, app_cfg=None, ignore_config=False):
         """
@@ -554,8 +860,10 @@ class KaeCluster(object):
         dp_dict = self._create_deployment_dict(spec_copy, annotations=dp_annotations, canary=True)
         svc_dict = self._create_service_dict(spec_copy, canary=True)
 
-        self.apply(dp_dict)
-        self.apply(svc_dict)
+        return run_steps(_deploy_executor, [
+            Step("deployment", lambda: self.apply(dp_dict)),
+            Step("service", lambda: self.apply(svc_dict)),
+        ])
 
     def add_canary_backend(self, appname, ing):
         canary_appname = make_canary_appname(appname)
@@ -600,11 +908,12 @@ class KaeCluster(object):
         # add backend if needed
         ing = self.add_canary_backend(appname, ing)
 
-        self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=self.namespace)
+        with self._changing("Ingress", appname):
+            self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=self.namespace)
 
-    def get_abtesting_rules(self, appname):
+    def get_abtesting_rules(self, appname, cache_mode=CacheMode.DIRECT):
         annotations_key = "{}/service-match".format(INGRESS_ANNOTATIONS_PREFIX)
-        ing = self.extensions_api.read_namespaced_ingress(appname, namespace=self.namespace)
+        ing = self.get_ingress(appname, cache_mode=cache_mode)
         annotations = ing.metadata.annotations if ing.metadata.annotations else {}
         full_rules_str = annotations.get(annotations_key, None)
         if full_rules_str is None:
@@ -636,7 +945,8 @@ class KaeCluster(object):
         # add canary backend if needed
         ing = self.add_canary_backend(appname, ing)
 
-        self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=self.namespace)
+        with self._changing("Ingress", appname):
+            self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=self.namespace)
 
     def undeploy_app_canary(self, appname):
         canary_appname = make_canary_appname(appname)
@@ -661,7 +971,8 @@ class KaeCluster(object):
                 for path in need_delete:
                     rule.http.paths.remove(path)
 
-            self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=self.namespace)
+            with self._changing("Ingress", appname):
+                self.extensions_api.replace_namespaced_ingress(name=appname, body=ing, namespace=self.namespace)
             # the nginx-ingress needs about 1 seconds to detect the change of the ingress
             time.sleep(1)
         except ApiException as e:
@@ -677,14 +988,15 @@ class KaeCluster(object):
             if e.status != 404:
                 raise e
         # remove deployment
-        try:
-            self.apps_api.delete_namespaced_deployment(
-                name=canary_appname, namespace=self.namespace,
-                body=client.V1DeleteOptions(propagation_policy="Foreground",
-                                            grace_period_seconds=5))
-        except ApiException as e:
-            if e.status != 404:
-                raise e
+        with self._changing("Deployment", canary_appname):
+            try:
+                self.apps_api.delete_namespaced_deployment(
+                    name=canary_appname, namespace=self.namespace,
+                    body=client.V1DeleteOptions(propagation_policy="Foreground",
+                                                grace_period_seconds=5))
+            except ApiException as e:
+                if e.status != 404:
+                    raise e
         self.delete_config_map(canary_appname, ignore_404=True)
 
     def undeploy_app(self, appname, apptype, ignore_404=False):
@@ -692,14 +1004,15 @@ class KaeCluster(object):
 
         # delete resource in the following order: ingress, service, hpa, deployment, secret, configmap
         if apptype == "web":
-            try:
-                self.extensions_api.delete_namespaced_ingress(
-                    name=appname, namespace=self.namespace,
-                    body=client.V1DeleteOptions(propagation_policy="Foreground",
-                                                grace_period_seconds=5))
-            except ApiException as e:
-                if not (e.status == 404 and ignore_404 is True):
-                    raise e
+            with self._changing("Ingress", appname):
+                try:
+                    self.extensions_api.delete_namespaced_ingress(
+                        name=appname, namespace=self.namespace,
+                        body=client.V1DeleteOptions(propagation_policy="Foreground",
+                                                    grace_period_seconds=5))
+                except ApiException as e:
+                    if not (e.status == 404 and ignore_404 is True):
+                        raise e
 
         if apptype in ("worker", "web"):
             try:
@@ -715,49 +1028,40 @@ class KaeCluster(object):
         except ApiException as e:
             if e.status != 404:
                 raise e
-        try:
-            self.apps_api.delete_namespaced_deployment(
-                name=appname, namespace=self.namespace,
-                body=client.V1DeleteOptions(propagation_policy="Foreground",
-                                            grace_period_seconds=5))
-        except ApiException as e:
-            if not (e.status == 404 and ignore_404 is True):
-                raise e
+        with self._changing("Deployment", appname):
+            try:
+                self.apps_api.delete_namespaced_deployment(
+                    name=appname, namespace=self.namespace,
+                    body=client.V1DeleteOptions(propagation_policy="Foreground",
+                                                grace_period_seconds=5))
+            except ApiException as e:
+                if not (e.status == 404 and ignore_404 is True):
+                    raise e
 
         self.delete_secret(appname, ignore_404=True)
         self.delete_config_map(appname, ignore_404=True)
         # delete ServiceMonitor
         self.delete_service_monitor(appname, ignore_404=True)
 
-    def get_deployment(self, name, ignore_404=False):
+    def get_deployment(self, name, ignore_404=False, cache_mode=CacheMode.DIRECT):
         """
         get kubernetes deployment object
         :param name:
-        :param namespace:
+        :param cache_mode: see CacheMode
         :return:
         """
-        try:
-            return self.apps_api.read_namespaced_deployment(name=name, namespace=self.namespace)
-        except ApiException as e:
-            if e.status == 404 and ignore_404 is True:
-                return None
-            else:
-                raise e
+        return self._cached_read("Deployment", name, self.apps_api.read_namespaced_deployment,
+                                 cache_mode=cache_mode, ignore_404=ignore_404)
 
-    def get_ingress(self, name, ignore_404=False):
+    def get_ingress(self, name, ignore_404=False, cache_mode=CacheMode.DIRECT):
         """
-        get kubernetes deployment object
+        get kubernetes ingress object
         :param name:
-        :param namespace:
+        :param cache_mode: see CacheMode
         :return:
         """
-        try:
-            return self.extensions_api.read_namespaced_ingress(name=name, namespace=self.namespace)
-        except ApiException as e:
-            if e.status == 404 and ignore_404 is True:
-                return None
-            else:
-                raise e
+        return self._cached_read("Ingress", name, self.extensions_api.read_namespaced_ingress,
+                                 cache_mode=cache_mode, ignore_404=ignore_404)
 
     def apply_service_monitor(self, appname, monitor_spec):
         try:
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+helpers to compare the objects generated by KAE with the live kubernetes objects
+and generate minimal JSON patches between them.
+"""
+import re
+from decimal import Decimal, InvalidOperation
+
+_MISSING = object()
+
+_QUANTITY_SUFFIXES = {
+    "n": Decimal("1e-9"), "u": Decimal("1e-6"), "m": Decimal("1e-3"), "": Decimal(1),
+    "k": Decimal(10) ** 3, "M": Decimal(10) ** 6, "G": Decimal(10) ** 9,
+    "T": Decimal(10) ** 12, "P": Decimal(10) ** 15, "E": Decimal(10) ** 18,
+    "Ki": Decimal(2) ** 10, "Mi": Decimal(2) ** 20, "Gi": Decimal(2) ** 30,
+    "Ti": Decimal(2) ** 40, "Pi": Decimal(2) ** 50, "Ei": Decimal(2) ** 60,
+}
+_QUANTITY_RE = re.compile(r'^([+-]?[0-9.]+(?:[eE][+-]?[0-9]+)?)(Ki|Mi|Gi|Ti|Pi|Ei|[numkMGTPE]?)$')
+
+
+def parse_quantity(val):
+    """
+    parse kubernetes quantity like `500m`, `0.5`, `1Gi`, return None if val is not a quantity
+    """
+    if isinstance(val, bool):
+        return None
+    if isinstance(val, (int, float)):
+        return Decimal(str(val))
+    if not isinstance(val, str):
+        return None
+    m = _QUANTITY_RE.match(val.strip())
+    if m is None:
+        return None
+    try:
+        return Decimal(m.group(1)) * _QUANTITY_SUFFIXES[m.group(2)]
+    except InvalidOperation:
+        return None
+
+
+def _is_empty(val):
+    return val is None or val == {} or val == []
+
+
+def _scalar_equal(desired, live):
+    if desired == live:
+        return True
+    # apiserver canonicalizes quantities, eg: 0.5 -> 500m
+    if isinstance(desired, str) or isinstance(live, str):
+        q1, q2 = parse_quantity(desired), parse_quantity(live)
+        return q1 is not None and q1 == q2
+    return False
+
+
+def is_subset(desired, live):
+    """
+    check if every field set in desired has the same value in live,
+    the fields only exist in live(mostly defaults added by apiserver) are ignored.
+    """
+    if isinstance(desired, dict):
+        if not isinstance(live, dict):
+            return _is_empty(desired) and live is None
+        for k, v in desired.items():
+            if k not in live:
+                if _is_empty(v):
+                    continue
+                return False
+            if not is_subset(v, live[k]):
+                return False
+        return True
+    if isinstance(desired, list):
+        if not isinstance(live, list):
+            return _is_empty(desired) and live is None
+        if len(desired) != len(live):
+            return False
+        return all(is_subset(d, l) for d, l in zip(desired, live))
+    return _scalar_equal(desired, live)
+
+
+def _escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def make_json_patch(last_applied, desired, live, path=""):
+    """
+    generate JSON patch(RFC 6902) operations which change live object to desired object.
+
+    only the fields managed by KAE are considered: a field is patched when it changed since
+    last applied or it is changed by somebody else, a field is removed when it is in
+    last applied config but not in desired.
+    :param last_applied: the dict applied last time
+    :param desired: the dict we want to apply now
+    :param live: the live object dict(camelCase keys, like the output of `sanitize_for_serialization`)
+    :return: list of operations
+    """
+    ops = []
+    last_applied = last_applied if isinstance(last_applied, dict) else {}
+    live = live if isinstance(live, dict) else {}
+    for k, v in desired.items():
+        p = f"{path}/{_escape(k)}"
+        old = last_applied.get(k, _MISSING)
+        live_v = live.get(k, _MISSING)
+        if live_v is _MISSING:
+            if not _is_empty(v):
+                ops.append({"op": "add", "path": p, "value": v})
+            continue
+        if old == v and is_subset(v, live_v):
+            continue
+        if isinstance(v, dict) and isinstance(live_v, dict):
+            ops.extend(make_json_patch(old, v, live_v, p))
+        else:
+            # "add" replaces an existing member of an object
+            ops.append({"op": "add", "path": p, "value": v})
+    for k in last_applied:
+        if k not in desired and k in live:
+            ops.append({"op": "remove", "path": f"{path}/{_escape(k)}"})
+    return ops
@@ -0,0 +1,148 @@
+# coding: utf-8
+"""
+non-blocking notifications.
+
+`notify_im` and `notify_email` only put the notification to a queue of this process, a background thread
+sends them, so the websocket greenlets and the celery workers never wait for the IM bot or the SMTP server.
+the emails to the same receiver in EMAIL_DIGEST_WINDOW seconds are sent as one digest,
+and the SMTP connection is reused until it's idle for EMAIL_SMTP_IDLE_TIMEOUT seconds.
+"""
+import os
+import time
+import queue
+import atexit
+import threading
+
+from console.libs.utils import logger, spawn, im_sendmsg, send_email, SMTPConnection
+from console.config import EMAIL_DIGEST_WINDOW, EMAIL_SMTP_IDLE_TIMEOUT, NOTIFY_QUEUE_MAXSIZE
+
+_STOP = object()
+
+
+def make_digests(pending):
+    """
+    :param pending: {receiver: [(subject, text), ...]}
+    :return: list of (receivers, subject, text), the receivers having the same messages share one email
+    """
+    receivers_by_msgs = {}
+    for receiver, msgs in pending.items():
+        receivers_by_msgs.setdefault(tuple(msgs), []).append(receiver)
+
+    digests = []
+    for msgs, receivers in receivers_by_msgs.items():
+        if len(msgs) == 1:
+            subject, text = msgs[0]
+        else:
+            subject = "KAE: {} notifications".format(len(msgs))
+            text = "<hr/>".join('<h3>{}</h3>{}'.format(s, t) for s, t in msgs)
+        digests.append((sorted(receivers), subject, text))
+    return digests
+
+
+class Notifier(object):
+    def __init__(self, maxsize=NOTIFY_QUEUE_MAXSIZE, digest_window=EMAIL_DIGEST_WINDOW,
+                 idle_timeout=EMAIL_SMTP_IDLE_TIMEOUT):
+        self.maxsize = maxsize
+        self.digest_window = digest_window
+        self.idle_timeout = idle_timeout
+        self.queue = None
+        # {receiver: [(subject, text), ...]} and when the first message of the receiver was queued
+        self.pending = {}
+        self.pending_since = {}
+        self.smtp = SMTPConnection()
+        self.lck = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def _ensure_worker(self):
+        # the thread doesn't survive fork
+        if self._pid == os.getpid():
+            return
+        with self.lck:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.maxsize)
+            self.pending, self.pending_since = {}, {}
+            self.smtp = SMTPConnection()
+            self._thread = spawn(self._run)
+            self._pid = os.getpid()
+
+    def _put(self, item):
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            logger.warning("notification queue is full, drop {}".format(item[0]))
+
+    def im(self, to, content):
+        self._put(("im", to, content))
+
+    def email(self, receivers, subject, text):
+        self._put(("email", list(receivers), subject, text))
+
+    def _handle(self, item):
+        if item[0] == "im":
+            im_sendmsg(item[1], item[2])
+            return
+        _, receivers, subject, text = item
+        now = time.time()
+        for receiver in receivers:
+            self.pending.setdefault(receiver, []).append((subject, text))
+            self.pending_since.setdefault(receiver, now)
+
+    def flush_emails(self, force=False):
+        now = time.time()
+        due = {}
+        for receiver, since in list(self.pending_since.items()):
+            if force or now - since >= self.digest_window:
+                due[receiver] = self.pending.pop(receiver)
+                del self.pending_since[receiver]
+        for receivers, subject, text in make_digests(due):
+            send_email(receivers, subject, text, conn=self.smtp)
+
+    def _next_timeout(self):
+        if not self.pending_since:
+            return self.idle_timeout
+        return max(min(self.pending_since.values()) + self.digest_window - time.time(), 0)
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self._next_timeout())
+            except queue.Empty:
+                item = None
+            stop = item is _STOP
+            try:
+                if item is not None and not stop:
+                    self._handle(item)
+                self.flush_emails(force=stop)
+                if stop or time.time() - self.smtp.last_used_at >= self.idle_timeout:
+                    self.smtp.close()
+            except Exception:
+                logger.exception("error when send notification")
+            if stop:
+                return
+
+    def stop(self, timeout=10):
+        """
+        send the queued notifications before exit
+        """
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+_notifier = Notifier()
+atexit.register(_notifier.stop)
+
+
+def notify_im(to, content):
+    _notifier.im(to, content)
+
+
+def notify_email(receivers, subject, text):
+    _notifier.email(receivers, subject, text)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+run a group of dependent steps concurrently,
+every step starts as soon as all the steps it depends on succeeded.
+"""
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+class Step(object):
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+    def __repr__(self):
+        return "Step <{}>".format(self.name)
+
+
+class StepResult(object):
+    def __init__(self, name, started_at=None, duration=None, result=None, error=None, skipped=False):
+        self.name = name
+        self.started_at = started_at
+        self.duration = duration
+        self.result = result
+        self.error = error
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.error is None and not self.skipped
+
+    def to_dict(self, start_time=0):
+        return {
+            "step": self.name,
+            "start": None if self.started_at is None else round(self.started_at - start_time, 3),
+            "duration": None if self.duration is None else round(self.duration, 3),
+            "result": self.result,
+            "error": None if self.error is None else str(self.error),
+            "skipped": self.skipped,
+        }
+
+
+def _timed(step):
+    started_at = time.time()
+    try:
+        result = step.func()
+    except Exception as e:
+        return StepResult(step.name, started_at, time.time() - started_at, error=e)
+    return StepResult(step.name, started_at, time.time() - started_at, result=result)
+
+
+def run_steps(executor, steps, raise_error=True):
+    """
+    run steps on the executor, the caller thread only does the scheduling,
+    so the worker threads never wait for each other.
+    when a step fails, the steps depending on it are skipped, the independent steps still run.
+
+    :param executor: a concurrent.futures executor
+    :param steps: list of Step, the names must be unique
+    :param raise_error: re-raise the original exception of the first failed step after all steps finished,
+                        so the callers can handle it as if the steps ran sequentially
+    :return: report, list of dict in the order of steps
+    """
+    start_time = time.time()
+    names = set(s.name for s in steps)
+    for s in steps:
+        unknown = set(s.deps) - names
+        if unknown:
+            raise ValueError("{} depends on unknown steps: {}".format(s, ", ".join(sorted(unknown))))
+
+    results = {}
+    waiting = list(steps)
+    running = {}
+    while waiting or running:
+        for s in list(waiting):
+            dep_results = [results.get(d) for d in s.deps]
+            if any(r is not None and not r.ok for r in dep_results):
+                results[s.name] = StepResult(s.name, skipped=True)
+                waiting.remove(s)
+            elif all(r is not None for r in dep_results):
+                running[executor.submit(_timed, s)] = s
+                waiting.remove(s)
+        if not running:
+            if waiting:
+                raise ValueError("dependency cycle in steps: {}".format(waiting))
+            break
+        done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+        for fut in done:
+            s = running.pop(fut)
+            results[s.name] = fut.result()
+
+    report = [results[s.name].to_dict(start_time) for s in steps]
+    if raise_error:
+        failed = sorted((r for r in results.values() if r.error is not None), key=lambda r: r.started_at)
+        if failed:
+            raise failed[0].error
+    return report
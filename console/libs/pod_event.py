@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+encoding of the pod events sent to the websocket clients.
+
+compact: only the fields shown by the UI, with the same layout as `V1Pod.to_dict()`
+delta: the fields changed since the last event of the same pod
+full: the whole `V1Pod.to_dict()`
+"""
+
+FORMAT_COMPACT = "compact"
+FORMAT_DELTA = "delta"
+FORMAT_FULL = "full"
+POD_EVENT_FORMATS = (FORMAT_COMPACT, FORMAT_DELTA, FORMAT_FULL)
+
+_CONTAINER_STATUS_FIELDS = {
+    "name": True,
+    "image": True,
+    "ready": True,
+    "started": True,
+    "restart_count": True,
+    "state": True,
+    "last_state": True,
+}
+
+# True means the whole value, a dict means the fields of the value(or of every item if the value is a list)
+COMPACT_POD_FIELDS = {
+    "metadata": {
+        "name": True,
+        "namespace": True,
+        "uid": True,
+        "labels": True,
+        "resource_version": True,
+        "creation_timestamp": True,
+        "deletion_timestamp": True,
+    },
+    "spec": {
+        "node_name": True,
+    },
+    "status": {
+        "phase": True,
+        "reason": True,
+        "message": True,
+        "host_ip": True,
+        "pod_ip": True,
+        "start_time": True,
+        "conditions": {
+            "type": True,
+            "status": True,
+        },
+        "init_container_statuses": _CONTAINER_STATUS_FIELDS,
+        "container_statuses": _CONTAINER_STATUS_FIELDS,
+    },
+}
+
+
+def _to_plain(val):
+    if hasattr(val, "to_dict"):
+        return val.to_dict()
+    if isinstance(val, list):
+        return [_to_plain(item) for item in val]
+    return val
+
+
+def _project(val, fields):
+    if fields is True:
+        return _to_plain(val)
+    if isinstance(val, list):
+        return [_project(item, fields) for item in val]
+    if isinstance(val, dict):
+        get = val.get
+    elif hasattr(val, "to_dict"):
+        # kubernetes model, only the projected fields are converted
+        get = lambda k: getattr(val, k, None)  # noqa: E731
+    else:
+        return val
+    result = {}
+    for k, sub in fields.items():
+        v = get(k)
+        if v is not None:
+            result[k] = _project(v, sub)
+    return result
+
+
+def compact_pod(pod):
+    """
+    :param pod: V1Pod or the dict returned by `V1Pod.to_dict()`
+    """
+    return _project(pod, COMPACT_POD_FIELDS)
+
+
+def make_delta(old, new):
+    """
+    the fields of new which are different from old, a removed field is set to None,
+    lists are always sent as a whole.
+    """
+    delta = {}
+    for k, v in new.items():
+        old_v = old.get(k)
+        if old_v == v:
+            continue
+        if isinstance(v, dict) and isinstance(old_v, dict):
+            delta[k] = make_delta(old_v, v)
+        else:
+            delta[k] = v
+    for k in old:
+        if k not in new:
+            delta[k] = None
+    return delta
+
+
+class PodDeltaEncoder(object):
+    """
+    encode the compact pod events of one websocket client in delta format,
+    it remembers the last version of every pod sent to the client.
+    """
+    def __init__(self):
+        self.pods = {}
+
+    def encode(self, action, pod):
+        uid = pod.get("metadata", {}).get("uid")
+        if action == "DELETED":
+            self.pods.pop(uid, None)
+            return {"action": action, "uid": uid, "object": {"metadata": pod.get("metadata", {})}}
+
+        old = self.pods.get(uid)
+        self.pods[uid] = pod
+        if old is None:
+            return {"action": action, "uid": uid, "object": pod}
+        return {"action": action, "uid": uid, "delta": make_delta(old, pod)}
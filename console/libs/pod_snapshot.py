@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+the current pods of every app maintained by the pod watcher in redis.
+
+every app has a hash of pod uid -> compact pod, and the resource version the hash is up to date with.
+the watcher changes the hash and publishes the event in one transaction,
+so a client which subscribes the channel before it reads the snapshot neither misses nor duplicates events:
+it just skips the events whose resource version is not newer than the snapshot.
+"""
+import json
+
+from console.ext import rds
+from console.config import POD_WATCHER_LEASE_TTL
+
+RESOURCE_VERSION_FIELD = "__resource_version__"
+# the snapshots of a cluster are only used when its watcher refreshed this mark recently,
+# the owner of the cluster refreshes it when it receives events or bookmarks(the apiserver sends
+# a bookmark about every minute), a hung watch stops refreshing it.
+SYNCED_TTL = POD_WATCHER_LEASE_TTL * 3
+
+
+def make_snapshot_key(cluster, appname):
+    return "kae-pods-snapshot:{}:app:{}".format(cluster, appname)
+
+
+def make_synced_key(cluster):
+    return "kae-pods-snapshot:{}:synced".format(cluster)
+
+
+def mark_synced(cluster):
+    rds.set(make_synced_key(cluster), 1, ex=SYNCED_TTL)
+
+
+def iter_snapshot_keys(cluster):
+    for key in rds.scan_iter(match=make_snapshot_key(cluster, "*"), count=500):
+        yield key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+def parse_resource_version(rv):
+    try:
+        return int(rv)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_newer(rv, base_rv):
+    """
+    resource versions are opaque strings in kubernetes API, but they are etcd revisions in practice,
+    if they can't be compared, the event is considered newer.
+    """
+    rv, base_rv = parse_resource_version(rv), parse_resource_version(base_rv)
+    if rv is None or base_rv is None:
+        return True
+    return rv > base_rv
+
+
+def load_snapshot(cluster, appname):
+    """
+    :return: (resource version, list of compact pods), or None when the snapshot can't be trusted
+    """
+    if not rds.exists(make_synced_key(cluster)):
+        return None
+    data = rds.hgetall(make_snapshot_key(cluster, appname))
+    rv = data.pop(RESOURCE_VERSION_FIELD.encode('utf-8'), None)
+    if rv is None:
+        # the watcher hasn't seen any pod of this app
+        return None
+    return rv.decode('utf-8'), [json.loads(v) for v in data.values()]
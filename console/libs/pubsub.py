@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+one redis pubsub connection per worker process shared by all the local subscribers.
+
+the channels are subscribed on demand and unsubscribed when the last local subscriber leaves,
+every subscriber has its own bounded queue, so a slow websocket client never blocks the others.
+"""
+import os
+from collections import deque, OrderedDict, defaultdict
+
+import gevent
+from gevent.event import Event
+from redis.exceptions import ConnectionError
+
+from console.libs.utils import logger
+from console.ext import rds
+from console.config import PUBSUB_QUEUE_MAXSIZE
+
+
+class Subscription(object):
+    """
+    messages of some channels for one local subscriber.
+
+    when the queue is full, the messages with the same coalesce key are merged(only the newest one is kept),
+    if it is still full, the oldest messages are dropped.
+    """
+    def __init__(self, mux, maxsize=PUBSUB_QUEUE_MAXSIZE, coalesce_key=None):
+        self.mux = mux
+        self.maxsize = maxsize
+        self.coalesce_key = coalesce_key
+        self.channels = set()
+        self.messages = deque()
+        self.dropped = 0
+        self._event = Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def subscribe(self, *channels):
+        self.mux.subscribe(self, channels)
+
+    def unsubscribe(self, *channels):
+        self.mux.unsubscribe(self, channels or list(self.channels))
+
+    def close(self):
+        if self.dropped > 0:
+            logger.info("subscriber of {} dropped {} messages".format(self.channels, self.dropped))
+        self.unsubscribe()
+
+    def _coalesce(self):
+        latest = OrderedDict()
+        for channel, data in self.messages:
+            try:
+                key = self.coalesce_key(data)
+            except Exception:
+                key = None
+            # the messages without key are never merged
+            key = (channel, key) if key is not None else object()
+            latest.pop(key, None)
+            latest[key] = (channel, data)
+        self.dropped += len(self.messages) - len(latest)
+        self.messages = deque(latest.values())
+
+    def put(self, channel, data):
+        if self.maxsize and len(self.messages) >= self.maxsize:
+            if self.coalesce_key is not None:
+                self._coalesce()
+            while len(self.messages) >= self.maxsize:
+                self.messages.popleft()
+                self.dropped += 1
+        self.messages.append((channel, data))
+        self._event.set()
+
+    def get(self, timeout=None):
+        """
+        :return: (channel, data) or None when timeout
+        """
+        if not self.messages:
+            self._event.clear()
+            self._event.wait(timeout)
+        if not self.messages:
+            return None
+        return self.messages.popleft()
+
+
+class PubSubMultiplexer(object):
+    def __init__(self, redis_client):
+        self.rds = redis_client
+        self.pubsub = None
+        # channel -> local subscriptions
+        self.subscribers = defaultdict(set)
+        self._greenlet = None
+
+    def subscription(self, channels, **kwargs):
+        sub = Subscription(self, **kwargs)
+        sub.subscribe(*channels)
+        return sub
+
+    def subscribe(self, sub, channels):
+        new_channels = []
+        for channel in channels:
+            if not self.subscribers[channel]:
+                new_channels.append(channel)
+            self.subscribers[channel].add(sub)
+            sub.channels.add(channel)
+        if new_channels:
+            if self.pubsub is None:
+                self.pubsub = self.rds.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(*new_channels)
+            if self._greenlet is None or self._greenlet.dead:
+                self._greenlet = gevent.spawn(self._run)
+
+    def unsubscribe(self, sub, channels):
+        empty_channels = []
+        for channel in channels:
+            sub.channels.discard(channel)
+            subs = self.subscribers.get(channel)
+            if subs is None:
+                continue
+            subs.discard(sub)
+            if not subs:
+                del self.subscribers[channel]
+                empty_channels.append(channel)
+        if empty_channels and self.pubsub is not None:
+            try:
+                self.pubsub.unsubscribe(*empty_channels)
+            except ConnectionError:
+                # the channels are not re-subscribed on reconnect, since they are removed from pubsub.channels
+                logger.warn("can't unsubscribe {}".format(empty_channels))
+
+    def dispatch(self, channel, data):
+        if isinstance(channel, bytes):
+            channel = channel.decode('utf-8')
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        for sub in list(self.subscribers.get(channel, ())):
+            sub.put(channel, data)
+
+    def _run(self):
+        while True:
+            try:
+                msg = self.pubsub.get_message(timeout=30)
+            except ConnectionError:
+                # redis-py reconnects and subscribes the channels again on next read
+                logger.warn("pubsub connection error, reconnect")
+                gevent.sleep(1)
+                continue
+            except Exception:
+                logger.exception("pubsub multiplexer error")
+                gevent.sleep(1)
+                continue
+            if msg is not None and msg['type'] == 'message':
+                self.dispatch(msg['channel'], msg['data'])
+
+
+_MULTIPLEXER = None
+_MULTIPLEXER_PID = None
+
+
+def get_pubsub_multiplexer():
+    global _MULTIPLEXER, _MULTIPLEXER_PID
+    # the multiplexer can't be shared by forked processes
+    if _MULTIPLEXER is None or _MULTIPLEXER_PID != os.getpid():
+        _MULTIPLEXER = PubSubMultiplexer(rds)
+        _MULTIPLEXER_PID = os.getpid()
+    return _MULTIPLEXER
@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+validated app specs cached by the sha256 of the specs text.
+
+the key is derived from the content and the version of the schema, so the entries never need invalidation,
+they are kept in a local LRU and in redis, so every distinct specs text is parsed
+by `yaml.safe_load` and `app_specs_schema.load` once in all workers.
+"""
+import hashlib
+import pickle
+
+import yaml
+import pkg_resources
+
+from console.ext import rds
+from console.libs.cache import LocalCache, SingleFlight, ONE_DAY
+from console.libs.utils import logger
+from kaelib.spec import app_specs_schema
+
+# bump it when the specs loaded by the same kaelib change, e.g. the console adds fields to them
+SPECS_CACHE_VERSION = 1
+
+# the specs are stored pickled, every caller gets its own copy which it may modify
+_local_specs = LocalCache(maxsize=256, ttl=ONE_DAY)
+_single_flight = SingleFlight()
+
+
+def _get_kaelib_version():
+    try:
+        return pkg_resources.get_distribution('kaelib').version
+    except pkg_resources.DistributionNotFound:
+        return 'unknown'
+
+
+# the workers running another kaelib don't share the pickled specs
+_schema_version = '{}-{}'.format(_get_kaelib_version(), SPECS_CACHE_VERSION)
+
+
+def make_specs_cache_key(specs_text):
+    digest = hashlib.sha256(specs_text.encode('utf-8')).hexdigest()
+    return 'console:specs:{}:{}'.format(_schema_version, digest)
+
+
+def _parse(key, specs_text):
+    data = rds.get(key)
+    if data is not None:
+        return data
+    specs = app_specs_schema.load(yaml.safe_load(specs_text)).data
+    try:
+        data = pickle.dumps(specs)
+    except Exception:
+        logger.exception("can't pickle specs, skip cache")
+        return specs
+    rds.set(key, data, ex=ONE_DAY)
+    return data
+
+
+def load_specs(specs_text):
+    """
+    the same as `app_specs_schema.load(yaml.safe_load(specs_text)).data`,
+    raises yaml.YAMLError or ValidationError when the specs text is invalid(errors are not cached).
+    """
+    key = make_specs_cache_key(specs_text)
+    data = _local_specs.get(key)
+    if data is None:
+        data = _single_flight.do(key, lambda: _parse(key, specs_text))
+        if not isinstance(data, bytes):
+            return data
+        _local_specs.set(key, data)
+    try:
+        return pickle.loads(data)
+    except Exception:
+        logger.exception("can't unpickle cached specs {}, parse them again".format(key))
+        _local_specs.delete(key)
+        rds.delete(key)
+        return app_specs_schema.load(yaml.safe_load(specs_text)).data
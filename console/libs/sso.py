@@ -1,16 +1,81 @@
-import threading
+import os
+import json
 import copy
 import time
+import uuid
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
+
+import redis_lock
+from redis import StrictRedis
 from keycloak import KeycloakOpenID, KeycloakAdmin
-from keycloak.exceptions import KeycloakError
+from keycloak.exceptions import KeycloakError, KeycloakGetError, raise_error_from_response
 from console.libs.utils import spawn, logger
 from console.config import (
     SSO_HOST, KEYCLOAK_ADMIN_USER, KEYCLOAK_ADMIN_PASSWD,
-    SSO_REALM, FAKE_USER,
+    SSO_REALM, FAKE_USER, REDIS_URL,
+    SSO_INCREMENTAL_SYNC, SSO_SYNC_INTERVAL, SSO_FULL_SYNC_INTERVAL,
 )
 
-REFRESH_INTERVAL = 300
+SNAPSHOT_KEY = "console:sso:snapshot"
+SNAPSHOT_VERSION_KEY = "console:sso:snapshot-version"
+SYNCED_AT_KEY = "console:sso:synced-at"
+SYNC_LEASE_NAME = "console:sso:sync"
+# the admin events which may change the users, groups or group members
+EVENT_RESOURCE_TYPES = ["USER", "GROUP", "GROUP_MEMBERSHIP"]
+EVENTS_PAGE_SIZE = 500
+
+
+class SSOSnapshot(object):
+    """
+    users and groups with the secondary indexes, it is never changed after creation,
+    so the readers don't need any lock, the SSO swaps in a new snapshot on refresh.
+    """
+    def __init__(self, user_map=None, group_map=None):
+        self.user_map = user_map or {}
+        self.group_map = group_map or {}
+        self.groups_by_name = {}
+        for grp in self.group_map.values():
+            # keep the first one like the linear scan did
+            self.groups_by_name.setdefault(grp['name'], grp)
+        self.groups_by_user = {}
+        self.members_by_group = {g_id: [] for g_id in self.group_map}
+        for username, user in self.user_map.items():
+            groups = []
+            for g_id in user.get('group_ids', []):
+                grp = self.group_map.get(g_id)
+                if grp is None:
+                    continue
+                groups.append(grp)
+                self.members_by_group[g_id].append(user)
+            self.groups_by_user[username] = groups
+
+    def get_groups(self):
+        return self.group_map.values()
+
+    def get_group(self, group_id):
+        return self.group_map.get(group_id)
+
+    def get_group_by_name(self, name):
+        return self.groups_by_name.get(name)
+
+    def get_groups_by_user(self, username):
+        groups = self.groups_by_user.get(username)
+        if groups is None:
+            return None
+        return list(groups)
+
+    def get_group_members(self, group_id):
+        members = self.members_by_group.get(group_id)
+        if members is None:
+            return None
+        return list(members)
+
+    def get_user(self, username):
+        return self.user_map.get(username)
+
+    def get_users(self):
+        return self.user_map.values()
 
 
 class AdminWrapper(object):
@@ -38,6 +103,12 @@ class AdminWrapper(object):
 
 
 class SSO(object):
+    """
+    cache of the users and groups of keycloak.
+
+    only the process holding the sync lease talks to keycloak, it publishes the result as a snapshot in redis,
+    the other processes just load the snapshot when its version changes.
+    """
     _INSTANCE = None
 
     def __init__(self, host_or_url, admin_user, admin_passwd, realm="kae", admin_realm="master"):
@@ -46,7 +117,7 @@ class SSO(object):
             # url is a host
             url = f'https://{host_or_url}/auth/'
         else:
-            url = host_or_url    
+            url = host_or_url
         self._admin = AdminWrapper(server_url=url,
                                    username=admin_user,
                                    password=admin_passwd,
@@ -54,10 +125,35 @@ class SSO(object):
                                    realm_name=realm,
                                    verify=True,
                                    auto_refresh_token=['get', 'put', 'post', 'delete'])
-        self.user_map, self.group_map = {}, {}
-        self.lck = threading.Lock()
-        # refresh first
-        self.refresh()
+        self.realm = realm
+        # replaced as a whole, never changed in place
+        self.snapshot = SSOSnapshot()
+
+        self.rds = StrictRedis.from_url(REDIS_URL)
+        self.lease = redis_lock.Lock(self.rds, SYNC_LEASE_NAME, expire=SSO_SYNC_INTERVAL * 3,
+                                     id="{}-{}".format(os.getpid(), uuid.uuid4().hex))
+        self.snapshot_version = None
+        # when the snapshot was made by a full sync or updated by an incremental sync
+        self.synced_at = None
+        self.full_synced_at = 0
+        # the admin events after this time(in milliseconds) haven't been applied
+        self.last_event_time = None
+        self.stats = {
+            "leader": False,
+            "last_refresh_mode": None,
+            "last_refresh_duration": None,
+            "full_refreshes": 0,
+            "incremental_refreshes": 0,
+        }
+
+        # load the shared snapshot first, only talk to keycloak when nobody has synced
+        try:
+            loaded = self.load_snapshot()
+        except Exception:
+            logger.exception("can't load sso snapshot")
+            loaded = False
+        if not loaded:
+            self.refresh(publish=self._hold_lease())
 
         spawn(self._refresh_thread_func)
 
@@ -70,12 +166,38 @@ class SSO(object):
     def _refresh_thread_func(self, *args, **kwargs):
         logger.info("starting sso refresher thread")
         while True:
-            logger.debug("refresh sso cache.")
+            time.sleep(SSO_SYNC_INTERVAL)
             try:
-                self.refresh()
+                self.sync()
             except Exception:
-                logger.exception("error when refresh sso, retry...")
-            time.sleep(REFRESH_INTERVAL)
+                logger.exception("error when sync sso, retry...")
+
+    def _hold_lease(self):
+        try:
+            self.lease.extend()
+            held = True
+        except redis_lock.NotAcquired:
+            held = self.lease.acquire(blocking=False)
+        except Exception:
+            logger.exception("can't get sso sync lease")
+            held = False
+        self.stats["leader"] = held
+        return held
+
+    def sync(self):
+        # the leader may have changed, so always start from the newest snapshot
+        self.load_snapshot()
+        if not self._hold_lease():
+            return
+
+        if time.time() - self.full_synced_at >= SSO_FULL_SYNC_INTERVAL or self.last_event_time is None:
+            self.refresh()
+        elif SSO_INCREMENTAL_SYNC:
+            try:
+                self.refresh_incremental()
+            except KeycloakError:
+                logger.exception("incremental sso sync failed, fall back to full sync")
+                self.refresh()
 
     def _fetch_all_user_group(self):
         group_map = {}
@@ -109,40 +231,170 @@ class SSO(object):
                 handle_group(grp)
         return user_map, group_map
 
+    def _fetch_admin_events(self, since):
+        """
+        the admin events about users and groups after the time(in milliseconds)
+        """
+        conn = self._admin.connection
+        url = "admin/realms/{}/admin-events".format(self.realm)
+        # dateFrom only has the precision of day
+        date_from = (datetime.utcfromtimestamp(since / 1000) - timedelta(days=1)).strftime("%Y-%m-%d")
+        events = []
+        first = 0
+        while True:
+            page = raise_error_from_response(
+                conn.raw_get(url, dateFrom=date_from, resourceTypes=EVENT_RESOURCE_TYPES,
+                             first=first, max=EVENTS_PAGE_SIZE),
+                KeycloakGetError)
+            new_events = [ev for ev in page if ev.get('time', 0) > since]
+            events.extend(new_events)
+            # the events are sorted by time desc
+            if len(page) < EVENTS_PAGE_SIZE or len(new_events) < len(page):
+                break
+            first += EVENTS_PAGE_SIZE
+        return events
+
+    def _record_refresh(self, mode, started_at):
+        duration = time.time() - started_at
+        self.stats["last_refresh_mode"] = mode
+        self.stats["last_refresh_duration"] = duration
+        self.stats["{}_refreshes".format(mode)] += 1
+        logger.info("sso {} refresh took {:.3f}s".format(mode, duration))
+
+    def refresh(self, publish=True):
+        """
+        fetch all the users and groups, and publish them as the snapshot
+        """
+        started_at = time.time()
+        # events are applied again by the next incremental sync, it's harmless,
+        # the margin covers the clock skew between keycloak and us.
+        since = int((started_at - 60) * 1000)
+        user_map, group_map = self._fetch_all_user_group()
+        self.snapshot = SSOSnapshot(user_map, group_map)
+        self.synced_at = self.full_synced_at = started_at
+        self.last_event_time = since
+        if publish:
+            self._publish()
+        self._record_refresh("full", started_at)
+
+    def refresh_incremental(self):
+        """
+        only fetch the users changed by the admin events since the last sync,
+        a change of groups needs a full sync, since the members of the sub groups may be changed.
+        """
+        started_at = time.time()
+        events = self._fetch_admin_events(self.last_event_time)
+        if not events:
+            # nothing changed, don't make the other processes reload the snapshot
+            self.synced_at = started_at
+            self.rds.set(SYNCED_AT_KEY, started_at)
+            self._record_refresh("incremental", started_at)
+            return
+
+        user_ids = set()
+        for ev in events:
+            if ev.get('resourceType') == "GROUP":
+                self.refresh()
+                return
+            parts = (ev.get('resourcePath') or '').split('/')
+            # users/{id} or users/{id}/groups/{group id}
+            if len(parts) >= 2 and parts[0] == "users":
+                user_ids.add(parts[1])
+
+        snapshot = self.snapshot
+        user_map = dict(snapshot.user_map)
+        username_by_id = {u.get('id'): name for name, u in user_map.items()}
+        for user_id in user_ids:
+            old_name = username_by_id.get(user_id)
+            if old_name is not None:
+                user_map.pop(old_name, None)
+            try:
+                user = self._admin.get_user(user_id)
+            except KeycloakGetError as e:
+                if e.response_code == 404:
+                    # the user is deleted
+                    continue
+                raise
+            user['group_ids'] = [grp['id'] for grp in self._admin.get_user_groups(user_id)]
+            user_map[user['username']] = user
+
+        self.snapshot = SSOSnapshot(user_map, snapshot.group_map)
+        self.synced_at = started_at
+        self.last_event_time = max(ev.get('time', 0) for ev in events)
+        self._publish()
+        self._record_refresh("incremental", started_at)
+
+    def _publish(self):
+        snapshot = self.snapshot
+        data = json.dumps({
+            "users": snapshot.user_map,
+            "groups": snapshot.group_map,
+            "synced_at": self.synced_at,
+            "full_synced_at": self.full_synced_at,
+            "last_event_time": self.last_event_time,
+        })
+        pipe = self.rds.pipeline()
+        pipe.set(SNAPSHOT_KEY, data)
+        pipe.set(SYNCED_AT_KEY, self.synced_at)
+        pipe.incr(SNAPSHOT_VERSION_KEY)
+        _, _, self.snapshot_version = pipe.execute()
+
+    def load_snapshot(self):
+        """
+        :return: False if there is no snapshot
+        """
+        version, synced_at = self.rds.mget(SNAPSHOT_VERSION_KEY, SYNCED_AT_KEY)
+        if version is None:
+            return False
+        if int(version) == self.snapshot_version:
+            if synced_at is not None:
+                self.synced_at = max(self.synced_at or 0, float(synced_at))
+            return True
+
+        pipe = self.rds.pipeline()
+        pipe.get(SNAPSHOT_VERSION_KEY)
+        pipe.get(SNAPSHOT_KEY)
+        version, data = pipe.execute()
+        if data is None:
+            return False
+        snapshot = json.loads(data)
+        self.snapshot = SSOSnapshot(snapshot["users"], snapshot["groups"])
+        self.snapshot_version = int(version)
+        self.synced_at = snapshot["synced_at"]
+        self.full_synced_at = snapshot["full_synced_at"]
+        self.last_event_time = snapshot["last_event_time"]
+        return True
+
+    def get_stats(self):
+        """
+        metrics of the sync, staleness is the seconds since the data of this process was fetched from keycloak
+        """
+        stats = dict(self.stats)
+        stats["snapshot_version"] = self.snapshot_version
+        stats["staleness"] = None if self.synced_at is None else time.time() - self.synced_at
+        stats["full_sync_staleness"] = time.time() - self.full_synced_at if self.full_synced_at else None
+        return stats
+
     def get_groups(self):
-        with self.lck:
-            return self.group_map.values()
+        return self.snapshot.get_groups()
 
     def get_group(self, group_id):
-        with self.lck:
-            return self.group_map.get(group_id)
+        return self.snapshot.get_group(group_id)
 
     def get_group_by_name(self, name):
-        with self.lck:
-            for grp in self.group_map.values():
-                if grp['name'] == name:
-                    return grp
+        return self.snapshot.get_group_by_name(name)
 
     def get_groups_by_user(self, username):
-        with self.lck:
-            user = self.user_map.get(username)
-            if user is None:
-                return None
-            group_ids = user['group_ids']
-            return [self.group_map[g_id] for g_id in group_ids]
+        return self.snapshot.get_groups_by_user(username)
+
+    def get_group_members(self, group_id):
+        return self.snapshot.get_group_members(group_id)
 
     def get_user(self, username):
-        with self.lck:
-            return self.user_map.get(username)
+        return self.snapshot.get_user(username)
 
     def get_users(self):
-        with self.lck:
-            return self.user_map.values()
-
-    def refresh(self):
-        user_map, group_map = self._fetch_all_user_group()
-        with self.lck:
-            self.user_map, self.group_map = user_map, group_map
+        return self.snapshot.get_users()
 
 
 class SSOMocker(object):
@@ -183,6 +435,11 @@ class SSOMocker(object):
         group_ids = user['group_ids']
         return [self.group_map[g_id] for g_id in group_ids]
 
+    def get_group_members(self, group_id):
+        if group_id not in self.group_map:
+            return None
+        return [u for u in self.user_map.values() if group_id in u['group_ids']]
+
     def get_user(self, username):
         return self.user_map.get(username)
 
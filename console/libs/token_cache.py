@@ -0,0 +1,125 @@
+# coding: utf-8
+"""
+cache of the bearer token validation, so keycloak isn't called on every request.
+
+the results are keyed by the sha256 of the token and the required scopes,
+kept in a local LRU and in redis, a valid token is never cached after it expires.
+"""
+import json
+import time
+import hashlib
+import threading
+
+import requests
+from flask import g
+from jose import jwt, JWTError
+
+from console.ext import rds, oidc
+from console.libs.cache import LocalCache
+from console.libs.utils import logger
+from console.config import (
+    SSO_HOST, SSO_REALM, SSO_CLIENT_ID,
+    OIDC_TOKEN_CACHE_MAX_TTL, OIDC_TOKEN_NEGATIVE_CACHE_TTL, OIDC_OFFLINE_VALIDATION, OIDC_JWKS_CACHE_TTL,
+)
+
+_local_results = LocalCache(maxsize=4096, ttl=OIDC_TOKEN_CACHE_MAX_TTL)
+_jwks = {'keys': None, 'fetched_at': 0}
+_jwks_lck = threading.Lock()
+
+
+def make_token_cache_key(token, scopes_required=None):
+    h = hashlib.sha256(token.encode('utf-8'))
+    if scopes_required:
+        h.update(' '.join(sorted(scopes_required)).encode('utf-8'))
+    return 'console:token:{}'.format(h.hexdigest())
+
+
+def _realm_url():
+    return f"https://{SSO_HOST}/auth/realms/{SSO_REALM}"
+
+
+def _get_jwks(force=False):
+    with _jwks_lck:
+        if force or _jwks['keys'] is None or time.time() - _jwks['fetched_at'] > OIDC_JWKS_CACHE_TTL:
+            resp = requests.get(_realm_url() + "/protocol/openid-connect/certs", timeout=10)
+            resp.raise_for_status()
+            _jwks['keys'] = resp.json()
+            _jwks['fetched_at'] = time.time()
+        return _jwks['keys']
+
+
+def _validate_offline(token, scopes_required=None):
+    """
+    :return: (validity, token info), validity is True or an error message like `oidc.validate_token`
+    """
+    try:
+        kid = jwt.get_unverified_header(token).get('kid')
+        jwks = _get_jwks()
+        if kid not in {k.get('kid') for k in jwks.get('keys', [])}:
+            # the keys may have been rotated
+            jwks = _get_jwks(force=True)
+        token_info = jwt.decode(token, jwks, algorithms=['RS256'], issuer=_realm_url(),
+                                options={'verify_aud': False})
+    except JWTError as e:
+        return 'Token not valid: {}'.format(e), None
+
+    # the signature is valid for all the tokens of the realm, only the access tokens for us are accepted,
+    # e.g. the ID tokens have typ "ID"
+    if token_info.get('typ') != 'Bearer':
+        return 'Token not valid: not an access token', None
+    aud = token_info.get('aud') or []
+    if isinstance(aud, str):
+        aud = [aud]
+    if token_info.get('azp') != SSO_CLIENT_ID and SSO_CLIENT_ID not in aud:
+        return 'Token not valid: issued for another client', None
+
+    if scopes_required:
+        token_scopes = token_info.get('scope', '').split(' ')
+        if not set(scopes_required).issubset(set(token_scopes)):
+            return 'Token does not have required scopes', None
+    # the introspection result has username, the access token only has preferred_username
+    token_info.setdefault('username', token_info.get('preferred_username'))
+    return True, token_info
+
+
+def _validate(token, scopes_required=None):
+    if OIDC_OFFLINE_VALIDATION:
+        try:
+            return _validate_offline(token, scopes_required)
+        except requests.RequestException:
+            logger.exception("can't fetch jwks, fall back to token introspection")
+
+    validity = oidc.validate_token(token, scopes_required)
+    if validity is True:
+        return True, g.oidc_token_info
+    return validity, None
+
+
+def validate_token(token, scopes_required=None):
+    """
+    the same as `oidc.validate_token`: returns True or an error message, and sets `g.oidc_token_info` if valid.
+    """
+    key = make_token_cache_key(token, scopes_required)
+    result = _local_results.get(key)
+    if result is None:
+        cached = rds.get(key)
+        if cached is not None:
+            result = json.loads(cached)
+
+    # the ttl of redis is rounded to seconds, so check the expire time too
+    if result is None or result['expire_at'] <= time.time():
+        validity, token_info = _validate(token, scopes_required)
+        if validity is True:
+            ttl = OIDC_TOKEN_CACHE_MAX_TTL
+            if token_info.get('exp') is not None:
+                ttl = min(ttl, int(token_info['exp'] - time.time()))
+        else:
+            ttl = OIDC_TOKEN_NEGATIVE_CACHE_TTL
+        result = {'validity': validity, 'token_info': token_info, 'expire_at': time.time() + ttl}
+        if ttl > 0:
+            rds.set(key, json.dumps(result), ex=ttl)
+
+    _local_results.set(key, result, result['expire_at'] - time.time())
+    if result['validity'] is True:
+        g.oidc_token_info = result['token_info']
+    return result['validity']
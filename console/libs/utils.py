@@ -5,7 +5,6 @@ import time
 import json
 import string
 import random
-import shutil
 import logging
 import urllib.request
 import smtplib
@@ -16,18 +15,17 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.utils import COMMASPACE, formatdate
 from email.encoders import encode_base64
-from subprocess import Popen, PIPE, STDOUT, run, CalledProcessError
 
 import semver
+import requests
 
-import docker
 from flask import session
 from functools import wraps
 
 from console.config import (
     BOT_WEBHOOK_URL, LOGGER_NAME, DEBUG, DEFAULT_REGISTRY,
-    REPO_DATA_DIR, EMAIL_SENDER, EMAIL_SENDER_PASSWOORD,
-    CLUSTER_CFG, PROTECTED_CLUSTER, DOCKER_HOST, 
+    EMAIL_SENDER, EMAIL_SENDER_PASSWOORD, EMAIL_SMTP_SERVER, EMAIL_SMTP_PORT,
+    CLUSTER_CFG, PROTECTED_CLUSTER, 
 )
 from console.libs.jsonutils import VersatileEncoder
 
@@ -101,8 +99,7 @@ def send_get_json_request(url, headers=None):
     return res.getcode(), data
 
 
-def send_email(receivers, subject, text, sender=EMAIL_SENDER, password=EMAIL_SENDER_PASSWOORD,
-               files=None, server="smtp.exmail.qq.com", port=smtplib.SMTP_SSL_PORT, timeout=60):
+def make_email(receivers, subject, text, sender=EMAIL_SENDER, files=None):
     msg = MIMEMultipart()
     msg['Subject'] = subject
     msg['From'] = sender
@@ -117,13 +114,67 @@ def send_email(receivers, subject, text, sender=EMAIL_SENDER, password=EMAIL_SEN
 
             part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(fname))
             msg.attach(part)
+    return msg
+
+
+class SMTPConnection(object):
+    """
+    a logged in SMTP connection reused by the emails, it reconnects when the server closes it.
+    """
+    def __init__(self, sender=EMAIL_SENDER, password=EMAIL_SENDER_PASSWOORD,
+                 server=EMAIL_SMTP_SERVER, port=EMAIL_SMTP_PORT, timeout=60):
+        self.sender = sender
+        self.password = password
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self._smtp = None
+        self.last_used_at = 0
+
+    def _connect(self):
+        s = smtplib.SMTP_SSL(self.server, self.port, timeout=self.timeout)
+        s.login(self.sender, self.password)
+        return s
+
+    def sendmail(self, receivers, msg):
+        if self._smtp is None:
+            self._smtp = self._connect()
+        try:
+            self._smtp.sendmail(self.sender, receivers, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            self._smtp = self._connect()
+            self._smtp.sendmail(self.sender, receivers, msg.as_string())
+        self.last_used_at = time.time()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except SMTPException:
+            pass
+        except OSError:
+            pass
+        self._smtp = None
+
+
+def send_email(receivers, subject, text, sender=EMAIL_SENDER, password=EMAIL_SENDER_PASSWOORD,
+               files=None, server=EMAIL_SMTP_SERVER, port=EMAIL_SMTP_PORT, timeout=60, conn=None):
+    """
+    send email synchronously, pass a SMTPConnection as conn to reuse the connection
+    """
+    msg = make_email(receivers, subject, text, sender, files)
 
     logger.info("sending email..")
     try:
-        s = smtplib.SMTP_SSL(server, port, timeout=timeout)
-        s.login(sender, password)
-        s.sendmail(sender, receivers, msg.as_string())
-        s.close()
+        if conn is None:
+            conn = SMTPConnection(sender, password, server, port, timeout)
+            try:
+                conn.sendmail(receivers, msg)
+            finally:
+                conn.close()
+        else:
+            conn.sendmail(receivers, msg)
         logger.info("Sent email successfully")
         return True
     except SMTPException as e:
@@ -134,6 +185,9 @@ def send_email(receivers, subject, text, sender=EMAIL_SENDER, password=EMAIL_SEN
         return False
 
 
+_im_session = requests.Session()
+
+
 def im_sendmsg(to, content):
     """
     send message to IM app(currently use feishu)
@@ -152,12 +206,10 @@ def im_sendmsg(to, content):
         "text": content,
         "group": to,
     }
-    headers = {
-        'Connection': 'close',
-    }
     try:
-        code, res = send_post_json_request(BOT_WEBHOOK_URL, data, headers)
-        return res
+        # keep-alive connections to the bot
+        resp = _im_session.post(BOT_WEBHOOK_URL, json=data, timeout=10)
+        return resp.json()
     except:
         logger.exception('Send im msg failed')
         return
@@ -317,8 +369,14 @@ def get_dfs_host_dir(cluster):
     return cluster_info.get("dfs_host_dir", None)
 
 
-def make_app_watcher_channel_name(cluster, appname):
-    return "kae-cluster-{}-app-{}-pods-watcher".format(cluster, appname)
+def make_app_watcher_channel_name(cluster, appname, full=False):
+    """
+    the pod events of an app are published in compact format, and also in full format if full channel has subscribers
+    """
+    name = "kae-cluster-{}-app-{}-pods-watcher".format(cluster, appname)
+    if full:
+        name += "-full"
+    return name
 
 
 def make_errmsg(msg, jsonize=False):
@@ -329,10 +387,12 @@ def make_errmsg(msg, jsonize=False):
         return data
 
 
-def make_msg(phase, raw_data=None, success=True, error=None, msg=None, progress=None, jsonize=False):
+def make_msg(phase, raw_data=None, success=True, error=None, msg=None, progress=None, jsonize=False, image=None):
     d = {
         "success": success,
         "phase": phase,
+        # name of the build which the message belongs to, the builds of a release run concurrently
+        "image": image,
         "raw_data": raw_data,
         'progress': progress,
         'msg': msg,
@@ -352,109 +412,5 @@ class BuildError(Exception):
         return self.data
 
 
-def build_image_helper(appname, release):
-    git_tag = release.tag
-    specs = release.specs
-
-    if not specs.builds:
-        yield make_msg("Finished", msg="ignore empty builds")
-        return
-    if release.build_status:
-        yield make_msg("Finished", msg="already built")
-        return
-
-    # clone code
-    repo_dir = os.path.join(REPO_DATA_DIR, appname)
-    shutil.rmtree(repo_dir, ignore_errors=True)
-    p = Popen(['git',  'clone',  '--recursive', '--progress', release.git, repo_dir], stdout=PIPE,
-              stderr=STDOUT, env=os.environ.copy())
-
-    for line in iter(p.stdout.readline, ""):
-        if not line:
-            break
-        # please note: line contains \n
-        if isinstance(line, bytes):
-            line = line.decode('utf8')
-        yield make_msg("Cloning", msg=line)
-    p.wait()
-    if p.returncode:
-        raise BuildError(make_msg("Cloning", success=False, error="git clone error: {}".format(p.returncode)))
-
-    try:
-        run(
-            "git checkout {}".format(git_tag), shell=True,
-            check=True, cwd=repo_dir, stdout=PIPE, stderr=STDOUT,
-            universal_newlines=True,
-        )
-    except CalledProcessError as e:
-        raise BuildError(make_msg("Checkout", success=False, error="checkout tag error: {}".format(str(e))))
-
-    client = docker.APIClient(base_url=DOCKER_HOST)
-    for build in specs.builds:
-        image_name_no_tag = construct_full_image_name(build.name, appname)
-        image_tag = build.tag if build.tag else release.tag
-        dockerfile = build.dockerfile
-        if dockerfile is None:
-            dockerfile = os.path.join(repo_dir, "Dockerfile")
-        full_image_name = "{}:{}".format(image_name_no_tag, image_tag)
-
-        # use docker to build image
-        try:
-            build_args_dict = {
-                "path": repo_dir,
-                "dockerfile": dockerfile,
-                "tag": full_image_name,
-            }
-            if build.target:
-                build_args_dict['target'] = build.target
-            if build.args:
-                build_args_dict['buildargs'] = build.args
-
-            for line in client.build(**build_args_dict):
-                output_dict = json.loads(line.decode('utf8'))
-                if 'stream' in output_dict:
-                    # please note: don't  append \n to the end of msg, 
-                    #       because output_dict['stream'] may be just part of a line.
-                    yield make_msg("Building", raw_data=output_dict, msg=output_dict['stream'])
-        except docker.errors.APIError as e:
-            raise BuildError(make_msg("Building", success=False, error="Building error: {}".format(str(e))))
-
-        # push image
-        try:
-            for line in client.push(full_image_name, stream=True):
-                output_dict = json.loads(line.decode('utf8'))
-
-                if len(output_dict) == 1 and 'status' in output_dict:
-                    msg = output_dict['status']+"\n"
-                elif 'id' in output_dict and 'status' in output_dict:
-                    # TODO: make the output like docker push
-                    # format output like:
-                    #   'b'{"status":"Preparing","progressDetail":{},"id":"89928fe4fc01"}\r\n''
-                    msg = f"{output_dict['id']}:{output_dict['status']}\n"
-                elif 'digest' in output_dict:
-                    # format output like:
-                    #    'b'{"status":"v0.1.5: digest: sha256:30fbf6b9db64c79751b7bf1f98b2ddfc630dead7f0016f764f752cecabcc72fa size: 1996"}\r\n''
-                    msg = "{}: digest: {} size: {}\n".format(output_dict.get('status'), output_dict['digest'], output_dict.get('size'))
-                else:
-                    msg = f"{line.decode('utf8')}\n"
-
-                yield make_msg("Pushing", raw_data=output_dict, msg=msg)
-        except docker.errors.APIError as e:
-            raise BuildError(make_msg("Pushing", success=False, error="pushing error: {}".format(str(e))))
-        logger.debug(f"========={full_image_name}")
-
-        # create latest tag for image and push this tag to registry
-        latest_image_name = "{}:latest".format(image_name_no_tag)
-        tagged = client.tag(full_image_name, image_name_no_tag, "latest", True)
-        if not tagged:
-            logger.warning(f"Can't create latest tag for image {full_image_name}")
-        else:
-            try:
-                client.push(latest_image_name)
-            except docker.errors.APIError as e:
-                logger.exception("Can't push latest image to registry.")
-    yield make_msg("Finished", msg="build app {}'s release {} successfully".format(appname, git_tag))
-
-
 def create_grafana_dashboard_for_app(app):
     pass
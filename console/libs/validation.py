@@ -2,10 +2,11 @@
 import re
 import numbers
 from humanfriendly import parse_size, InvalidSize
-from marshmallow import validates_schema, ValidationError, fields
+from marshmallow import validates_schema, ValidationError, fields, validate
 from numbers import Number
 
 from console.libs.k8s import KubeApi
+from console.libs.pod_event import FORMAT_COMPACT, POD_EVENT_FORMATS
 
 from kaelib.spec import (
     StrictSchema, validate_cpu, validate_memory, validate_appname,
@@ -18,6 +19,11 @@ def validate_positive_integer(i):
         raise ValidationError("Need a positive integer")
 
 
+def validate_not_empty(l):
+    if len(l) == 0:
+        raise ValidationError("Need at least one item")
+
+
 def validate_weight(i):
     if i <= 0 or i > 100:
         raise ValidationError("invalid percent value")
@@ -147,6 +153,11 @@ def validate_cpu_dict(dd):
         validate_cpu(v)
 
 
+def validate_pod_event_format(fmt):
+    if fmt not in POD_EVENT_FORMATS:
+        raise ValidationError("format should be one of {}".format(", ".join(POD_EVENT_FORMATS)))
+
+
 def validate_cluster_name(cluster):
     if KubeApi.instance().cluster_exist(cluster) is False:
         raise ValidationError("cluster {} not exists".format(cluster))
@@ -157,6 +168,15 @@ class PaginationSchema(StrictSchema):
     size = fields.Int(missing=200)
 
 
+class ListAppArgsSchema(PaginationSchema):
+    prefix = fields.Str()
+
+
+class OPLogArgsSchema(StrictSchema):
+    cursor = fields.Int(validate=validate_positive_integer)
+    size = fields.Int(missing=100, validate=validate.Range(min=1, max=1000))
+
+
 class RegisterSchema(StrictSchema):
     appname = fields.Str(required=True, validate=validate_appname)
     tag = fields.Str(required=True, validate=validate_tag)
@@ -202,6 +222,17 @@ class DeploySchema(StrictSchema):
     debug = fields.Bool(missing=False)
 
 
+class BatchDeploySchema(StrictSchema):
+    clusters = fields.List(fields.Str(validate=validate_cluster_name), required=True, validate=validate_not_empty)
+    tag = fields.Str(required=True)
+    app_yaml_name = fields.Str(missing='default')
+    # deploy the newest config of every cluster
+    use_newest_config = fields.Bool(missing=False)
+    cpus = fields.Dict(validate=validate_cpu_dict)
+    memories = fields.Dict(validate=validate_memory_dict)
+    replicas = fields.Int()
+
+
 class ScaleSchema(StrictSchema):
     cluster = fields.Str(required=True, validate=validate_cluster_name)
     replicas = fields.Int(required=True, validate=validate_positive_integer)
@@ -229,6 +260,11 @@ class ClusterCanarySchema(StrictSchema):
     canary = fields.Bool(missing=False)
 
 
+class AppPodsEventsArgsSchema(ClusterCanarySchema):
+    # see console.libs.pod_event
+    format = fields.Str(missing=FORMAT_COMPACT, validate=validate_pod_event_format)
+
+
 class GetPodEventsSchema(StrictSchema):
     cluster = fields.Str(required=True, validate=validate_cluster_name)
     # podname = fields.Str(required=True)
@@ -298,6 +334,7 @@ class CreateRoleBindingArgsSchema(StrictSchema):
 
 cluster_args_schema = ClusterArgSchema()
 cluster_canary_schema = ClusterCanarySchema()
+app_pods_events_args_schema = AppPodsEventsArgsSchema()
 register_schema = RegisterSchema()
 deploy_schema = DeploySchema()
 scale_schema = ScaleSchema()
@@ -10,8 +10,8 @@ from werkzeug.utils import cached_property
 
 from console.ext import db
 from console.libs.utils import logger
+from console.libs.spec_cache import load_specs
 from console.models.base import BaseModelMixin
-from kaelib.spec import app_specs_schema
 
 
 class App(BaseModelMixin):
@@ -118,7 +118,7 @@ class Release(BaseModelMixin):
         appname = app.name
 
         # check the format of specs text(ignore the result)
-        app_specs_schema.load(yaml.safe_load(specs_text))
+        load_specs(specs_text)
         misc = {
             'author': author,
             'commit_message': commit_message,
@@ -139,7 +139,7 @@ class Release(BaseModelMixin):
     def update(self, specs_text, image=None, build_status=False, branch='', author='', commit_message=''):
         """app must be an App instance"""
         # check the format of specs text(ignore the result)
-        app_specs_schema.load(yaml.safe_load(specs_text))
+        load_specs(specs_text)
         misc = {
             'author': author,
             'commit_message': commit_message,
@@ -183,6 +183,13 @@ class Release(BaseModelMixin):
 
         return cls.query.filter_by(app_id=app.id, tag=tag).first()
 
+    @property
+    def previous_built_release(self):
+        """the latest built release of the app before this one, its images are used as the build cache"""
+        return Release.query.filter(
+            Release.app_id == self.app_id, Release.id < self.id, Release.build_status.is_(True),
+        ).order_by(Release.id.desc()).first()
+
     @property
     def raw(self):
         """if no builds clause in app.yaml, this release is considered raw"""
@@ -213,9 +220,7 @@ class Release(BaseModelMixin):
 
     @cached_property
     def specs(self):
-        dic = yaml.safe_load(self.specs_text)
-        unmarshal_result = app_specs_schema.load(dic)
-        return unmarshal_result.data
+        return load_specs(self.specs_text)
 
     @cached_property
     def specs_dict(self):
@@ -253,7 +258,7 @@ class AppYaml(BaseModelMixin):
         appname = app.name
 
         # check the format of specs text(ignore the result)
-        app_specs_schema.load(yaml.safe_load(specs_text))
+        load_specs(specs_text)
 
         try:
             new_yaml = cls(name=name, app_id=app.id, specs_text=specs_text, comment=comment)
@@ -285,9 +290,7 @@ class AppYaml(BaseModelMixin):
 
     @cached_property
     def specs(self):
-        dic = yaml.safe_load(self.specs_text)
-        unmarshal_result = app_specs_schema.load(dic)
-        return unmarshal_result.data
+        return load_specs(self.specs_text)
 
 
 class DeployVersion(BaseModelMixin):
@@ -304,21 +307,27 @@ class DeployVersion(BaseModelMixin):
         return 'DeployVersion <{r.appname}:{r.tag}:{r.id}>'.format(r=self)
 
     @classmethod
-    def create(cls, app, tag, yaml_name, specs_text, parent_id, cluster, config_id=None):
-        """app must be an App instance"""
+    def create(cls, app, tag, yaml_name, specs_text, parent_id, cluster, config_id=None, commit=True):
+        """
+        app must be an App instance,
+        if commit is False, the version is only flushed(so it gets an id), the caller should commit the session
+        """
         if isinstance(specs_text, Dict):
             specs_text = yaml.dump(specs_text.to_dict())
         elif isinstance(specs_text, dict):
             specs_text = yaml.dump(specs_text)
         else:
             # check the format of specs text(ignore the result)
-            app_specs_schema.load(yaml.safe_load(specs_text))
+            load_specs(specs_text)
 
         try:
             ver = cls(tag=tag, app_id=app.id, parent_id=parent_id, cluster=cluster,
                       config_id=config_id, yaml_name=yaml_name, specs_text=specs_text)
             db.session.add(ver)
-            db.session.commit()
+            if commit:
+                db.session.commit()
+            else:
+                db.session.flush()
         except IntegrityError:
             logger.warn('Fail to create SpecVersion %s %s, duplicate', app.name, tag)
             db.session.rollback()
@@ -369,9 +378,7 @@ class DeployVersion(BaseModelMixin):
 
     @cached_property
     def specs(self):
-        dic = yaml.safe_load(self.specs_text)
-        unmarshal_result = app_specs_schema.load(dic)
-        return unmarshal_result.data
+        return load_specs(self.specs_text)
 
     @cached_property
     def app_config(self):
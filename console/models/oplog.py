@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import os
+import atexit
+import threading
 from datetime import datetime
 
 import enum
 import sqlalchemy
+from flask import current_app
 from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
 
 from console.ext import db
+from console.config import OPLOG_FLUSH_SIZE, OPLOG_FLUSH_INTERVAL, OPLOG_BUFFER_MAXSIZE
 from console.libs.datastructure import purge_none_val_from_dict
+from console.libs.utils import logger, spawn
 from console.models.base import BaseModelMixin, Enum34
 
 
@@ -41,13 +48,17 @@ class OPLog(BaseModelMixin):
     @classmethod
     def get_by(cls, **kwargs):
         '''
-        query operation logs, all fields could be used as query parameters
+        query operation logs, all fields could be used as query parameters,
+        the logs are ordered by id desc, pass the id of the last log as cursor to get the next page
         '''
         purge_none_val_from_dict(kwargs)
         limit = kwargs.pop('limit', 100)
         time_window = kwargs.pop('time_window', None)
+        cursor = kwargs.pop('cursor', None)
 
         filters = [getattr(cls, k) == v for k, v in kwargs.items()]
+        if cursor is not None:
+            filters.append(cls.id < cursor)
 
         if time_window:
             left, right = time_window
@@ -59,13 +70,43 @@ class OPLog(BaseModelMixin):
 
     @classmethod
     def create(cls, username=None, app_id=None, appname=None,
-               tag=None, action=None, content=None, cluster=''):
+               tag=None, action=None, content=None, cluster='', commit=True):
         op_log = cls(username=username, app_id=app_id, cluster=cluster,
                      appname=appname, tag=tag, action=action, content=content)
         db.session.add(op_log)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return op_log
 
+    @classmethod
+    def enqueue(cls, username=None, app_id=None, appname=None,
+                tag=None, action=None, content=None, cluster='', flush=False):
+        """
+        buffer the log and insert it later with other logs in one statement,
+        if flush is True, all buffered logs of this process are inserted before return.
+        """
+        now = datetime.now()
+        _writer.append({
+            'username': username,
+            'app_id': app_id or 0,
+            'appname': appname or '',
+            'tag': tag or '',
+            'cluster': cluster or '',
+            'action': action,
+            'content': content,
+            'created': now,
+            'updated': now,
+        })
+        if flush:
+            cls.flush()
+
+    @classmethod
+    def flush(cls):
+        """
+        insert the buffered logs of this process
+        """
+        _writer.flush()
+
     @classmethod
     def delete_by_app_id(cls, app_id):
         OPLog.query.filter_by(app_id=app_id).delete()
@@ -81,3 +122,108 @@ class OPLog(BaseModelMixin):
         dic['action'] = self.action.name
         return dic
 
+
+class OPLogWriter(object):
+    """
+    buffer of the operation logs in this process, flushed by a background thread.
+    the logs are inserted in their own transaction, so the session of the caller is never committed.
+    """
+    def __init__(self, max_size=OPLOG_FLUSH_SIZE, interval=OPLOG_FLUSH_INTERVAL, max_buffer=OPLOG_BUFFER_MAXSIZE):
+        self.max_size = max_size
+        self.max_buffer = max_buffer
+        self.interval = interval
+        self.rows = []
+        self.lck = threading.Lock()
+        self.flush_lck = threading.Lock()
+        self._wakeup = threading.Event()
+        self._app = None
+        self._pid = None
+
+    def append(self, row):
+        self._ensure_flusher()
+        with self.lck:
+            self.rows.append(row)
+            self._truncate()
+            full = len(self.rows) >= self.max_size
+        if full:
+            self._wakeup.set()
+
+    def _truncate(self):
+        # must be called with self.lck held
+        n_drop = len(self.rows) - self.max_buffer
+        if n_drop > 0:
+            logger.error("operation log buffer is full, drop {} logs".format(n_drop))
+            del self.rows[:n_drop]
+
+    def _insert(self, rows):
+        with db.engine.begin() as conn:
+            conn.execute(OPLog.__table__.insert(), rows)
+
+    def flush(self):
+        """
+        :return: the number of the inserted logs
+        if the batch fails, the logs are inserted one by one, the invalid ones are dropped,
+        the others are kept for the next flush when the database is unavailable.
+        """
+        with self.flush_lck:
+            with self.lck:
+                rows, self.rows = self.rows, []
+            if not rows:
+                return 0
+            try:
+                self._insert(rows)
+                return len(rows)
+            except Exception:
+                logger.exception("can't insert {} operation logs, insert them one by one".format(len(rows)))
+
+            n = 0
+            for i, row in enumerate(rows):
+                try:
+                    self._insert([row])
+                except OperationalError:
+                    # keep them for the next flush
+                    with self.lck:
+                        self.rows = rows[i:] + self.rows
+                        self._truncate()
+                    raise
+                except Exception:
+                    logger.exception("drop invalid operation log {}".format(row))
+                    continue
+                n += 1
+            return n
+
+    def _ensure_flusher(self):
+        # the thread doesn't survive fork, and the logs inherited from the parent are flushed by the parent
+        if self._pid == os.getpid():
+            return
+        with self.lck:
+            # checked again, so only one flusher is started when called concurrently
+            if self._pid == os.getpid():
+                return
+            self.rows = []
+            self._app = current_app._get_current_object()
+            self._pid = os.getpid()
+            spawn(self._run)
+
+    def _run(self):
+        with self._app.app_context():
+            while True:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("can't flush operation logs")
+
+    def flush_at_exit(self):
+        if self._app is None or self._pid != os.getpid():
+            return
+        with self._app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("can't flush operation logs at exit")
+
+
+_writer = OPLogWriter()
+atexit.register(_writer.flush_at_exit)
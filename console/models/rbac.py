@@ -2,11 +2,16 @@
 
 import json
 import enum
+import time
 from flask import g
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import object_session
 
-from console.ext import db
+from console.ext import db, rds
+from console.libs.cache import LocalCache, ONE_HOUR
 from console.libs.utils import logger, get_cluster_names
+from console.models.app import App
 from console.models.base import BaseModelMixin
 
 
@@ -41,6 +46,136 @@ role_app_association = db.Table('role_app_association',
 )
 
 
+# the bits are stored in Role.action_mask, so never change the bit of an existing action
+_action_bits = {
+    RBACAction.GET: 1 << 0,
+    RBACAction.UPDATE: 1 << 1,
+    RBACAction.CREATE: 1 << 2,
+    RBACAction.DELETE: 1 << 3,
+    RBACAction.BUILD: 1 << 4,
+    RBACAction.GET_CONFIG: 1 << 5,
+    RBACAction.UPDATE_CONFIG: 1 << 6,
+    RBACAction.GET_SECRET: 1 << 7,
+    RBACAction.UPDATE_SECRET: 1 << 8,
+    RBACAction.DEPLOY: 1 << 9,
+    RBACAction.UNDEPLOY: 1 << 10,
+    RBACAction.RENEW: 1 << 11,
+    RBACAction.ROLLBACK: 1 << 12,
+    RBACAction.SCALE: 1 << 13,
+    RBACAction.STOP_CONTAINER: 1 << 14,
+    RBACAction.ENTER_CONTAINER: 1 << 15,
+    RBACAction.ADMIN: 1 << 16,
+    RBACAction.KAE_ADMIN: 1 << 17,
+}
+
+
+def action_bit(action):
+    return _action_bits[action]
+
+
+def actions_to_mask(actions):
+    mask = 0
+    for act in actions:
+        mask |= action_bit(act)
+    return mask
+
+
+def mask_to_actions(mask):
+    return [act for act in _all_action_list if mask & _action_bits[act]]
+
+
+_ALL_ACTIONS_MASK = actions_to_mask(_all_action_list)
+_ADMIN_BIT = action_bit(RBACAction.ADMIN)
+_KAE_ADMIN_BIT = action_bit(RBACAction.KAE_ADMIN)
+# key of the roles which apply to all apps
+_ANY_APP = object()
+
+
+class PermissionIndex(object):
+    """
+    the roles of a user compiled to action bitsets, keyed by (app, cluster).
+
+    the masks of different roles are not merged, because the actions of a check must be granted by one role.
+    a None cluster means the check ignores the cluster, a None app means the check ignores the app.
+    """
+    def __init__(self):
+        self.kae_admin = False
+        self.clusters = set()
+        # (app name or _ANY_APP, cluster or None) -> set of masks
+        self.app_masks = {}
+        # cluster or None -> set of masks, the app admin role doesn't grant anything when app is ignored
+        self.masks = {}
+
+    @classmethod
+    def build(cls, roles):
+        idx = cls()
+        for role in roles:
+            mask = role.actions_mask
+            if mask & _KAE_ADMIN_BIT:
+                idx.kae_admin = True
+                idx.clusters.update(get_cluster_names())
+                continue
+            clusters = role.cluster_list
+            idx.clusters.update(clusters)
+            # app admin can do anything on specified app
+            app_mask = _ALL_ACTIONS_MASK if mask & _ADMIN_BIT else mask
+            app_keys = role.app_names or [_ANY_APP]
+            for cluster in list(clusters) + [None]:
+                idx.masks.setdefault(cluster, set()).add(mask)
+                for app_key in app_keys:
+                    idx.app_masks.setdefault((app_key, cluster), set()).add(app_mask)
+        return idx
+
+    def check(self, actions, appname=None, cluster=None):
+        if self.kae_admin:
+            return True
+        required = actions_to_mask(actions)
+        cluster = cluster or None
+        if appname is None:
+            masks = self.masks.get(cluster, ())
+        else:
+            masks = self.app_masks.get((appname, cluster), set()) | self.app_masks.get((_ANY_APP, cluster), set())
+        return any(required & ~m == 0 for m in masks)
+
+
+RBAC_VERSION_KEY = "console:rbac:version"
+# the version changed by other processes is seen after at most RBAC_VERSION_CHECK_INTERVAL seconds
+RBAC_VERSION_CHECK_INTERVAL = 1
+
+_permission_indexes = LocalCache(maxsize=4096, ttl=ONE_HOUR)
+_rbac_version = {'value': None, 'checked_at': 0}
+
+
+def get_rbac_version():
+    now = time.time()
+    if _rbac_version['value'] is None or now - _rbac_version['checked_at'] >= RBAC_VERSION_CHECK_INTERVAL:
+        _rbac_version['value'] = int(rds.get(RBAC_VERSION_KEY) or 0)
+        _rbac_version['checked_at'] = now
+    return _rbac_version['value']
+
+
+def bump_rbac_version():
+    _rbac_version['value'] = rds.incr(RBAC_VERSION_KEY)
+    _rbac_version['checked_at'] = time.time()
+
+
+def get_permission_index(user):
+    """
+    the index is cached by the user and his groups, so it is rebuilt when the group membership changes,
+    and by the rbac version, which is bumped when roles or role bindings are changed.
+    """
+    groups = user.get_groups() or []
+    key = (user['username'], tuple(sorted(grp["id"] for grp in groups)))
+    version = get_rbac_version()
+    cached = _permission_indexes.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    idx = PermissionIndex.build(get_roles_by_user(user, groups))
+    _permission_indexes.set(key, (version, idx))
+    return idx
+
+
 def check_rbac(actions, app=None, cluster=None, user=None):
     """
     check if a user has the permission, cluster is optional argument,
@@ -53,28 +188,8 @@ def check_rbac(actions, app=None, cluster=None, user=None):
     """
     if user is None:
         user = g.user
-    roles = get_roles_by_user(user)
-    logger.debug(f"roles: {roles}, user: {user}")
-    if not roles:
-        return False
-    for role in roles:
-        # kae admin can do anything
-        if RBACAction.KAE_ADMIN in role.action_list:
-            return True
-        # check cluster
-        if cluster and role.cluster_list and (cluster not in role.cluster_list):
-            continue
-        # check app
-        if app is not None:
-            if len(role.app_names) > 0 and app.name not in role.app_names:
-                continue
-            # app admin can do anything on specified app
-            if RBACAction.ADMIN in role.action_list:
-                return True
-
-        if len(set(actions) - set(role.action_list)) == 0:
-            return True
-    return False
+    idx = get_permission_index(user)
+    return idx.check(actions, None if app is None else app.name, cluster)
 
 
 def prepare_roles_for_new_app(app, user, clusters=None):
@@ -118,11 +233,12 @@ def str2actions(ss):
     return actions
 
 
-def get_roles_by_user(u):
+def get_roles_by_user(u, groups=None):
     username = u['username']
     roles = UserRoleBinding.get_roles_by_name(username)
 
-    groups = u.get_groups()
+    if groups is None:
+        groups = u.get_groups()
     if not groups:
         return roles
     for group in groups:
@@ -130,27 +246,43 @@ def get_roles_by_user(u):
     return roles
 
 
-def get_clusters_by_user(user):
-    if user is None:
-        user = g.user
-    all_clusters = get_cluster_names()
+def query_apps_by_user(user, prefix=None):
+    """
+    query of the apps the user can get, ordered by name,
+    the roles and the apps are filtered in the database, so the caller can paginate the query.
 
-    roles = get_roles_by_user(user)
-    logger.debug(f"roles: {roles}, user: {user}")
-    if not roles:
-        return []
+    :param prefix: only the apps whose name starts with prefix
+    """
+    group_ids = [grp["id"] for grp in (user.get_groups() or [])]
+    bound = Role.id.in_(db.session.query(UserRoleBinding.role_id).filter(UserRoleBinding.username == user['username']))
+    if group_ids:
+        bound = db.or_(bound, Role.id.in_(
+            db.session.query(GroupRoleBinding.role_id).filter(GroupRoleBinding.group_id.in_(group_ids))))
+    granted_mask = actions_to_mask([RBACAction.GET, RBACAction.ADMIN, RBACAction.KAE_ADMIN])
+    granting_roles = db.session.query(Role.id).filter(bound, Role.action_mask.op('&')(granted_mask) != 0)
+
+    # kae admin or the roles without apps can get all apps
+    any_app = db.or_(
+        Role.action_mask.op('&')(_KAE_ADMIN_BIT) != 0,
+        ~db.exists().where(role_app_association.c.role_id == Role.id),
+    )
+    all_apps = db.session.query(granting_roles.filter(any_app).exists()).scalar()
 
-    role_clusters = set()
+    q = App.query
+    if not all_apps:
+        q = q.filter(App.id.in_(
+            db.session.query(role_app_association.c.app_id).filter(
+                role_app_association.c.role_id.in_(granting_roles))))
+    if prefix:
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        q = q.filter(App.name.like(escaped + '%', escape='\\'))
+    return q.order_by(App.name)
 
-    for role in roles:
-        # kae admin can do anything
-        if RBACAction.KAE_ADMIN in role.action_list:
-            return all_clusters
-        # check cluster
-        role_clusters.update(role.cluster_list)
-        if len(role_clusters) == len(all_clusters):
-            return list(role_clusters)
-    return list(role_clusters)
+
+def get_clusters_by_user(user):
+    if user is None:
+        user = g.user
+    return list(get_permission_index(user).clusters)
 
 
 class Role(BaseModelMixin):
@@ -163,6 +295,8 @@ class Role(BaseModelMixin):
     # actions is a json with the following format:
     #   ["get", "deploy", "get_config"],
     actions = db.Column(db.Text, nullable=False)
+    # bitmask of the actions, it is kept in sync with actions when the role is saved
+    action_mask = db.Column(db.BigInteger)
     # clusters is a json list with the following format:
     # ["cluster1", "cluster2", "cluster3"]
     # if clusters is an empty list, it mains allows all clusters
@@ -201,8 +335,7 @@ class Role(BaseModelMixin):
     def app_names(self):
         return [app.name for app in self.apps]
 
-    @property
-    def action_list(self):
+    def _parse_actions(self):
         try:
             actions = str2actions(self.actions)
         except AttributeError:
@@ -212,6 +345,16 @@ class Role(BaseModelMixin):
             actions = _all_action_list
         return actions
 
+    @property
+    def actions_mask(self):
+        if self.action_mask is None:
+            return actions_to_mask(self._parse_actions())
+        return self.action_mask
+
+    @property
+    def action_list(self):
+        return mask_to_actions(self.actions_mask)
+
     @property
     def cluster_list(self):
         if not self.clusters:
@@ -226,7 +369,6 @@ class Role(BaseModelMixin):
     def app_list(self):
         apps = self.apps.all() 
         if len(apps) == 0:
-            from console.models.app import App
             return App.get_all()
         else:
             return apps
@@ -287,3 +429,37 @@ class GroupRoleBinding(BaseModelMixin):
     def get_roles_by_id(cls, group_id):
         l = cls.query.filter_by(group_id=group_id)
         return [binding.role for binding in l]
+
+
+@event.listens_for(Role, 'before_insert')
+@event.listens_for(Role, 'before_update')
+def _sync_action_mask(mapper, connection, target):
+    target.action_mask = actions_to_mask(target._parse_actions())
+
+
+def _mark_rbac_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['rbac_changed'] = True
+
+
+# the permission indexes are rebuilt after the roles or role bindings are changed,
+# or an app is deleted(the indexes refer to apps by name)
+for _model in (Role, UserRoleBinding, GroupRoleBinding):
+    for _evt in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _evt, _mark_rbac_changed)
+event.listen(App, 'after_delete', _mark_rbac_changed)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _bump_rbac_version_after_commit(session):
+    if session.info.pop('rbac_changed', False):
+        try:
+            bump_rbac_version()
+        except Exception:
+            logger.exception("can't bump rbac version")
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _clear_rbac_changed(session):
+    session.info.pop('rbac_changed', None)
@@ -7,8 +7,8 @@ from flask import abort, session, request, g
 from console.config import (
     EMAIL_DOMAIN, KEYCLOAK_ADMIN_USER, KEYCLOAK_ADMIN_PASSWD
 )
-from console.ext import oidc
 from console.libs.utils import logger
+from console.libs.token_cache import validate_token
 from console.libs.sso import SSO
 
 
@@ -26,7 +26,7 @@ def get_current_user(require_token=False, scopes_required=None):
         token = request.args['access_token']
 
     if token is not None:
-        validity = oidc.validate_token(token, scopes_required)
+        validity = validate_token(token, scopes_required)
         logger.debug(f"validity: {validity}, token: {token}")
         if (validity is True) or (not require_token):
             user = User(g.oidc_token_info)
@@ -106,26 +106,12 @@ class User(Dict):
             d = User(d)
         return d
 
-    def list_app(self, start=0, limit=500):
-        from console.models.rbac import RBACAction, get_roles_by_user
-        from console.models.app import App
-        roles = get_roles_by_user(self)
-        seen_app_names = set()
-        apps = []
-        logger.debug(f"role list(user: {self.username}) {roles}")
-        for role in roles:
-            if RBACAction.KAE_ADMIN in role.action_list:
-                apps = App.get_all()
-                break
-            if RBACAction.ADMIN in role.action_list or RBACAction.GET in role.action_list:
-                # remove duplicate
-                for app in role.app_list:
-                    if app.name not in seen_app_names:
-                        apps.append(app)
-                        seen_app_names.add(app.name)
-        # sort
-        apps = sorted(apps, key=lambda app: app.name)
-        return apps[start: start+limit]
+    def query_app(self, prefix=None):
+        from console.models.rbac import query_apps_by_user
+        return query_apps_by_user(self, prefix)
+
+    def list_app(self, start=0, limit=500, prefix=None):
+        return self.query_app(prefix).offset(start).limit(limit).all()
 
     @property
     def nickname(self):
@@ -3,9 +3,12 @@ from celery import current_app
 from celery.exceptions import SoftTimeLimitExceeded
 
 from console.config import TASK_PUBSUB_CHANNEL, APP_BUILD_TIMEOUT
-from console.ext import rds, db
-from console.libs.utils import logger, BuildError, build_image_helper, make_errmsg
+from console.ext import db
+from console.libs.utils import logger, BuildError, make_errmsg
+from console.libs.builder import build_image_helper
 from console.libs.k8s import KubeApi, ApiException
+from console.libs.pubsub import get_pubsub_multiplexer
+from console.libs.events import deliver_events
 from console.models import Release
 
 
@@ -22,38 +25,36 @@ def build_image(self, appname, git_tag):
         self.stream_output(make_errmsg('build timeout, please test in local environment and contact administrator'))
 
 
+@current_app.task
+def deliver_events_task():
+    delay = deliver_events()
+    if delay is not None:
+        deliver_events_task.apply_async(countdown=delay)
+
+
 def celery_task_stream_response(celery_task_ids, timeout=0, exit_when_timeout=True):
     if isinstance(celery_task_ids, str):
         celery_task_ids = celery_task_ids,
 
     task_progress_channels = [TASK_PUBSUB_CHANNEL.format(task_id=id_) for id_ in celery_task_ids]
-    pubsub = rds.pubsub()
-    pubsub.subscribe(task_progress_channels)
     try:
-        while pubsub.subscribed:
-            resp = pubsub.get_message(timeout=timeout)
-            if resp is None:
-                if exit_when_timeout:
-                    logger.warn("pubsub timeout {}".format(celery_task_ids))
-                    return None
-                continue
-            raw_content = resp['data']
-            # omit the initial message where item['data'] is 1L
-            if not isinstance(raw_content, (bytes, str)):
-                continue
-            content = raw_content
-            if isinstance(content, bytes):
-                content = content.decode('utf-8')
-            logger.debug('Got pubsub message: %s', content)
-            # task will publish TASK_PUBSUB_EOF at success or failure
-            if content.startswith('CELERY_TASK_DONE'):
-                finished_task_id = content[content.find(':') + 1:]
-                finished_task_channel = TASK_PUBSUB_CHANNEL.format(task_id=finished_task_id)
-                logger.debug('Task %s finished, break celery_task_stream_response', finished_task_id)
-                pubsub.unsubscribe(finished_task_channel)
-            else:
-                yield content
+        with get_pubsub_multiplexer().subscription(task_progress_channels) as sub:
+            while sub.channels:
+                resp = sub.get(timeout=timeout)
+                if resp is None:
+                    if exit_when_timeout:
+                        logger.warn("pubsub timeout {}".format(celery_task_ids))
+                        return None
+                    continue
+                _, content = resp
+                logger.debug('Got pubsub message: %s', content)
+                # task will publish TASK_PUBSUB_EOF at success or failure
+                if content.startswith('CELERY_TASK_DONE'):
+                    finished_task_id = content[content.find(':') + 1:]
+                    finished_task_channel = TASK_PUBSUB_CHANNEL.format(task_id=finished_task_id)
+                    logger.debug('Task %s finished, break celery_task_stream_response', finished_task_id)
+                    sub.unsubscribe(finished_task_channel)
+                else:
+                    yield content
     finally:
         logger.debug("celery stream response exit ************")
-        pubsub.unsubscribe()
-        pubsub.close()
@@ -0,0 +1,69 @@
+"""add role.action_mask
+
+Revision ID: 5c9384d401c4
+Revises: 60c60fa1815a
+Create Date: 2026-10-17 08:12:31.502718
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c9384d401c4'
+down_revision = '60c60fa1815a'
+branch_labels = None
+depends_on = None
+
+# the bits of RBACAction in console/models/rbac.py at the time of this revision
+ACTION_BITS = {
+    "get": 1 << 0,
+    "update": 1 << 1,
+    "create": 1 << 2,
+    "delete": 1 << 3,
+    "build": 1 << 4,
+    "get_config": 1 << 5,
+    "update_config": 1 << 6,
+    "get_secret": 1 << 7,
+    "update_secret": 1 << 8,
+    "deploy": 1 << 9,
+    "undeploy": 1 << 10,
+    "renew": 1 << 11,
+    "rollback": 1 << 12,
+    "scale": 1 << 13,
+    "stop_container": 1 << 14,
+    "enter_container": 1 << 15,
+    "admin": 1 << 16,
+    "kae_admin": 1 << 17,
+}
+
+
+def _actions_to_mask(actions_txt):
+    try:
+        actions = json.loads(actions_txt)
+        # an empty list means all actions
+        if len(actions) == 0:
+            actions = list(ACTION_BITS.keys())
+        mask = 0
+        for act in actions:
+            mask |= ACTION_BITS[act.lower()]
+        return mask
+    except (TypeError, ValueError, KeyError, AttributeError):
+        # the same as Role.action_list, invalid actions grant nothing
+        return 0
+
+
+def upgrade():
+    op.add_column('role', sa.Column('action_mask', sa.BigInteger(), nullable=True))
+
+    role = sa.table('role', sa.column('id', sa.Integer), sa.column('actions', sa.Text),
+                    sa.column('action_mask', sa.BigInteger))
+    conn = op.get_bind()
+    for role_id, actions_txt in conn.execute(sa.select([role.c.id, role.c.actions])).fetchall():
+        conn.execute(role.update().where(role.c.id == role_id).values(action_mask=_actions_to_mask(actions_txt)))
+
+
+def downgrade():
+    op.drop_column('role', 'action_mask')
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+import pytest
+
+from console.libs import builder
+from console.libs.builder import (
+    parse_image_refs, strip_image_tag, run_builds, count_cache_hits, setup_build_cache,
+)
+from console.libs.utils import BuildError, make_msg
+
+
+def test_parse_image_refs():
+    dockerfile = """
+ARG BASE_TAG=v1
+FROM registry.example.com:5000/app-base:${BASE_TAG} AS base
+COPY --from=builder /src /dst
+FROM $RUNTIME
+"""
+    refs = parse_image_refs(dockerfile, {"RUNTIME": "python:3.8"})
+    assert refs == ["registry.example.com:5000/app-base:v1", "builder", "python:3.8"]
+
+    assert strip_image_tag("registry.example.com:5000/app-base:v1") == "registry.example.com:5000/app-base"
+    assert strip_image_tag("registry.example.com:5000/app-base") == "registry.example.com:5000/app-base"
+    assert strip_image_tag("python@sha256:abc") == "python"
+
+
+class FakeBuild(object):
+    def __init__(self, name, uses=(), fail=False, push_fail=False):
+        self.name = name
+        self._uses = set(uses)
+        self.fail = fail
+        self.push_fail = push_fail
+        self.deps = set()
+        self.full_image_name = name
+
+    def uses(self, other):
+        return other.name in self._uses
+
+    def make_msg(self, phase, **kwargs):
+        return make_msg(phase, image=self.name, **kwargs)
+
+    def build(self, emit):
+        emit(self.make_msg("Building", msg=self.name))
+        if self.fail:
+            raise BuildError(self.make_msg("Building", success=False, error="failed"))
+
+    def push(self, emit):
+        emit(self.make_msg("Pushing", msg=self.name))
+        if self.push_fail:
+            raise BuildError(self.make_msg("Pushing", success=False, error="failed"))
+
+
+def test_run_builds_order():
+    jobs = [FakeBuild("web", uses=["base"]), FakeBuild("worker", uses=["base"]), FakeBuild("base")]
+    msgs = list(run_builds(jobs, concurrency=2))
+    builds = [m["image"] for m in msgs if m["phase"] == "Building"]
+    assert builds[0] == "base"
+    assert sorted(builds[1:]) == ["web", "worker"]
+    # every image is pushed before run_builds returns
+    assert sorted(m["image"] for m in msgs if m["phase"] == "Pushing") == ["base", "web", "worker"]
+
+
+def test_run_builds_error():
+    jobs = [FakeBuild("web", uses=["base"]), FakeBuild("base", fail=True), FakeBuild("worker")]
+    with pytest.raises(BuildError):
+        msgs = []
+        for m in run_builds(jobs, concurrency=1):
+            msgs.append(m)
+    # web depends on the failed build, so it never starts
+    assert "web" not in [m["image"] for m in msgs]
+
+    jobs = [FakeBuild("a", uses=["b"]), FakeBuild("b", uses=["a"])]
+    with pytest.raises(BuildError):
+        list(run_builds(jobs))
+
+
+def test_run_builds_push_error():
+    jobs = [FakeBuild("web", push_fail=True), FakeBuild("worker")]
+    with pytest.raises(BuildError) as e:
+        list(run_builds(jobs, concurrency=2))
+    assert e.value.data["phase"] == "Pushing"
+
+
+def test_count_cache_hits():
+    output = """Step 1/4 : FROM python:3.8
+ ---> 0a3a8a5ec0a1
+Step 2/4 : COPY requirements.txt /app/
+ ---> Using cache
+ ---> 5b0c5d3bd2e4
+Step 3/4 : RUN pip install -r /app/requirements.txt
+ ---> Using cache
+ ---> 6e1f9f8e3b2a
+Step 4/4 : COPY . /app
+ ---> 7f2a0b1c9d3e
+"""
+    assert count_cache_hits(output) == (3, 2)
+
+
+class SlowBuild(FakeBuild):
+    def __init__(self, name):
+        super(SlowBuild, self).__init__(name)
+        self.finished = False
+
+    def build(self, emit):
+        emit(self.make_msg("Building", msg=self.name))
+        time.sleep(0.1)
+        self.finished = True
+
+
+def test_run_builds_close_waits_workers():
+    jobs = [SlowBuild("web"), SlowBuild("worker")]
+    gen = run_builds(jobs, concurrency=2)
+    next(gen)
+    gen.close()
+    # the build context is removed after close, so no build may be running
+    assert all(job.finished for job in jobs)
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_setup_build_cache():
+    prev = Obj(tag="v1", specs=Obj(builds=[Obj(name="example.com/app-web", tag=None)]))
+    release = Obj(tag="v2", previous_built_release=prev)
+    jobs = [
+        Obj(image_name_no_tag="example.com/app-web", full_image_name="example.com/app-web:v2", cache_from=[]),
+        Obj(image_name_no_tag="example.com/app-worker", full_image_name="example.com/app-worker:v2", cache_from=[]),
+    ]
+    setup_build_cache("app", release, jobs)
+    assert jobs[0].cache_from == ["example.com/app-web:v1"]
+    # the new image has no previous release
+    assert jobs[1].cache_from == []
+
+
+class FakeAPIClient(object):
+    def __init__(self, base_url=None):
+        self.pushed = []
+
+    def pull(self, repo, tag=None):
+        pass
+
+    def build(self, **kwargs):
+        yield b'{"stream": "Step 1/2 : FROM python:3.8\\n"}'
+        yield b'{"stream": "Step 2/2 : COPY . /app\\n"}'
+        yield b'{"stream": " ---> Using cache\\n"}'
+
+    def push(self, image, stream=False):
+        yield json.dumps({"status": "pushed {}".format(image)}).encode('utf8')
+
+    def tag(self, image, repository, tag=None, force=False):
+        return True
+
+
+def test_run_builds_image_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(builder.docker, "APIClient", FakeAPIClient)
+    (tmp_path / "Dockerfile").write_text("FROM python:3.8\nCOPY . /app\n")
+    release = Obj(tag="v1")
+    spec = Obj(name="example.com/app-web", tag=None, dockerfile=None, target=None, args=None)
+    jobs = [builder.ImageBuild("app", release, spec, str(tmp_path))]
+    msgs = list(run_builds(jobs))
+    assert all(m["success"] for m in msgs)
+    assert any("cache hit ratio: 1/1" in m["msg"] for m in msgs)
+    assert "pushed example.com/app-web:v1\n" in [m["msg"] for m in msgs if m["phase"] == "Pushing"]
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from console.libs import cache as cache_mod
+from console.libs.cache import LocalCache, SingleFlight, cache, clean_cache
+
+
+class FakeListenerThread(object):
+    def is_alive(self):
+        return True
+
+
+class FakePubSub(object):
+    def __init__(self, rds):
+        self.rds = rds
+
+    def subscribe(self, **handlers):
+        self.rds.handlers.update(handlers)
+
+    def run_in_thread(self, sleep_time=0, daemon=False):
+        return FakeListenerThread()
+
+
+class FakeRedis(object):
+    """
+    the messages are only delivered to the subscribers by `deliver`, like the listener thread of redis-py
+    """
+    def __init__(self):
+        self.data = {}
+        self.handlers = {}
+        self.messages = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def publish(self, channel, message):
+        self.messages.append((channel, message.encode('utf-8')))
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    def deliver(self):
+        messages, self.messages = self.messages, []
+        for channel, data in messages:
+            if channel in self.handlers:
+                self.handlers[channel]({'type': 'message', 'channel': channel, 'data': data})
+
+
+class FakeLock(object):
+    locks = {}
+
+    def __init__(self, rds, name, expire=None):
+        self.lck = self.locks.setdefault(name, threading.Lock())
+
+    def acquire(self, timeout=None):
+        return self.lck.acquire(timeout=timeout)
+
+    def release(self):
+        self.lck.release()
+
+
+class NoSingleFlight(object):
+    # every caller acts like it's in another process
+    def do(self, key, func):
+        return func()
+
+
+@pytest.fixture
+def fake_rds(monkeypatch):
+    rds = FakeRedis()
+    monkeypatch.setattr(cache_mod, "rds", rds)
+    monkeypatch.setattr(cache_mod, "local_cache", LocalCache(maxsize=100, ttl=60))
+    monkeypatch.setattr(cache_mod, "_invalidation_thread", None)
+    monkeypatch.setattr(cache_mod.redis_lock, "Lock", FakeLock)
+    return rds
+
+
+def test_local_cache_lru():
+    c = LocalCache(maxsize=2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.get("a") == 1
+    c.set("c", 3)
+    # b is the least recently used one
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    c.delete("a")
+    assert c.get("a") is None
+
+
+def test_local_cache_ttl():
+    c = LocalCache(maxsize=10, ttl=60)
+    c.set("a", 1, ttl=0.05)
+    assert c.get("a") == 1
+    time.sleep(0.1)
+    assert c.get("a") is None
+    c.set("b", 1, ttl=0)
+    assert c.get("b") is None
+
+
+def test_single_flight():
+    sf = SingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 42
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(sf.do("k", compute))) for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+        t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == [42] * 5
+    assert len(calls) == 1
+
+
+def test_clean_cache_evicts_other_listeners(fake_rds, monkeypatch):
+    calls = []
+
+    @cache(fmt='test:{x}', ttl=60)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    assert double(1) == 2
+    assert double(1) == 2
+    assert calls == [1]
+    ours = cache_mod.local_cache
+    assert ours.get('test:1') == 2
+
+    # another process cleans the key, it only evicts its own local copy directly
+    monkeypatch.setattr(cache_mod, "local_cache", LocalCache(maxsize=100, ttl=60))
+    clean_cache('test:1')
+    monkeypatch.setattr(cache_mod, "local_cache", ours)
+    assert fake_rds.get('test:1') is None
+    assert ours.get('test:1') == 2
+
+    # our listener receives the key
+    fake_rds.deliver()
+    assert ours.get('test:1') is None
+    assert double(1) == 2
+    assert calls == [1, 1]
+
+
+def test_cache_fill_lock(fake_rds, monkeypatch):
+    monkeypatch.setattr(cache_mod, "_single_flight", NoSingleFlight())
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    @cache(fmt='test:fill:{x}', ttl=60)
+    def compute(x):
+        calls.append(x)
+        started.set()
+        release.wait()
+        return x
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(compute(42))) for _ in range(5)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+        t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == [42] * 5
+    # the others waited for the lock and read the value from redis
+    assert len(calls) == 1
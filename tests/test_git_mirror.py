@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+
+from console.libs import git_mirror
+from console.libs.git_mirror import mirror_path, _submodule_urls
+
+
+def test_mirror_path():
+    assert mirror_path("git@github.com:a/b.git") == mirror_path("git@github.com:a/b.git")
+    assert mirror_path("git@github.com:a/b.git") != mirror_path("git@github.com:a/c.git")
+    assert mirror_path("git@github.com:a/b.git").endswith(".git")
+
+
+def test_submodule_urls(tmp_path):
+    assert _submodule_urls(str(tmp_path)) == []
+    (tmp_path / ".gitmodules").write_text(
+        '[submodule "a"]\n'
+        '\tpath = a\n'
+        '\turl = git@github.com:a/a.git\n'
+        '[submodule "b"]\n'
+        '\tpath = b\n'
+        '\turl = ../b.git\n'
+    )
+    # relative urls are left to git
+    assert _submodule_urls(str(tmp_path)) == ["git@github.com:a/a.git"]
+
+
+def git(*args, cwd=None):
+    subprocess.run(['git', '-c', 'protocol.file.allow=always'] + list(args), cwd=cwd, check=True,
+                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def make_bare_repo(tmp_path, name, files, submodules=()):
+    work = str(tmp_path / "work" / name)
+    git('init', '-q', work)
+    for path, content in files.items():
+        with open(os.path.join(work, path), 'w') as fp:
+            fp.write(content)
+    for path, url in submodules:
+        git('submodule', 'add', '-q', url, path, cwd=work)
+    git('add', '-A', cwd=work)
+    git('commit', '-q', '-m', 'init', cwd=work)
+    git('tag', 'v1', cwd=work)
+    bare = str(tmp_path / "{}.git".format(name))
+    git('clone', '-q', '--bare', work, bare)
+    return bare
+
+
+def test_checkout(tmp_path, monkeypatch):
+    for key in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME', 'GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+        monkeypatch.setenv(key, 'kae')
+    monkeypatch.setattr(git_mirror, "MIRRORS_DIR", str(tmp_path / "mirrors"))
+    sub_url = make_bare_repo(tmp_path, "sub", {"lib.txt": "lib"})
+    url = make_bare_repo(tmp_path, "app", {"Dockerfile": "FROM scratch"}, submodules=[("lib", sub_url)])
+
+    dest = str(tmp_path / "build")
+    for _ in range(2):
+        # the second checkout fetches into the mirrors
+        list(git_mirror.checkout(url, "v1", dest))
+        with open(os.path.join(dest, "Dockerfile")) as fp:
+            assert fp.read() == "FROM scratch"
+        with open(os.path.join(dest, "lib", "lib.txt")) as fp:
+            assert fp.read() == "lib"
+    assert os.path.isdir(mirror_path(url))
+    assert os.path.isdir(mirror_path(sub_url))
+    # the objects are shared with the mirror
+    with open(os.path.join(dest, ".git", "objects", "info", "alternates")) as fp:
+        assert fp.read().strip() == os.path.join(mirror_path(url), "objects")
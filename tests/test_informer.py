@@ -0,0 +1,80 @@
+import time
+
+from addict import Dict
+
+from console.libs.informer import ObjectStore, Informer, CacheMode
+from console.libs.k8s import KaeCluster
+
+
+def make_obj(name, ver):
+    return Dict({"metadata": {"name": name, "resource_version": str(ver)}})
+
+
+def test_object_store():
+    store = ObjectStore()
+    key = store.make_key("kae", "hello")
+    assert store.get(key) is None
+
+    store.put(key, make_obj("hello", 10), from_watch=True)
+    assert store.get(key).metadata.resource_version == "10"
+    # an older object never replaces a newer one
+    store.put(key, make_obj("hello", 9), from_watch=True)
+    assert store.get(key).metadata.resource_version == "10"
+
+    # the returned object is a copy
+    store.get(key).metadata.resource_version = "100"
+    assert store.get(key).metadata.resource_version == "10"
+
+    # a dirty key is only cleared by a read-through put
+    store.invalidate(key)
+    store.put(key, make_obj("hello", 11), from_watch=True)
+    assert store.is_dirty(key)
+    store.put(key, make_obj("hello", 12))
+    assert not store.is_dirty(key)
+
+    store.delete(key)
+    assert store.get(key) is None
+
+
+def make_cluster():
+    cluster = KaeCluster.__new__(KaeCluster)
+    cluster.namespace = "kae"
+    informer = Informer("Deployment", None, "kae")
+    informer.synced_at = time.time()
+    cluster.informers = {"Deployment": informer}
+    return cluster
+
+
+def test_read_through_during_write():
+    cluster = make_cluster()
+    live = {"obj": make_obj("hello", 10)}
+
+    def read(name, namespace):
+        return live["obj"]
+
+    with cluster._changing("Deployment", "hello"):
+        # the read-through gets the object before the write
+        cluster._cached_read("Deployment", "hello", read, cache_mode=CacheMode.READ_THROUGH)
+        live["obj"] = make_obj("hello", 11)
+    obj = cluster._cached_read("Deployment", "hello", read, cache_mode=CacheMode.LOCAL)
+    assert obj.metadata.resource_version == "11"
+
+
+def test_write_during_read_through():
+    cluster = make_cluster()
+    live = {"obj": make_obj("hello", 10)}
+
+    def read(name, namespace):
+        old = live["obj"]
+        # the write starts and ends while the response of the read is on its way
+        with cluster._changing("Deployment", "hello"):
+            live["obj"] = make_obj("hello", 11)
+        return old
+
+    obj = cluster._cached_read("Deployment", "hello", read, cache_mode=CacheMode.READ_THROUGH)
+    assert obj.metadata.resource_version == "10"
+    assert cluster.informers["Deployment"].is_dirty("hello")
+
+    obj = cluster._cached_read("Deployment", "hello", lambda name, namespace: live["obj"],
+                               cache_mode=CacheMode.LOCAL)
+    assert obj.metadata.resource_version == "11"
@@ -0,0 +1,43 @@
+from decimal import Decimal
+
+from console.libs.k8s_diff import parse_quantity, is_subset, make_json_patch
+
+
+def test_parse_quantity():
+    assert parse_quantity("500m") == parse_quantity("0.5") == Decimal("0.5")
+    assert parse_quantity("1Gi") == parse_quantity("1024Mi")
+    assert parse_quantity(2) == Decimal(2)
+    assert parse_quantity("abc") is None
+    assert parse_quantity(True) is None
+
+
+def test_is_subset():
+    live = {
+        "spec": {
+            "replicas": 2,
+            "containers": [{"name": "web", "image": "hello:v1", "terminationMessagePath": "/dev/termination-log",
+                            "resources": {"limits": {"cpu": "500m"}}}],
+        },
+    }
+    assert is_subset({"spec": {"replicas": 2}}, live)
+    assert is_subset({"spec": {"containers": [{"name": "web", "resources": {"limits": {"cpu": "0.5"}}}]}}, live)
+    assert is_subset({"spec": {"volumes": []}}, live)
+    assert not is_subset({"spec": {"replicas": 3}}, live)
+    assert not is_subset({"spec": {"containers": []}}, live)
+
+
+def test_make_json_patch():
+    last = {"metadata": {"labels": {"a": "1", "b": "2"}}, "spec": {"replicas": 2}}
+    desired = {"metadata": {"labels": {"a": "1", "c/d": "3"}}, "spec": {"replicas": 2}}
+    live = {"metadata": {"labels": {"a": "1", "b": "2"}, "uid": "xx"}, "spec": {"replicas": 2}}
+    ops = make_json_patch(last, desired, live)
+    assert ops == [
+        {"op": "add", "path": "/metadata/labels/c~1d", "value": "3"},
+        {"op": "remove", "path": "/metadata/labels/b"},
+    ]
+    assert make_json_patch(desired, desired, {"metadata": {"labels": {"a": "1", "c/d": "3"}}, "spec": {"replicas": 2}}) == []
+
+    # fields changed by others are restored
+    live["spec"]["replicas"] = 5
+    ops = make_json_patch(last, last, live)
+    assert ops == [{"op": "add", "path": "/spec/replicas", "value": 2}]
@@ -55,3 +55,39 @@ def test_oplog(test_db):
 
     query_by_appname = OPLog.get_by(appname=default_appname)
     assert len(query_by_appname) == 2
+
+
+def test_oplog_enqueue(test_db):
+    for action in (OPType.DEPLOY_APP, OPType.SCALE_APP, OPType.UNDEPLOY_APP):
+        OPLog.enqueue(username=FAKE_USER['username'],
+                      app_id=1,
+                      appname=default_appname,
+                      action=action,
+                      content="{'foo': 'bar'}")
+    OPLog.flush()
+
+    query_all = OPLog.get_by(appname=default_appname)
+    assert [log.action for log in query_all] == [OPType.UNDEPLOY_APP, OPType.SCALE_APP, OPType.DEPLOY_APP]
+
+    first_page = OPLog.get_by(appname=default_appname, limit=2)
+    assert len(first_page) == 2
+    next_page = OPLog.get_by(appname=default_appname, limit=2, cursor=first_page[-1].id)
+    assert [log.action for log in next_page] == [OPType.DEPLOY_APP]
+
+
+def test_oplog_flush_poison_row(test_db):
+    OPLog.enqueue(username=FAKE_USER['username'], app_id=1, appname=default_appname,
+                  action=OPType.DEPLOY_APP, content="ok")
+    # not an OPType, the batch insert fails
+    OPLog.enqueue(username=FAKE_USER['username'], app_id=1, appname=default_appname,
+                  action='poison', content="poison")
+    OPLog.enqueue(username=FAKE_USER['username'], app_id=1, appname=default_appname,
+                  action=OPType.SCALE_APP, content="ok")
+    OPLog.flush()
+
+    query_all = OPLog.get_by(appname=default_appname)
+    assert [log.action for log in query_all] == [OPType.SCALE_APP, OPType.DEPLOY_APP]
+    # the poison row is dropped, so the next flush succeeds
+    OPLog.enqueue(username=FAKE_USER['username'], app_id=1, appname=default_appname,
+                  action=OPType.UNDEPLOY_APP, content="ok")
+    assert OPLog.flush() == 1
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from console.libs.notify import make_digests
+
+
+def test_make_digests():
+    pending = {
+        "a@x.com": [("s1", "t1")],
+        "b@x.com": [("s1", "t1")],
+        "c@x.com": [("s1", "t1"), ("s2", "t2")],
+    }
+    digests = sorted(make_digests(pending))
+    assert len(digests) == 2
+    receivers, subject, text = digests[0]
+    # the receivers with the same messages share one email
+    assert receivers == ["a@x.com", "b@x.com"]
+    assert subject == "s1"
+    assert text == "t1"
+
+    receivers, subject, text = digests[1]
+    assert receivers == ["c@x.com"]
+    assert subject == "KAE: 2 notifications"
+    assert "t1" in text and "t2" in text
@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from console.libs.pipeline import Step, run_steps
+
+
+def test_run_steps():
+    executor = ThreadPoolExecutor(max_workers=4)
+    finished = []
+
+    def make_func(name, delay=0, error=None):
+        def _func():
+            time.sleep(delay)
+            if error:
+                raise error
+            finished.append(name)
+            return name
+        return _func
+
+    report = run_steps(executor, [
+        Step("configmap", make_func("configmap", 0.1)),
+        Step("deployment", make_func("deployment"), deps=["configmap"]),
+        Step("service", make_func("service")),
+    ])
+    assert [r["step"] for r in report] == ["configmap", "deployment", "service"]
+    assert [r["result"] for r in report] == ["configmap", "deployment", "service"]
+    # independent step doesn't wait for configmap
+    assert finished.index("service") < finished.index("configmap") < finished.index("deployment")
+
+    finished.clear()
+    steps = [
+        Step("configmap", make_func("configmap", error=KeyError("xx"))),
+        Step("deployment", make_func("deployment"), deps=["configmap"]),
+        Step("service", make_func("service")),
+    ]
+    with pytest.raises(KeyError):
+        run_steps(executor, steps)
+    assert finished == ["service"]
+
+    report = run_steps(executor, steps, raise_error=False)
+    assert report[0]["error"] is not None
+    assert report[1]["skipped"]
+    assert report[2]["result"] == "service"
@@ -0,0 +1,53 @@
+from console.libs.pod_event import compact_pod, make_delta, PodDeltaEncoder
+
+
+def make_pod(phase="Pending", restart_count=0, node_name=None):
+    return {
+        "metadata": {
+            "name": "hello-abc", "namespace": "kae", "uid": "uid-1", "resource_version": "10",
+            "labels": {"kae-app-name": "hello"}, "managed_fields": [{"manager": "kubelet"}],
+        },
+        "spec": {"node_name": node_name, "containers": [{"name": "web", "image": "hello:v1"}]},
+        "status": {
+            "phase": phase,
+            "conditions": [{"type": "Ready", "status": "False", "last_probe_time": None, "reason": "xx"}],
+            "container_statuses": [{"name": "web", "ready": False, "restart_count": restart_count,
+                                    "image_id": "docker://xxx"}],
+        },
+    }
+
+
+def test_compact_pod():
+    pod = compact_pod(make_pod())
+    assert pod == {
+        "metadata": {"name": "hello-abc", "namespace": "kae", "uid": "uid-1", "resource_version": "10",
+                     "labels": {"kae-app-name": "hello"}},
+        "spec": {},
+        "status": {
+            "phase": "Pending",
+            "conditions": [{"type": "Ready", "status": "False"}],
+            "container_statuses": [{"name": "web", "ready": False, "restart_count": 0}],
+        },
+    }
+
+
+def test_make_delta():
+    old = compact_pod(make_pod())
+    new = compact_pod(make_pod(phase="Running", node_name="node1"))
+    assert make_delta(old, new) == {"spec": {"node_name": "node1"}, "status": {"phase": "Running"}}
+    assert make_delta(new, old) == {"spec": {"node_name": None}, "status": {"phase": "Pending"}}
+    assert make_delta(old, old) == {}
+
+
+def test_pod_delta_encoder():
+    encoder = PodDeltaEncoder()
+    pod = compact_pod(make_pod())
+    assert encoder.encode("ADDED", pod) == {"action": "ADDED", "uid": "uid-1", "object": pod}
+
+    pod2 = compact_pod(make_pod(restart_count=1))
+    msg = encoder.encode("MODIFIED", pod2)
+    assert msg["delta"] == {"status": {"container_statuses": pod2["status"]["container_statuses"]}}
+
+    msg = encoder.encode("DELETED", pod2)
+    assert msg["object"] == {"metadata": pod2["metadata"]}
+    assert encoder.pods == {}
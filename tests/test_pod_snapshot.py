@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+from console.libs.pod_snapshot import is_newer, parse_resource_version
+
+
+def test_parse_resource_version():
+    assert parse_resource_version("123") == 123
+    assert parse_resource_version(None) is None
+    assert parse_resource_version("abc") is None
+
+
+def test_is_newer():
+    assert is_newer("11", "10")
+    assert not is_newer("10", "10")
+    assert not is_newer("9", "10")
+    # resource versions which can't be compared are always newer
+    assert is_newer(None, "10")
+    assert is_newer("abc", "10")
@@ -0,0 +1,66 @@
+import json
+
+from console.libs.pubsub import Subscription, PubSubMultiplexer
+
+
+class FakePubSub(object):
+    def __init__(self):
+        self.channels = set()
+
+    def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+
+
+class FakeRedis(object):
+    def pubsub(self, **kwargs):
+        return FakePubSub()
+
+
+class FakeGreenlet(object):
+    dead = False
+
+
+def make_event(uid, phase):
+    return json.dumps({"action": "MODIFIED", "object": {"metadata": {"uid": uid}, "status": {"phase": phase}}})
+
+
+def test_subscription_backpressure():
+    sub = Subscription(None, maxsize=3)
+    for i in range(5):
+        sub.put("ch", str(i))
+    assert sub.dropped == 2
+    assert [sub.get(0)[1] for _ in range(3)] == ["2", "3", "4"]
+    assert sub.get(0) is None
+
+    sub = Subscription(None, maxsize=3, coalesce_key=lambda data: json.loads(data)["object"]["metadata"]["uid"])
+    sub.put("ch", make_event("a", "Pending"))
+    sub.put("ch", make_event("b", "Pending"))
+    sub.put("ch", make_event("a", "Running"))
+    sub.put("ch", make_event("c", "Pending"))
+    # the two events of pod a are merged
+    assert sub.dropped == 1
+    assert [json.loads(sub.get(0)[1])["object"]["metadata"]["uid"] for _ in range(3)] == ["b", "a", "c"]
+
+
+def test_multiplexer_refcount():
+    mux = PubSubMultiplexer(FakeRedis())
+    # don't start the reader greenlet
+    mux._greenlet = FakeGreenlet()
+
+    sub1 = Subscription(mux)
+    sub2 = Subscription(mux)
+    mux.subscribe(sub1, ["ch1", "ch2"])
+    mux.subscribe(sub2, ["ch1"])
+    assert mux.pubsub.channels == {"ch1", "ch2"}
+
+    mux.dispatch(b"ch1", b"hello")
+    assert sub1.get(0) == ("ch1", "hello")
+    assert sub2.get(0) == ("ch1", "hello")
+
+    sub1.close()
+    assert mux.pubsub.channels == {"ch1"}
+    sub2.close()
+    assert mux.pubsub.channels == set()
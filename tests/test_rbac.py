@@ -113,3 +113,41 @@ def test_delete_app(test_db):
     assert app.roles.count() == 0
     app.delete()
 
+
+
+def test_permission_index():
+    from addict import Dict
+    from console.models.rbac import PermissionIndex, actions_to_mask
+
+    def make_role(actions, clusters, app_names):
+        return Dict(actions_mask=actions_to_mask(actions), cluster_list=clusters, app_names=app_names)
+
+    reader = make_role([RBACAction.GET], ["c1", "c2"], ["app1"])
+    deployer = make_role([RBACAction.DEPLOY], ["c1"], [])
+    admin = make_role([RBACAction.ADMIN], ["c2"], ["app2"])
+    idx = PermissionIndex.build([reader, deployer, admin])
+
+    assert idx.check([RBACAction.GET], "app1")
+    assert idx.check([RBACAction.GET], "app1", "c2")
+    assert not idx.check([RBACAction.GET], "app3")
+    assert idx.check([RBACAction.DEPLOY], "app3", "c1")
+    assert not idx.check([RBACAction.DEPLOY], "app3", "c2")
+    # the actions must be granted by one role
+    assert not idx.check([RBACAction.GET, RBACAction.DEPLOY], "app1", "c1")
+    # app admin can do anything on the app
+    assert idx.check([RBACAction.DELETE, RBACAction.BUILD], "app2", "c2")
+    assert not idx.check([RBACAction.DELETE], "app2", "c1")
+    # but nothing when app is ignored
+    assert not idx.check([RBACAction.DELETE])
+    assert idx.check([RBACAction.GET])
+    assert idx.check([RBACAction.GET], cluster="c2")
+    assert not idx.check([RBACAction.DEPLOY], cluster="c2")
+    assert idx.clusters == {"c1", "c2"}
+
+
+def test_action_mask():
+    from console.models.rbac import actions_to_mask, mask_to_actions
+
+    actions = [RBACAction.GET, RBACAction.DEPLOY, RBACAction.KAE_ADMIN]
+    assert mask_to_actions(actions_to_mask(actions)) == actions
+    assert actions_to_mask([]) == 0
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from console.libs import spec_cache
+
+from .prepare import default_specs_text
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def test_specs_cache_key_has_schema_version():
+    key = spec_cache.make_specs_cache_key(default_specs_text)
+    assert spec_cache._schema_version in key
+    assert key != spec_cache.make_specs_cache_key(default_specs_text + "\n")
+
+
+def test_load_specs_unpickle_error(monkeypatch):
+    rds = FakeRedis()
+    monkeypatch.setattr(spec_cache, "rds", rds)
+    spec_cache._local_specs.clear()
+
+    key = spec_cache.make_specs_cache_key(default_specs_text)
+    # written by a worker with other classes
+    rds.set(key, b"not a pickle")
+    specs = spec_cache.load_specs(default_specs_text)
+    assert specs.appname == spec_cache.app_specs_schema.load(
+        spec_cache.yaml.safe_load(default_specs_text)).data.appname
+    assert rds.get(key) is None
+
+    # cached again by the next load
+    assert spec_cache.load_specs(default_specs_text).appname == specs.appname
+    assert rds.get(key) is not None
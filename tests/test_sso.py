@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from console.libs.sso import SSOSnapshot
+
+
+def test_sso_snapshot():
+    group_map = {
+        "g1": {"id": "g1", "name": "dev"},
+        "g2": {"id": "g2", "name": "ops"},
+    }
+    user_map = {
+        "alice": {"username": "alice", "group_ids": ["g1", "g2"]},
+        "bob": {"username": "bob", "group_ids": ["g1", "deleted"]},
+        "carol": {"username": "carol", "group_ids": []},
+    }
+    snapshot = SSOSnapshot(user_map, group_map)
+
+    assert snapshot.get_user("alice") is user_map["alice"]
+    assert snapshot.get_group_by_name("ops")["id"] == "g2"
+    assert snapshot.get_group_by_name("qa") is None
+    assert [grp["id"] for grp in snapshot.get_groups_by_user("alice")] == ["g1", "g2"]
+    # the groups which don't exist are ignored
+    assert [grp["id"] for grp in snapshot.get_groups_by_user("bob")] == ["g1"]
+    assert snapshot.get_groups_by_user("carol") == []
+    assert snapshot.get_groups_by_user("dave") is None
+    assert sorted(u["username"] for u in snapshot.get_group_members("g1")) == ["alice", "bob"]
+    assert snapshot.get_group_members("g3") is None
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from console.libs import token_cache
+
+
+def test_validate_offline_token_type(monkeypatch):
+    claims = {}
+    monkeypatch.setattr(token_cache, "SSO_CLIENT_ID", "console")
+    monkeypatch.setattr(token_cache, "_get_jwks", lambda force=False: {"keys": [{"kid": "k1"}]})
+    monkeypatch.setattr(token_cache.jwt, "get_unverified_header", lambda token: {"kid": "k1"})
+    monkeypatch.setattr(token_cache.jwt, "decode", lambda *args, **kwargs: dict(claims))
+
+    claims.update({"typ": "Bearer", "azp": "console", "preferred_username": "alice"})
+    validity, info = token_cache._validate_offline("token")
+    assert validity is True
+    assert info["username"] == "alice"
+
+    # ID token
+    claims.update({"typ": "ID"})
+    validity, info = token_cache._validate_offline("token")
+    assert validity is not True and info is None
+
+    # access token of another client
+    claims.update({"typ": "Bearer", "azp": "other", "aud": ["account"]})
+    validity, info = token_cache._validate_offline("token")
+    assert validity is not True and info is None
+    claims.update({"aud": "console"})
+    validity, info = token_cache._validate_offline("token")
+    assert validity is True